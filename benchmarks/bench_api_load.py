@@ -0,0 +1,280 @@
+"""
+Load test of the allocation API: latency percentiles, throughput and SQL
+statements per request for a few traffic shapes.
+
+    allocate    concurrent allocations spread over many skus
+    mix         four allocations for every new batch
+    hot-sku     every request allocates the same sku, racing on its version
+    history     allocations to a sku that already has a long allocation history
+
+By default the app from `make_app()` runs in this process through
+httpx.ASGITransport on a throwaway SQLite database. `--db postgres` uses the Postgres
+from docker-compose and `--target uvicorn` starts `src/run.py` and sends
+real HTTP requests (no statement counts then, they happen in the server).
+Run from the repository root:
+
+    PYTHONPATH=src python benchmarks/bench_api_load.py --output bench-results/$(git rev-parse --short HEAD).json
+    PYTHONPATH=src python benchmarks/bench_api_load.py --db postgres --target uvicorn --requests 5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+UVICORN_URL = "http://localhost:10300"
+SCENARIOS = ("allocate", "mix", "hot-sku", "history")
+
+
+@dataclass
+class Scenario:
+    name: str
+    setup: Callable[[httpx.AsyncClient], Awaitable[None]]
+    request: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+
+def make_scenarios(prefix: str, skus: int, history: int) -> Dict[str, Scenario]:
+    def sku(n: int) -> str:
+        return f"{prefix}-sku-{n}"
+
+    async def add_stock(client: httpx.AsyncClient, names: List[str]) -> None:
+        batches = [
+            {"reference": f"{prefix}-stock-{name}", "sku": name, "purchased_quantity": 10**9, "eta": None}
+            for name in names
+        ]
+        response = await client.post("/add_batches", json=batches)
+        response.raise_for_status()
+
+    async def allocate(client: httpx.AsyncClient, name: str, orderid: str) -> httpx.Response:
+        return await client.post("/allocate", json={"orderid": orderid, "sku": name, "qty": 1})
+
+    async def add_history(client: httpx.AsyncClient) -> None:
+        await add_stock(client, [sku(-2)])
+        for start in range(0, history, 1000):
+            lines = [
+                {"orderid": f"{prefix}-past-{n}", "sku": sku(-2), "qty": 1}
+                for n in range(start, min(start + 1000, history))
+            ]
+            response = await client.post("/allocate/batch", json=lines)
+            response.raise_for_status()
+
+    async def mixed(client: httpx.AsyncClient, n: int) -> httpx.Response:
+        if n % 5 == 0:
+            batch = {"reference": f"{prefix}-mix-{n}", "sku": sku(n % skus), "purchased_quantity": 100, "eta": None}
+            return await client.post("/add_batch", json=batch)
+        return await allocate(client, sku(n % skus), f"{prefix}-mix-{n}")
+
+    spread = [sku(n) for n in range(skus)]
+    return {
+        "allocate": Scenario(
+            "allocate",
+            lambda client: add_stock(client, spread),
+            lambda client, n: allocate(client, sku(n % skus), f"{prefix}-allocate-{n}"),
+        ),
+        "mix": Scenario("mix", lambda client: asyncio.sleep(0), mixed),
+        "hot-sku": Scenario(
+            "hot-sku",
+            lambda client: add_stock(client, [sku(-1)]),
+            lambda client, n: allocate(client, sku(-1), f"{prefix}-hot-{n}"),
+        ),
+        "history": Scenario(
+            "history",
+            add_history,
+            lambda client, n: allocate(client, sku(-2), f"{prefix}-history-{n}"),
+        ),
+    }
+
+
+class StatementCounter:
+    """Counts the statements the engine of this process sends to the database."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, *args) -> None:
+        self.count += 1
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    requests: int,
+    concurrency: int,
+    statements: Optional[StatementCounter],
+) -> dict:
+    await scenario.setup(client)
+
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    pending = iter(range(requests))
+
+    async def worker() -> None:
+        for n in pending:
+            start = time.perf_counter()
+            response = await scenario.request(client, n)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] += 1
+
+    before = statements.count if statements else 0
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    p50, p95, p99 = (statistics.quantiles(latencies, n=100)[p - 1] * 1000 for p in (50, 95, 99))
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "throughput": requests / elapsed,
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "statements_per_request": (statements.count - before) / requests if statements else None,
+    }
+
+
+@asynccontextmanager
+async def in_process_client():
+    # imported here, after DB_URI is set for the engine the app creates
+    from sqlalchemy import event
+
+    from entrypoints.fastapi_app import make_app
+    from service_layer import unit_of_work
+
+    app = make_app()
+    # ASGITransport doesn't send lifespan events, so the app's lifespan runs here
+    async with app.router.lifespan_context(app):
+        statements = StatementCounter()
+        event.listen(unit_of_work.get_engine().sync_engine, "before_cursor_execute", statements)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            yield client, statements
+
+
+@asynccontextmanager
+async def uvicorn_client():
+    server = subprocess.Popen([sys.executable, "run.py"], cwd=SRC, env={**os.environ, "API_HOST": "localhost"})
+    try:
+        async with httpx.AsyncClient(base_url=UVICORN_URL, timeout=60) as client:
+            for _ in range(100):
+                try:
+                    if (await client.get("/health_check")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.2)
+            else:
+                raise RuntimeError("uvicorn did not come up")
+            yield client, None
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    database = None
+    if args.db == "sqlite":
+        # a file rather than :memory:, which is one connection shared by every
+        # concurrent session, /dev/shm keeps it in memory where there is one.
+        # sqlite has a single writer, sessions queue for one pooled connection
+        # instead of failing with "database is locked". The outbox relay holds
+        # its session while the handlers use another one, so it is left out
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        database = Path(directory) / f"bench-{uuid.uuid4().hex}.db"
+        os.environ.update(
+            DB_URI=f"sqlite+aiosqlite:///{database}",
+            DB_POOL_SIZE="1",
+            DB_MAX_OVERFLOW="0",
+            OUTBOX_RELAY_IN_PROCESS="false",
+        )
+    prefix = f"bench-{uuid.uuid4().hex[:6]}"
+    scenarios = make_scenarios(prefix, args.skus, args.history)
+
+    results = {}
+    client_context = uvicorn_client() if args.target == "uvicorn" else in_process_client()
+    try:
+        async with client_context as (client, statements):
+            for name in args.scenarios:
+                result = await run_scenario(client, scenarios[name], args.requests, args.concurrency, statements)
+                results[name] = result
+                per_request = result["statements_per_request"]
+                print(
+                    f"{name:>10}: {result['throughput']:8.1f} req/s  p50 {result['p50_ms']:7.1f} ms"
+                    f"  p95 {result['p95_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms"
+                    f"  {'-' if per_request is None else f'{per_request:.1f}'} statements/req  {result['statuses']}"
+                )
+    finally:
+        if database is not None:
+            database.unlink(missing_ok=True)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "target": args.target,
+        "db": args.db,
+        "options": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def compare(before: dict, after: dict) -> None:
+    print(f"\nchanges against {before.get('commit') or 'the earlier run'}")
+    for name, result in after["results"].items():
+        previous = before["results"].get(name)
+        if previous is None:
+            continue
+        changes = "  ".join(
+            f"{key} {(result[key] - previous[key]) / previous[key]:+.1%}"
+            for key in ("throughput", "p50_ms", "p95_ms", "p99_ms", "statements_per_request")
+            if result[key] is not None and previous[key]
+        )
+        print(f"{name:>10}: {changes}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=("asgi", "uvicorn"), default="asgi")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--requests", type=int, default=1000, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--skus", type=int, default=50, help="skus the allocate and mix scenarios spread over")
+    parser.add_argument("--history", type=int, default=20_000, help="allocations already on the history sku")
+    parser.add_argument("--scenario", dest="scenarios", action="append", choices=SCENARIOS)
+    parser.add_argument("--output", type=Path, help="write the results as json, e.g. one file per commit")
+    parser.add_argument("--compare", type=Path, help="results json of an earlier run to print the changes against")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+
+    report = asyncio.run(run(args))
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), report)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
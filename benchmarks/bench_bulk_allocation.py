@@ -0,0 +1,75 @@
+"""
+Throughput of replanning many order lines: looping over `Product.allocate`
+against `domain.planning.allocate_columns` on the same column data.
+
+    PYTHONPATH=src python benchmarks/bench_bulk_allocation.py --lines 1000000
+"""
+
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+from domain.model import Batch, OrderLine, Product
+from domain.planning import allocate_columns
+
+
+def make_columns(lines: int, batches: int, skus: int, seed: int) -> tuple:
+    rng = random.Random(seed)
+    sku_names = [f"sku-{n}" for n in range(skus)]
+    etas = [None] + [date.today() + timedelta(days=d) for d in range(1, 30)]
+    # stock for most of the lines, so some skus run out
+    per_batch = max(1, lines * 5 * 9 // 10 // batches)
+
+    batch_columns = (
+        [f"batch-{n}" for n in range(batches)],
+        [rng.choice(sku_names) for _ in range(batches)],
+        [rng.randint(per_batch // 2, per_batch * 3 // 2) for _ in range(batches)],
+        [rng.choice(etas) for _ in range(batches)],
+    )
+    line_columns = (
+        [rng.choice(sku_names) for _ in range(lines)],
+        [rng.randint(1, 9) for _ in range(lines)],
+        [f"order-{n}" for n in range(lines)],
+    )
+    return line_columns, batch_columns
+
+
+def through_products(line_columns, batch_columns) -> list:
+    products = {}
+    for ref, sku, qty, eta in zip(*batch_columns):
+        products.setdefault(sku, Product(sku, [])).batches.append(Batch(ref, sku, qty, eta))
+
+    refs = []
+    for sku, qty, orderid in zip(*line_columns):
+        product = products.get(sku)
+        refs.append(product.allocate(OrderLine(orderid, sku, qty)) if product else None)
+    return refs
+
+
+def through_columns(line_columns, batch_columns) -> list:
+    return allocate_columns(*line_columns, *batch_columns).batchref
+
+
+def run(args) -> None:
+    line_columns, batch_columns = make_columns(args.lines, args.batches, args.skus, args.seed)
+    print(f"{args.lines} lines, {args.batches} batches, {args.skus} skus")
+
+    results = {}
+    for name, allocate in (("Product.allocate", through_products), ("allocate_columns", through_columns)):
+        start = time.perf_counter()
+        results[name] = allocate(line_columns, batch_columns)
+        elapsed = time.perf_counter() - start
+        allocated = sum(ref is not None for ref in results[name])
+        print(f"{name:>20}: {elapsed:8.2f} s  {args.lines / elapsed:12,.0f} lines/s  {allocated} allocated")
+
+    assert results["Product.allocate"] == results["allocate_columns"], "results differ"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--batches", type=int, default=20_000)
+    parser.add_argument("--skus", type=int, default=2_000)
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
@@ -0,0 +1,70 @@
+"""
+Set operations on 100k order lines: the domain dataclass against the
+pydantic adapter, and the adapter's former model_dump based hash.
+
+    PYTHONPATH=src python benchmarks/bench_orderline_hash.py
+"""
+
+import argparse
+import time
+import warnings
+
+warnings.filterwarnings("ignore", message="Field name .* shadows an attribute")
+warnings.filterwarnings("ignore", message="Pydantic serializer warnings")
+
+from adapters import pyd_model  # noqa: E402
+from dbschema import orm  # noqa: E402
+from domain import model  # noqa: E402
+
+# the adapter's hot path only matters with the orm instrumentation in place
+orm.start_mappers()
+
+
+class ModelDumpOrderLine(pyd_model.OrderLine):
+    """The adapter as it was: hashing through model_dump() on every call."""
+
+    def __hash__(self) -> int:
+        data = self.model_dump()
+        return hash((data["sku"], data["qty"], data["orderid"]))
+
+
+def make_lines(cls, n: int) -> list:
+    if issubclass(cls, pyd_model.OrderLine):
+        return [cls(orderid=f"order-{i}", sku=f"sku-{i % 100}", qty=i % 10 + 1) for i in range(n)]
+    return [cls(f"order-{i}", f"sku-{i % 100}", i % 10 + 1) for i in range(n)]
+
+
+def timed(operation) -> float:
+    start = time.perf_counter()
+    operation()
+    return time.perf_counter() - start
+
+
+def bench(cls, n: int) -> dict:
+    lines = make_lines(cls, n)
+    probes = make_lines(cls, n)
+    allocations = set()
+
+    return {
+        "add": timed(lambda: [allocations.add(line) for line in lines]),
+        "contains": timed(lambda: [line in allocations for line in probes]),
+        "remove": timed(lambda: [allocations.remove(line) for line in probes]),
+    }
+
+
+def run(n: int) -> None:
+    print(f"{n} lines, seconds per operation over the whole set")
+    print(f"{'':>24} {'add':>10} {'contains':>10} {'remove':>10}")
+    for name, cls in (
+        ("model.OrderLine", model.OrderLine),
+        ("pyd_model.OrderLine", pyd_model.OrderLine),
+        ("model_dump hash", ModelDumpOrderLine),
+    ):
+        result = bench(cls, n)
+        print(f"{name:>24} {result['add']:10.4f} {result['contains']:10.4f} {result['remove']:10.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=100_000)
+    run(parser.parse_args().lines)
@@ -0,0 +1,122 @@
+"""
+Bytes held per allocation once a product is loaded.
+
+Mapped classes can't use __slots__: SQLAlchemy keeps every mapped attribute
+in the instance __dict__ next to its InstanceState, so the ORM graph is
+compared here with and without interned sku strings, and with the
+allocation load that doesn't materialise the allocations at all. The share
+allocated inside sqlalchemy.orm is the per-line bookkeeping (instance state,
+identity map, collections) no mapped representation of a line gets below,
+the way down is not loading the lines, as `add_batch` now does.
+
+    PYTHONPATH=src python benchmarks/bench_product_memory.py --allocations 200000
+"""
+
+import argparse
+import asyncio
+import gc
+import tracemalloc
+from typing import Tuple
+from unittest import mock
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from dbschema import orm
+from domain import events
+from repositories import repository
+from service_layer import services, unit_of_work
+
+SKU = "FLASH-SALE-SNEAKERS-LIMITED-EDITION"
+ORM_FILES = tracemalloc.Filter(True, "*/sqlalchemy/orm/*")
+
+orm.start_mappers()
+
+
+async def populate(engine, allocations: int, batches: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(orm.metadata.create_all)
+        await conn.execute(insert(orm.products).values(sku=SKU))
+        await conn.execute(
+            insert(orm.batches),
+            [{"reference": f"batch-{i}", "sku": SKU, "purchased_quantity": 10**9, "eta": None} for i in range(batches)],
+        )
+        await conn.execute(
+            insert(orm.order_lines),
+            [{"orderid": f"order-{i:09d}", "sku": SKU, "qty": 1} for i in range(allocations)],
+        )
+        await conn.execute(
+            text('INSERT INTO allocations ("OrderLine_id", batch_id) SELECT id, id % :batches + 1 FROM order_lines'),
+            dict(batches=batches),
+        )
+
+
+async def measure(session_factory, load: str) -> Tuple[int, int]:
+    """Bytes held by the loaded product, in total and allocated inside sqlalchemy.orm."""
+    async with session_factory() as session:
+        repo = repository.SqlAlchemyRepository(session)
+        gc.collect()
+        tracemalloc.start()
+        product = await getattr(repo, load)(SKU)
+        gc.collect()
+        held, _ = tracemalloc.get_traced_memory()
+        orm_held = sum(
+            stat.size for stat in tracemalloc.take_snapshot().filter_traces([ORM_FILES]).statistics("filename")
+        )
+        tracemalloc.stop()
+        del product
+    return held, orm_held
+
+
+async def measure_add_batch(session_factory, reference: str) -> int:
+    """Peak bytes while adding one batch to the product."""
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    gc.collect()
+    tracemalloc.start()
+    await services.add_batch(reference, SKU, 10, None, uow)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def measure_events(allocations: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    recorded = [events.Allocated(f"order-{i:09d}", SKU, 1, "batch-0") for i in range(allocations)]
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del recorded
+    return held
+
+
+async def run(args) -> None:
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    await populate(engine, args.allocations, args.batches)
+    session_factory = async_sessionmaker(bind=engine)
+
+    with mock.patch.object(orm.InternedString, "process_result_value", lambda self, value, dialect: value):
+        plain, _ = await measure(session_factory, "get")
+    interned, orm_held = await measure(session_factory, "get")
+    lightweight, _ = await measure(session_factory, "get_for_allocation")
+    # add_batch used to load the product with every allocation
+    with mock.patch.object(repository.AbstractRepository, "get_for_allocation", repository.AbstractRepository.get):
+        add_batch_full = await measure_add_batch(session_factory, "batch-full-load")
+    add_batch = await measure_add_batch(session_factory, "batch-allocation-load")
+
+    print(f"{args.allocations} allocations over {args.batches} batches, bytes per allocation")
+    print(f"{'get, plain strings':>36}: {plain / args.allocations:10.1f}")
+    print(f"{'get, interned skus':>36}: {interned / args.allocations:10.1f}")
+    print(f"{'of which sqlalchemy.orm':>36}: {orm_held / args.allocations:10.1f}")
+    print(f"{'get_for_allocation':>36}: {lightweight / args.allocations:10.1f}")
+    print(f"{'add_batch peak, full load':>36}: {add_batch_full / args.allocations:10.1f}")
+    print(f"{'add_batch peak':>36}: {add_batch / args.allocations:10.1f}")
+    print(f"{'pending Allocated events':>36}: {measure_events(args.allocations) / args.allocations:10.1f}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--allocations", type=int, default=200_000)
+    parser.add_argument("--batches", type=int, default=10)
+    asyncio.run(run(parser.parse_args()))
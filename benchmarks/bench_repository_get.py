@@ -0,0 +1,153 @@
+"""
+Query plans and latency of the product loads with and without the
+allocation indexes (dbschema.migrations revision 1).
+
+Needs the Postgres from docker-compose, run from the repository root:
+
+    PYTHONPATH=src python benchmarks/bench_repository_get.py --allocations 1000000
+
+Everything it inserts uses the `bench-` prefix and is deleted at the end.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import config
+from dbschema import migrations, orm
+from repositories import repository
+
+HOT_SKU = "bench-hot"
+
+orm.start_mappers()
+
+
+async def populate(conn, allocations: int, batches: int, noise_skus: int) -> None:
+    await conn.execute(
+        text("INSERT INTO products (sku) SELECT 'bench-' || g FROM generate_series(1, :n) g"),
+        dict(n=noise_skus),
+    )
+    await conn.execute(text("INSERT INTO products (sku) VALUES (:sku)"), dict(sku=HOT_SKU))
+    await conn.execute(
+        text(
+            "INSERT INTO batches (reference, sku, purchased_quantity, eta)"
+            " SELECT 'bench-batch-' || g, CASE WHEN g <= :batches THEN :sku ELSE 'bench-' || (g % :n + 1) END,"
+            " 1000000000, NULL FROM generate_series(1, :batches + :n) g"
+        ),
+        dict(batches=batches, n=noise_skus, sku=HOT_SKU),
+    )
+    # half of the lines belong to the hot sku, the rest is spread over the other skus
+    await conn.execute(
+        text(
+            "INSERT INTO order_lines (orderid, sku, qty)"
+            " SELECT 'bench-order-' || g, CASE WHEN g % 2 = 0 THEN :sku ELSE 'bench-' || (g % :n + 1) END, 1"
+            " FROM generate_series(1, :allocations) g"
+        ),
+        dict(allocations=allocations, n=noise_skus, sku=HOT_SKU),
+    )
+    result = await conn.execute(text("SELECT min(id) FROM batches WHERE sku = :sku"), dict(sku=HOT_SKU))
+    first_batch_id = result.scalar()
+    await conn.execute(
+        text(
+            'INSERT INTO allocations ("OrderLine_id", batch_id)'
+            " SELECT id, :first + id % :batches FROM order_lines WHERE sku = :sku AND orderid LIKE 'bench-order-%'"
+        ),
+        dict(first=first_batch_id, batches=batches, sku=HOT_SKU),
+    )
+    await conn.execute(
+        text(
+            'INSERT INTO allocations ("OrderLine_id", batch_id)'
+            " SELECT ol.id, b.id FROM order_lines ol JOIN batches b ON b.sku = ol.sku"
+            " WHERE ol.sku <> :sku AND ol.orderid LIKE 'bench-order-%' AND b.reference LIKE 'bench-batch-%'"
+        ),
+        dict(sku=HOT_SKU),
+    )
+    await conn.execute(text("ANALYZE"))
+
+
+async def cleanup(conn) -> None:
+    await conn.execute(text("DELETE FROM order_lines WHERE orderid LIKE 'bench-order-%'"))
+    await conn.execute(text("DELETE FROM batches WHERE reference LIKE 'bench-batch-%'"))
+    await conn.execute(text("DELETE FROM products WHERE sku LIKE 'bench-%'"))
+
+
+async def set_indexes(engine, present: bool) -> None:
+    async with engine.begin() as conn:
+        for table in (orm.order_lines, orm.batches, orm.allocations):
+            for index in table.indexes:
+                if present:
+                    await conn.run_sync(index.create, checkfirst=True)
+                else:
+                    await conn.run_sync(index.drop, checkfirst=True)
+        await conn.execute(text("ANALYZE"))
+
+
+async def measure(engine, load: str, repeat: int) -> list:
+    session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    timings = []
+    for _ in range(repeat):
+        async with session_factory() as session:
+            repo = repository.SqlAlchemyRepository(session)
+            start = time.perf_counter()
+            await getattr(repo, load)(HOT_SKU)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def explain(engine, load: str) -> None:
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", capture)
+    await measure(engine, load, 1)
+    event.remove(engine.sync_engine, "before_cursor_execute", capture)
+
+    async with engine.connect() as conn:
+        for statement, parameters in statements:
+            print(f"\n--- {' '.join(statement.split())[:160]}")
+            result = await conn.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+            for (line,) in result:
+                print(f"    {line}")
+
+
+async def run(args) -> None:
+    engine = create_async_engine(config.get_postgres_uri())
+
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        await cleanup(conn)
+        print(f"populating {args.allocations} allocations ...")
+        await populate(conn, args.allocations, args.batches, args.noise_skus)
+
+    try:
+        for indexed in (False, True):
+            await set_indexes(engine, indexed)
+            print(f"\n===== {'with' if indexed else 'without'} indexes =====")
+            for load in ("get", "get_for_allocation"):
+                timings = await measure(engine, load, args.repeat)
+                print(
+                    f"{load:>20}: p50 {statistics.median(timings) * 1000:9.1f} ms"
+                    f"  min {min(timings) * 1000:9.1f} ms  max {max(timings) * 1000:9.1f} ms"
+                )
+                if args.explain:
+                    await explain(engine, load)
+    finally:
+        async with engine.begin() as conn:
+            await cleanup(conn)
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--allocations", type=int, default=1_000_000)
+    parser.add_argument("--batches", type=int, default=20, help="batches of the hot sku")
+    parser.add_argument("--noise-skus", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--no-explain", dest="explain", action="store_false")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,132 @@
+"""
+Cold start of the api: how long importing the app takes in a fresh
+interpreter, and how long `src/run.py` takes from spawn to answering
+`/health_check`. The first start runs against an empty database and creates
+the schema, the following ones find it current. This is what the startup
+probe of `k8s/sp-deployment.yaml` has to allow for.
+
+By default on a throwaway SQLite database, `--db postgres` uses the Postgres
+from docker-compose and `--production` starts the multi-worker server.
+Run from the repository root:
+
+    PYTHONPATH=src python benchmarks/bench_startup.py --output bench-results/startup-$(git rev-parse --short HEAD).json
+    PYTHONPATH=src python benchmarks/bench_startup.py --production --workers 4 --starts 5
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+IMPORTS = {
+    "app": "import entrypoints.fastapi_app",
+    "run": "import run",
+}
+
+
+def time_import(statement: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", statement], cwd=SRC, check=True)
+    return time.perf_counter() - start
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_ready(env: Dict[str, str], timeout: float) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "run.py"],
+        cwd=SRC,
+        env={**env, "API_HOST": "localhost", "API_PORT": str(port)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(base_url=f"http://localhost:{port}", timeout=1) as client:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if client.get("/health_check").status_code == 200:
+                        return time.perf_counter() - start
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise RuntimeError(f"run.py did not answer within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def summary(seconds: List[float]) -> dict:
+    return {"median_ms": statistics.median(seconds) * 1000, "max_ms": max(seconds) * 1000, "runs": len(seconds)}
+
+
+def run(args) -> dict:
+    env = {**os.environ, "OUTBOX_RELAY_IN_PROCESS": "false"}
+    database = None
+    if args.db == "sqlite":
+        database = Path(tempfile.gettempdir()) / f"bench-startup-{uuid.uuid4().hex}.db"
+        env["DB_URI"] = f"sqlite+aiosqlite:///{database}"
+    if args.production:
+        env.update(SERVER_MODE="production", WEB_CONCURRENCY=str(args.workers))
+
+    results = {}
+    for name, statement in IMPORTS.items():
+        results[f"import_{name}"] = summary([time_import(statement) for _ in range(args.imports)])
+        print(f"{'import ' + name:>16}: {results['import_' + name]['median_ms']:7.1f} ms median")
+
+    try:
+        # the first start creates the schema (on postgres only when it isn't there yet)
+        first = time_to_ready(env, args.timeout)
+        starts = [time_to_ready(env, args.timeout) for _ in range(args.starts)]
+    finally:
+        if database is not None:
+            database.unlink(missing_ok=True)
+
+    results["first_start"] = summary([first])
+    results["start"] = summary(starts)
+    print(f"{'first start':>16}: {first * 1000:7.1f} ms")
+    print(f"{'start':>16}: {results['start']['median_ms']:7.1f} ms median  {results['start']['max_ms']:7.1f} ms max")
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "options": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--production", action="store_true", help="SERVER_MODE=production")
+    parser.add_argument("--workers", type=int, default=2, help="WEB_CONCURRENCY with --production")
+    parser.add_argument("--imports", type=int, default=5, help="fresh interpreters per import measured")
+    parser.add_argument("--starts", type=int, default=5, help="starts against the existing schema")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", type=Path, help="write the results as json")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import asyncio
+import logging
+import smtplib
+from email.message import EmailMessage
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def _send(to: str, body: str, host: str, port: int, sender: str, timeout: float) -> None:
+    message = EmailMessage()
+    message["From"], message["To"], message["Subject"] = sender, to, "Allocation service notification"
+    message.set_content(body)
+    with smtplib.SMTP(host, port, timeout=timeout) as server:
+        server.send_message(message)
+
+
+async def send_mail(to: str, body: str) -> None:
+    options = config.get_email_options()
+    if options["host"] is None:
+        logger.info("mail to %s: %s", to, body)
+        return
+
+    # smtplib blocks, the event loop keeps serving requests meanwhile
+    await asyncio.to_thread(_send, to, body, **options)
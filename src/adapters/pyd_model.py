@@ -1,10 +1,10 @@
 from __future__ import annotations
 
 from datetime import date
-from typing import Optional, Set
+from typing import Optional, Set, Tuple
 from uuid import UUID
 
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
 
 from domain import model
 from domain.model import OrderId, Quantity, Reference, Sku
@@ -17,22 +17,33 @@ class OrderLine(BaseModel, model.OrderLine):
     qty: Quantity
     orderid: OrderId
     id: Optional[UUID] = Field(default=None, exclude=True)
+    _hash: Optional[int] = PrivateAttr(default=None)
+
+    def _key(self) -> Tuple[OrderId, Sku, Quantity]:
+        # fields are read from __dict__, once mappers are started the attributes
+        # inherited from model.OrderLine are orm descriptors that can't read pydantic instances
+        data = self.__dict__
+        return data["orderid"], data["sku"], data["qty"]
 
     def __hash__(self) -> int:
-        data = self.model_dump()
-        return hash((data["sku"], data["qty"], data["orderid"]))  # use dump_model before hashing, fix problems with orm
+        # the model is frozen, so the hash is computed once, from the same fields as model.OrderLine's,
+        # and kept in the private attributes dict directly, skipping pydantic's __getattr__
+        private = self.__pydantic_private__
+        if private["_hash"] is None:
+            private["_hash"] = hash(self._key())
+        return private["_hash"]
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, OrderLine):
             return False
 
-        return all(
-            (
-                other.orderid == self.orderid,
-                other.sku == self.sku,
-                other.qty == self.qty,
-            )
-        )
+        return self._key() == other._key()
+
+    def model_copy(self, *, update=None, deep: bool = False) -> OrderLine:
+        copy = super().model_copy(update=update, deep=deep)
+        if update:
+            copy.__pydantic_private__["_hash"] = None
+        return copy
 
     model_config = ConfigDict(
         from_attributes=True,
@@ -61,6 +72,7 @@ class Batch(BaseModel, model.Batch):
     eta: Optional[date]
     purchased_quantity: Quantity
     allocations: Set[OrderLine] = Field(default_factory=set)
+    _allocated_quantity: Optional[int] = PrivateAttr(default=None)
 
     def __hash__(self) -> int:
         return hash(self.reference)
@@ -90,3 +102,12 @@ class Batch(BaseModel, model.Batch):
             }
         },
     )
+
+
+class BatchQuantity(BaseModel):
+    """New purchased quantity of a batch, body of /change_batch_quantity."""
+
+    reference: Reference
+    qty: Quantity = Field(ge=0)
+
+    model_config = ConfigDict(json_schema_extra={"example": {"reference": "batch-001", "qty": 20}})
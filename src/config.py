@@ -1,6 +1,10 @@
 import os
 
 
+def _get_bool(name: str, default: bool) -> bool:
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
 # TODO: Clean up, decouple config to settings and bootstrap
 def get_postgres_uri() -> str:
     host = os.environ.get("DB_HOST", "localhost")
@@ -8,3 +12,166 @@ def get_postgres_uri() -> str:
     password = os.environ.get("DB_PASSWORD", "allocate")
     user, db_name = "allocation", "allocation"
     return f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{db_name}"
+
+
+def get_database_uri() -> str:
+    """`DB_URI` when set, e.g. a sqlite+aiosqlite file for local benchmarks, the Postgres uri otherwise."""
+    return os.environ.get("DB_URI") or get_postgres_uri()
+
+
+def get_server_options() -> dict:
+    """
+    Where run.py listens and how it runs. SERVER_MODE=production starts
+    WEB_CONCURRENCY worker processes, logs only an ACCESS_LOG_SAMPLE_RATE
+    fraction of the requests and gives in-flight requests
+    GRACEFUL_SHUTDOWN_TIMEOUT seconds to finish on SIGTERM.
+    """
+    host = os.environ.get("API_HOST", "localhost")
+    return {
+        "host": host,
+        "port": int(os.environ.get("API_PORT", 10300 if host == "localhost" else 10400)),
+        "production": os.environ.get("SERVER_MODE", "development") == "production",
+        "workers": int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        "access_log_sample_rate": float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", 0)),
+        "graceful_shutdown_timeout": float(os.environ.get("GRACEFUL_SHUTDOWN_TIMEOUT", 25)),
+    }
+
+
+def get_api_url() -> str:
+    options = get_server_options()
+    return f"http://{options['host']}:{options['port']}"
+
+
+def migrate_on_startup() -> bool:
+    """Whether every api process upgrades the schema as it starts, run.py's production mode does it once instead."""
+    return _get_bool("MIGRATE_ON_STARTUP", True)
+
+
+def get_engine_options() -> dict:
+    """
+    Connection pool and statement cache settings for `create_async_engine`.
+
+    Set both cache sizes to 0 when running behind pgbouncer in transaction mode.
+    """
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": _get_bool("DB_POOL_PRE_PING", True),
+        "connect_args": {
+            # asyncpg's own per connection statement cache
+            "statement_cache_size": int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 100)),
+            # sqlalchemy's asyncpg dialect cache of prepared statements
+            "prepared_statement_cache_size": int(os.environ.get("DB_PREPARED_STATEMENT_CACHE_SIZE", 100)),
+        },
+    }
+
+
+def get_allocate_retry_options() -> dict:
+    """How services retry an allocation that lost an optimistic concurrency race."""
+    return {
+        "max_attempts": int(os.environ.get("ALLOCATE_MAX_ATTEMPTS", 5)),
+        "base_delay": float(os.environ.get("ALLOCATE_RETRY_BASE_DELAY", 0.01)),
+        "max_delay": float(os.environ.get("ALLOCATE_RETRY_MAX_DELAY", 0.5)),
+    }
+
+
+def get_allocate_coalescing_options() -> dict:
+    """
+    Allocations of one sku arriving within `window` seconds of each other are
+    merged into one unit of work of at most `max_group_size` lines, 0 disables it.
+    """
+    return {
+        "window": float(os.environ.get("ALLOCATE_COALESCE_WINDOW_MS", 0)) / 1000,
+        "max_group_size": int(os.environ.get("ALLOCATE_COALESCE_MAX_GROUP", 100)),
+    }
+
+
+def get_messagebus_options() -> dict:
+    """
+    Size of the background event queue and how many events are handled at
+    once, by the outbox relay as well.
+    """
+    return {
+        "queue_size": int(os.environ.get("MESSAGEBUS_QUEUE_SIZE", 1000)),
+        "concurrency": int(os.environ.get("MESSAGEBUS_CONCURRENCY", 4)),
+    }
+
+
+def get_email_options() -> dict:
+    """SMTP server for notifications, without `SMTP_HOST` they are only logged."""
+    return {
+        "host": os.environ.get("SMTP_HOST"),
+        "port": int(os.environ.get("SMTP_PORT", 25)),
+        "sender": os.environ.get("SMTP_SENDER", "allocations@made.com"),
+        "timeout": float(os.environ.get("SMTP_TIMEOUT", 10)),
+    }
+
+
+def get_outbox_options() -> dict:
+    """
+    How many outbox rows the relay takes per transaction, how long it sleeps
+    when there are none, and after how many failures an event is dead-lettered.
+    """
+    return {
+        "batch_size": int(os.environ.get("OUTBOX_BATCH_SIZE", 500)),
+        "poll_interval": float(os.environ.get("OUTBOX_POLL_INTERVAL", 0.5)),
+        "max_attempts": int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5)),
+    }
+
+
+def run_outbox_relay_in_process() -> bool:
+    """Whether every api process also runs an outbox relay, instead of a separate `relay.py`."""
+    return _get_bool("OUTBOX_RELAY_IN_PROCESS", True)
+
+
+def instrumentation_enabled() -> bool:
+    """Whether requests are timed per stage and SQL statements counted for `/metrics`."""
+    return _get_bool("INSTRUMENTATION_ENABLED", True)
+
+
+def get_sql_profiler_options() -> dict:
+    """
+    Opt-in per request SQL profiling: how many request profiles are kept,
+    from how many ms a statement is slow, and how many runs of the same
+    select within one request are flagged as an N+1.
+    """
+    return {
+        "enabled": _get_bool("SQL_PROFILER_ENABLED", False),
+        "buffer_size": int(os.environ.get("SQL_PROFILER_BUFFER_SIZE", 200)),
+        "slow_query_ms": float(os.environ.get("SQL_PROFILER_SLOW_QUERY_MS", 100)),
+        "repeat_threshold": int(os.environ.get("SQL_PROFILER_REPEAT_THRESHOLD", 5)),
+    }
+
+
+def get_availability_cache_options() -> dict:
+    """Bounds of the per-process availability cache, `ttl` in seconds also caps staleness across processes."""
+    return {
+        "maxsize": int(os.environ.get("AVAILABILITY_CACHE_SIZE", 10_000)),
+        "ttl": float(os.environ.get("AVAILABILITY_CACHE_TTL", 5)),
+    }
+
+
+def get_idempotency_cache_options() -> dict:
+    """Bounds of the per-process cache of idempotency key results, the database keeps them for the retention."""
+    return {
+        "maxsize": int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10_000)),
+        "ttl": float(os.environ.get("IDEMPOTENCY_CACHE_TTL", 3600)),
+    }
+
+
+def get_idempotency_key_options() -> dict:
+    """
+    How long idempotency key results stay in the database, never less than the
+    cache TTL, and how often older ones are deleted, both in seconds.
+    """
+    retention = float(os.environ.get("IDEMPOTENCY_KEY_RETENTION", 24 * 3600))
+    return {
+        "retention": max(retention, get_idempotency_cache_options()["ttl"]),
+        "purge_interval": float(os.environ.get("IDEMPOTENCY_KEY_PURGE_INTERVAL", 600)),
+    }
+
+
+def get_export_options() -> dict:
+    """Rows fetched from the server-side cursor, and sent as one chunk, at a time by the /export endpoints."""
+    return {"chunk_size": int(os.environ.get("EXPORT_CHUNK_SIZE", 5_000))}
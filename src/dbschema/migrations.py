@@ -0,0 +1,136 @@
+"""
+Schema revisions for databases created before a change to `orm.metadata`.
+
+`metadata.create_all` only creates missing tables, it never touches tables
+that already exist, so anything added to an existing table (like an index)
+needs a revision here. A database already on `SCHEMA_VERSION` skips
+`create_all` altogether, so a new table needs a revision that creates it as
+well. Apply them with:
+
+    python -m dbschema.migrations
+"""
+
+from typing import Callable, List, Tuple
+
+from sqlalchemy import delete, func, insert, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+
+from dbschema import orm
+
+
+def add_allocation_indexes(connection: Connection) -> None:
+    """
+    Indexes for the product load and allocation queries, unique batch references.
+    Fails if the database already holds two batches with the same reference.
+    """
+    for table in (orm.order_lines, orm.batches, orm.allocations):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def add_outbox(connection: Connection) -> None:
+    orm.outbox.create(connection, checkfirst=True)
+
+
+def add_allocations_view(connection: Connection) -> None:
+    orm.allocations_view.create(connection, checkfirst=True)
+
+
+def add_idempotency_keys(connection: Connection) -> None:
+    orm.idempotency_keys.create(connection, checkfirst=True)
+
+
+def add_idempotency_keys_created_at_index(connection: Connection) -> None:
+    """Index for deleting the idempotency keys older than the retention window."""
+    for index in orm.idempotency_keys.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def add_allocations_view_qty(connection: Connection) -> None:
+    """
+    The qty tells two lines of an order for the same sku and batch apart. The
+    rows written before can't get theirs back, so the view is rebuilt from the
+    allocations themselves.
+    """
+    view = orm.allocations_view
+    if "qty" not in {column["name"] for column in inspect(connection).get_columns(view.name)}:
+        connection.execute(text(f"ALTER TABLE {view.name} ADD COLUMN qty INTEGER NOT NULL DEFAULT 0"))
+
+    connection.execute(delete(view))
+    connection.execute(
+        insert(view).from_select(
+            ["orderid", "sku", "qty", "batchref"],
+            select(orm.order_lines.c.orderid, orm.order_lines.c.sku, orm.order_lines.c.qty, orm.batches.c.reference)
+            .join(orm.allocations, orm.allocations.c.OrderLine_id == orm.order_lines.c.id)
+            .join(orm.batches, orm.allocations.c.batch_id == orm.batches.c.id)
+            .order_by(orm.allocations.c.id),
+        )
+    )
+
+
+def add_outbox_attempts(connection: Connection) -> None:
+    """Failed attempts per outbox event, and when the relay gave up on it."""
+    existing = {column["name"] for column in inspect(connection).get_columns(orm.outbox.name)}
+    for column in (orm.outbox.c.attempts, orm.outbox.c.dead_lettered_at):
+        if column.name not in existing:
+            connection.execute(text(f"ALTER TABLE {orm.outbox.name} ADD {CreateColumn(column).compile(connection)}"))
+
+
+REVISIONS: List[Tuple[int, Callable[[Connection], None]]] = [
+    (1, add_allocation_indexes),
+    (2, add_outbox),
+    (3, add_allocations_view),
+    (4, add_idempotency_keys),
+    (5, add_idempotency_keys_created_at_index),
+    (6, add_allocations_view_qty),
+    (7, add_outbox_attempts),
+]
+
+SCHEMA_VERSION = REVISIONS[-1][0]
+
+
+def current_version(connection: Connection) -> int:
+    return connection.execute(select(func.max(orm.schema_version.c.version))).scalar() or 0
+
+
+def upgrade(connection: Connection) -> int:
+    """
+    Create missing tables and apply every revision newer than the one
+    recorded in `schema_version`. A database that is already current only
+    has its version read, not every table looked up.
+
+    Returns:
+        int: The schema version the database ends up on.
+    """
+
+    if inspect(connection).has_table(orm.schema_version.name):
+        version = current_version(connection)
+        if version >= SCHEMA_VERSION:
+            return version
+
+    orm.metadata.create_all(connection)
+
+    version = current_version(connection)
+    for revision, apply in REVISIONS:
+        if revision > version:
+            apply(connection)
+            connection.execute(insert(orm.schema_version).values(version=revision))
+            version = revision
+
+    return version
+
+
+async def main() -> None:
+    from service_layer import unit_of_work
+
+    async with unit_of_work.get_engine().begin() as conn:
+        version = await conn.run_sync(upgrade)
+    await unit_of_work.dispose_engine()
+    print(f"database schema at version {version}")
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(main())
@@ -1,6 +1,9 @@
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table, event
+import sys
+
+from sqlalchemy import JSON, Column, Date, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, event, func
 from sqlalchemy.orm import registry, relationship
 from sqlalchemy.sql import text
+from sqlalchemy.types import TypeDecorator
 
 from domain.model import Batch, OrderLine, Product
 
@@ -8,13 +11,27 @@ mapper_registry = registry()
 metadata = MetaData()
 
 
+class InternedString(TypeDecorator):
+    """
+    String whose loaded values are interned: the many order lines and batches
+    of one product share a single sku string instead of holding a copy each.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        return sys.intern(value) if value is not None else None
+
+
 order_lines = Table(
     "order_lines",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("sku", String(255)),
+    Column("sku", InternedString(255)),
     Column("qty", Integer),
     Column("orderid", String(255)),
+    Index("ix_order_lines_orderid_sku", "orderid", "sku"),
 )
 
 batches = Table(
@@ -22,9 +39,11 @@ batches = Table(
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("reference", String(255)),
-    Column("sku", ForeignKey("products.sku")),
+    Column("sku", InternedString(255), ForeignKey("products.sku")),
     Column("purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index("ix_batches_sku", "sku"),
+    Index("ux_batches_reference", "reference", unique=True),
 )
 
 allocations = Table(
@@ -33,6 +52,8 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("OrderLine_id", ForeignKey("order_lines.id", ondelete="CASCADE")),
     Column("batch_id", ForeignKey("batches.id", ondelete="CASCADE")),
+    Index("ix_allocations_batch_id", "batch_id"),
+    Index("ix_allocations_orderline_id", "OrderLine_id"),
 )
 
 products = Table(
@@ -42,8 +63,61 @@ products = Table(
     Column("version_number", Integer, nullable=False, server_default=text("0")),
 )
 
+# domain events written in the same transaction as the change that raised them,
+# service_layer.outbox relays them to the message bus
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", JSON, nullable=False),
+    Column("created_at", DateTime, nullable=False, server_default=func.now()),
+    Column("sent_at", DateTime, nullable=True),
+    Column("attempts", Integer, nullable=False, server_default=text("0")),
+    Column("dead_lettered_at", DateTime, nullable=True),
+    Index("ix_outbox_sent_at_id", "sent_at", "id"),
+)
+
+# read model kept up to date from Allocated/Deallocated events, never joined with the tables above
+allocations_view = Table(
+    "allocations_view",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255), nullable=False),
+    Index("ix_allocations_view_orderid", "orderid"),
+)
+
+# result of each request made with an Idempotency-Key, written in the transaction
+# of the change it made, see service_layer.idempotency
+idempotency_keys = Table(
+    "idempotency_keys",
+    metadata,
+    Column("scope", String(64), primary_key=True),
+    Column("key", String(255), primary_key=True),
+    Column("request_hash", String(64), nullable=False),
+    Column("result", JSON, nullable=False),
+    Column("created_at", DateTime, nullable=False, server_default=func.now()),
+    Index("ix_idempotency_keys_created_at", "created_at"),
+)
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True),
+)
+
+
+def start_mappers() -> None:
+    """
+    Map the domain classes onto the tables. Called from the app's lifespan,
+    scripts and tests alike, only the first call in a process maps them.
+    """
+    if mapper_registry.mappers:
+        return
 
-def start_mappers():
     lines_mapper = mapper_registry.map_imperatively(OrderLine, order_lines)
 
     batches_mapper = mapper_registry.map_imperatively(
@@ -60,10 +134,25 @@ def start_mappers():
         },
     )
 
-    mapper_registry.map_imperatively(Product, products, properties={"batches": relationship(batches_mapper)})
+    # version_number is bumped by Product itself, the mapper only checks it on update
+    mapper_registry.map_imperatively(
+        Product,
+        products,
+        properties={"batches": relationship(batches_mapper)},
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
+    )
 
 
 # tells SQLALchemy whenever a Product object is loaded from the db, call this function and init product.events
 @event.listens_for(Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._stock = None
+
+
+# allocations are loaded after the batch row itself, so only mark the running
+# total as stale here and let Batch recompute it once on first use
+@event.listens_for(Batch, "load")
+def receive_batch_load(batch, _):
+    batch._allocated_quantity = None
@@ -2,9 +2,33 @@ from dataclasses import dataclass
 
 
 class Event:
-    pass
+    # slotted like every event below, a large allocate_many keeps one Allocated per line until commit
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class OutOfStock(Event):
     sku: str
+
+
+@dataclass(slots=True)
+class Allocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass(slots=True)
+class Deallocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass(slots=True)
+class BatchQuantityChanged(Event):
+    batchref: str
+    sku: str
+    qty: int
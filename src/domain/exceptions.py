@@ -6,3 +6,9 @@ class OutOfStock(Exception):
     """OutOfStock exception for allocate fn"""
 
     sku: str
+
+
+class DuplicateBatch(Exception):
+    """Raised when a new batch has a reference another batch already has"""
+
+    pass
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+from bisect import insort
 from dataclasses import dataclass
 from datetime import date
-from typing import List, NewType, Optional, Set
+from typing import List, NewType, Optional, Set, Tuple
 
 from domain import events
 
@@ -38,6 +39,7 @@ class Batch:
         self.eta = eta
         self.purchased_quantity = qty
         self.allocations: Set[OrderLine] = set()
+        self._allocated_quantity: Optional[int] = 0
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, Batch):
@@ -55,39 +57,131 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine) -> None:
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self.allocations:
             self.allocations.add(line)
+            self._allocated_quantity += line.qty
 
     def deallocate(self, line: OrderLine) -> None:
         if line in self.allocations:
             self.allocations.remove(line)
+            if self._allocated_quantity is not None:
+                self._allocated_quantity -= line.qty
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self.allocations)
+        # running total kept by allocate/deallocate, None means it has to be
+        # recomputed once (e.g. right after the batch was loaded from the db)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self.allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
         return self.purchased_quantity - self.allocated_quantity
 
 
+def allocation_priority(batch: Batch) -> Tuple[bool, date]:
+    """Sort key for allocation: in-stock batches (no eta) first, then shipments by earliest eta."""
+    return batch.eta is not None, batch.eta or date.min
+
+
 class Product:
     def __init__(self, sku: Sku, batches: List[Batch], version_number: int = 0) -> None:
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
         self.events = []
+        self._stock: Optional[List[Batch]] = None
 
     def allocate(self, line: OrderLine) -> Optional[Reference]:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            return batch.reference
-
-        except StopIteration:
-            self.events.append(events.OutOfStock(line.sku))
+        stock = self._in_stock()
+        for position, batch in enumerate(stock):
+            if batch.can_allocate(line):
+                batch.allocate(line)
+                if batch.available_quantity <= 0:
+                    del stock[position]
+                self.version_number += 1
+                self.events.append(events.Allocated(line.orderid, line.sku, line.qty, batch.reference))
+                return batch.reference
+
+        self.events.append(events.OutOfStock(line.sku))
+        return None
+
+    def deallocate(self, line: OrderLine) -> Optional[Reference]:
+        batch = next((b for b in self.batches if line in b.allocations), None)
+        if batch is None:
             return None
+
+        batch.deallocate(line)
+        self.refresh_batch(batch)
+        self.version_number += 1
+        self.events.append(events.Deallocated(line.orderid, line.sku, line.qty, batch.reference))
+        return batch.reference
+
+    def deallocate_all(self) -> List[OrderLine]:
+        """Take every line off its batch, e.g. before allocating them all again. Returns the lines."""
+        lines = []
+        for batch in self.batches:
+            for line in list(batch.allocations):
+                batch.deallocate(line)
+                self.events.append(events.Deallocated(line.orderid, line.sku, line.qty, batch.reference))
+                lines.append(line)
+
+        if lines:
+            self._stock = None
+            self.version_number += 1
+        return lines
+
+    def change_batch_quantity(self, ref: Reference, qty: Quantity) -> List[Tuple[OrderLine, Optional[Reference]]]:
+        """
+        Set the purchased quantity of one of the product's batches. When the
+        batch ends up over-allocated its largest lines, the fewest that cover
+        the excess, are taken off and allocated again to the other batches.
+
+        Returns:
+            The lines that had to move, each with its new batch reference
+            (None when nothing else had room for it).
+        """
+
+        [batch] = [b for b in self.batches if b.reference == ref]
+        batch.purchased_quantity = qty
+        self.events.append(events.BatchQuantityChanged(ref, self.sku, qty))
+
+        moved = []
+        for line in sorted(batch.allocations, key=lambda line: (-line.qty, line.orderid)):
+            if batch.available_quantity >= 0:
+                break
+            batch.deallocate(line)
+            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty, batch.reference))
+            moved.append(line)
+
+        self.refresh_batch(batch)
+        self.version_number += 1
+        # what is left on the batch is less than the smallest line taken off, none of them goes back to it
+        return [(line, self.allocate(line)) for line in moved]
+
+    def add_batch(self, batch: Batch) -> None:
+        self.batches.append(batch)
+        self.refresh_batch(batch)
+
+    def refresh_batch(self, batch: Batch) -> None:
+        """
+        Put the batch back at its place in the allocation order after its
+        quantities changed, or drop it from there once it is exhausted.
+        """
+
+        stock = self._in_stock()
+        if batch in stock:
+            stock.remove(batch)
+        if batch.available_quantity > 0:
+            insort(stock, batch, key=allocation_priority)
+
+    def _in_stock(self) -> List[Batch]:
+        # batches with anything left to allocate, kept in allocation order,
+        # built once per loaded product instead of sorting on every allocate
+        if self._stock is None:
+            self._stock = sorted((b for b in self.batches if b.available_quantity > 0), key=allocation_priority)
+        return self._stock
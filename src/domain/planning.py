@@ -0,0 +1,95 @@
+"""
+Bulk allocation for replenishment planning: the same rule as
+`Product.allocate`, run over plain column arrays instead of loaded products.
+
+Nothing here builds OrderLine/Batch objects or records events. Lines are
+grouped per sku and each group is allocated against that sku's batches
+held as parallel lists of remaining quantities, in allocation order.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date
+from typing import Dict, List, Optional, Sequence
+
+from domain.model import OrderId, Quantity, Reference, Sku
+
+
+@dataclass
+class BulkAllocation:
+    """
+    Result columns: `batchref[i]` is the batch line i went to (None when
+    out of stock), `available[j]` is what is left of batch j.
+    """
+
+    batchref: List[Optional[Reference]]
+    available: List[int]
+
+
+def _group(skus: Sequence[Sku]) -> Dict[Sku, List[int]]:
+    groups: Dict[Sku, List[int]] = {}
+    for position, sku in enumerate(skus):
+        groups.setdefault(sku, []).append(position)
+    return groups
+
+
+def allocate_columns(
+    line_skus: Sequence[Sku],
+    line_qtys: Sequence[Quantity],
+    line_orderids: Sequence[OrderId],
+    batch_refs: Sequence[Reference],
+    batch_skus: Sequence[Sku],
+    batch_qtys: Sequence[Quantity],
+    batch_etas: Sequence[Optional[date]],
+) -> BulkAllocation:
+    """
+    Allocate every line, in the given order, to the first batch of its sku
+    with enough left: in-stock batches (no eta) first, then by earliest
+    eta, ties kept in input order. This is what allocating the lines one
+    by one through `Product.allocate` does, for lines that are unique per
+    (orderid, sku).
+
+    Batch quantities are what is still available to allocate.
+
+    Returns:
+        BulkAllocation: Batch reference per line and remaining quantity per batch.
+    """
+
+    if not len(line_skus) == len(line_qtys) == len(line_orderids):
+        raise ValueError("line columns differ in length")
+    if not len(batch_refs) == len(batch_skus) == len(batch_qtys) == len(batch_etas):
+        raise ValueError("batch columns differ in length")
+
+    batchref: List[Optional[Reference]] = [None] * len(line_skus)
+    available = list(batch_qtys)
+    batches_by_sku = _group(batch_skus)
+
+    for sku, lines in _group(line_skus).items():
+        positions = sorted(
+            (j for j in batches_by_sku.get(sku, ()) if available[j] > 0),
+            key=lambda j: (batch_etas[j] is not None, batch_etas[j] or date.min),
+        )
+        # remaining quantities of the sku's batches that still have stock,
+        # in allocation order, exhausted ones are dropped as in Product._stock
+        left = [available[j] for j in positions]
+
+        for i in lines:
+            if not left:
+                break
+            qty = line_qtys[i]
+            for k, remaining in enumerate(left):
+                if remaining >= qty:
+                    remaining -= qty
+                    batchref[i] = batch_refs[positions[k]]
+                    if remaining > 0:
+                        left[k] = remaining
+                    else:
+                        available[positions[k]] = 0
+                        del left[k], positions[k]
+                    break
+
+        for j, remaining in zip(positions, left):
+            available[j] = remaining
+
+    return BulkAllocation(batchref=batchref, available=available)
@@ -1,7 +1,7 @@
 from typing import List
 
 from domain.exceptions import OutOfStock
-from domain.model import Batch, OrderLine
+from domain.model import Batch, OrderLine, allocation_priority
 
 
 def allocate(line: OrderLine, batches: List[Batch]) -> str:
@@ -9,8 +9,8 @@ def allocate(line: OrderLine, batches: List[Batch]) -> str:
     Allocate an order line to the first batch that can fulfill it.
 
     This function attempts to allocate the given order line to the earliest
-    batch that has sufficient quantity available. Batches are assumed to be
-    sorted by arrival time (ETA), with in-stock batches prioritized.
+    batch that has sufficient quantity available. Batches don't need to be
+    sorted, in-stock batches are preferred, then the earliest ETA.
 
     Args:
         line (OrderLine): The order line to allocate.
@@ -23,10 +23,9 @@ def allocate(line: OrderLine, batches: List[Batch]) -> str:
         OutOfStock: If no batch can fulfill the order line.
     """
 
-    try:
-        batch = next(b for b in sorted(batches) if b.can_allocate(line))
-        batch.allocate(line)
-        return batch.reference
-
-    except StopIteration:
+    batch = min((b for b in batches if b.can_allocate(line)), key=allocation_priority, default=None)
+    if batch is None:
         raise OutOfStock(f"Out of stock for sku {line.sku}")
+
+    batch.allocate(line)
+    return batch.reference
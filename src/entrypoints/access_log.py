@@ -0,0 +1,16 @@
+import logging
+import random
+
+
+class SampledAccessLog(logging.Filter):
+    """Lets a `rate` fraction of uvicorn's access log lines through, server errors always."""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # uvicorn.access args: client address, method, path, http version, status code
+        args = record.args if isinstance(record.args, tuple) else ()
+        status = args[4] if len(args) == 5 else 0
+        return status >= 500 or random.random() < self.rate
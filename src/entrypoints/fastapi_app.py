@@ -1,57 +1,301 @@
+import asyncio
+import csv
+import io
+import json
 from contextlib import asynccontextmanager
+from datetime import date
 from http import HTTPStatus
+from typing import Any, AsyncIterator, List, Literal, Optional, Sequence
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
 
-from adapters.pyd_model import Batch, OrderLine
-from dbschema import orm
+import config
+from adapters.pyd_model import Batch, BatchQuantity, OrderLine
+from dbschema import migrations, orm
 from domain import exceptions
-from service_layer import services, unit_of_work
+from service_layer import (
+    coalescing,
+    idempotency,
+    instrumentation,
+    messagebus,
+    metrics,
+    outbox,
+    profiler,
+    services,
+    unit_of_work,
+    views,
+)
 
-orm.start_mappers()
+BATCH_FIELDS = {"reference", "sku", "purchased_quantity", "eta"}
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+EXPORT_MEDIA_TYPES = {"ndjson": NDJSON_MEDIA_TYPE, "csv": "text/csv"}
+
+batch_list_adapter = TypeAdapter(List[Batch])
+
+
+async def read_batches(request: Request) -> List[dict[str, Any]]:
+    """Parse a json array of batches or, for ndjson bodies, one batch per line as it streams in."""
+
+    try:
+        if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+            batches, pending = [], b""
+            async for chunk in request.stream():
+                *lines, pending = (pending + chunk).split(b"\n")
+                batches.extend(Batch.model_validate_json(line) for line in lines if line.strip())
+            if pending.strip():
+                batches.append(Batch.model_validate_json(pending))
+        else:
+            batches = batch_list_adapter.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    return [batch.model_dump(include=BATCH_FIELDS) for batch in batches]
+
+
+async def encode_rows(chunks: AsyncIterator[Sequence], columns: Sequence[str], fmt: str) -> AsyncIterator[bytes]:
+    """One ndjson or csv body chunk per chunk of rows, a csv starts with its header line."""
+
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        async for rows in chunks:
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+    else:
+        async for rows in chunks:
+            yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows).encode()
+
+
+def export_response(chunks: AsyncIterator[Sequence], columns: Sequence[str], fmt: str, name: str) -> StreamingResponse:
+    return StreamingResponse(
+        encode_rows(chunks, columns, fmt),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
+
+
+class SqlProfilerMiddleware:
+    """Profiles the statements of every http request, body streaming included."""
+
+    def __init__(self, app, sql_profiler: profiler.SqlProfiler) -> None:
+        self.app = app
+        self.sql_profiler = sql_profiler
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        with self.sql_profiler.profile(f"{scope['method']} {scope['path']}"):
+            await self.app(scope, receive, send)
 
 
 @asynccontextmanager
-async def create_tables(app: FastAPI):
-    async with unit_of_work.DEFAULT_ENGINE.begin() as conn:
-        await conn.run_sync(orm.metadata.create_all)
+async def lifespan(app: FastAPI):
+    # mappers and engine are set up here, in the worker process, and not at import time
+    orm.start_mappers()
+    engine = unit_of_work.get_engine()
+    if profiler.get_profiler() is not None:
+        profiler.get_profiler().attach(engine.sync_engine)
+    if config.migrate_on_startup():
+        async with engine.begin() as conn:
+            await conn.run_sync(migrations.upgrade)
+
+    # the idempotency key purge runs wherever the relay does
+    stop_relay, background = asyncio.Event(), []
+    if config.run_outbox_relay_in_process():
+        background = [
+            asyncio.create_task(
+                outbox.run_relay(
+                    unit_of_work.get_session_factory(),
+                    unit_of_work.SqlAlchemyUnitOfWork,
+                    **config.get_outbox_options(),
+                    stop=stop_relay,
+                )
+            ),
+            asyncio.create_task(
+                idempotency.run_purge(
+                    unit_of_work.get_session_factory(), **config.get_idempotency_key_options(), stop=stop_relay
+                )
+            ),
+        ]
     yield
+    await app.state.allocation_coalescer.drain()
+    stop_relay.set()
+    await asyncio.gather(*background)
+    await messagebus.stop()
+    await unit_of_work.dispose_engine()
 
 
 def make_app() -> FastAPI:
 
-    app = FastAPI(lifespan=create_tables)
+    app = FastAPI(lifespan=lifespan)
+    instrumentation.configure(config.instrumentation_enabled())
+    sql_profiler = profiler.configure(config.get_sql_profiler_options())
+    if sql_profiler is not None:
+        app.add_middleware(SqlProfilerMiddleware, sql_profiler=sql_profiler)
+
+        @app.get("/debug/sql-profiles", status_code=HTTPStatus.OK)
+        async def sql_profiles_endpoint(flagged: bool = False) -> list[dict[str, Any]]:
+            return sql_profiler.recent(flagged_only=flagged)
+
+    app.state.allocation_coalescer = coalescing.AllocationCoalescer(
+        unit_of_work.SqlAlchemyUnitOfWork,
+        **config.get_allocate_coalescing_options(),
+    )
 
     @app.get("/health_check", status_code=HTTPStatus.OK)
     async def health_check() -> dict[str, str]:
         return {"status": "Ok"}
 
+    @app.get("/metrics", status_code=HTTPStatus.OK)
+    async def metrics_endpoint() -> Response:
+        return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
     @app.post("/allocate", status_code=HTTPStatus.ACCEPTED)
     async def allocate_endpoint(
         line: OrderLine,
+        idempotency_key: Optional[str] = Header(None, max_length=255),
     ) -> dict[str, str]:
         try:
-            uow = unit_of_work.SqlAlchemyUnitOfWork()
-            batchref = await services.allocate(
+            batchref = await app.state.allocation_coalescer.allocate(
                 **line.model_dump(include={"sku", "qty", "orderid"}),
-                uow=uow,
+                idempotency_key=idempotency_key,
             )
         except (exceptions.OutOfStock, services.InvalidSku) as e:
             raise HTTPException(HTTPStatus.BAD_REQUEST, detail=str(e))
+        except idempotency.IdempotencyKeyReused as e:
+            raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, detail=str(e))
+        except unit_of_work.ConcurrencyConflict as e:
+            raise HTTPException(HTTPStatus.CONFLICT, detail=str(e))
 
         return {"status": "Ok", "batchref": batchref}
 
+    @app.post("/allocate/batch", status_code=HTTPStatus.ACCEPTED)
+    async def allocate_many_endpoint(
+        lines: List[OrderLine],
+    ) -> dict[str, Any]:
+        try:
+            uow = unit_of_work.SqlAlchemyUnitOfWork()
+            results = await services.allocate_many(
+                [line.model_dump(include={"sku", "qty", "orderid"}) for line in lines],
+                uow=uow,
+            )
+        except unit_of_work.ConcurrencyConflict as e:
+            raise HTTPException(HTTPStatus.CONFLICT, detail=str(e))
+
+        return {"status": "Ok", "results": [result.to_dict() for result in results]}
+
+    @app.post("/deallocate", status_code=HTTPStatus.OK)
+    async def deallocate_endpoint(line: OrderLine) -> dict[str, str]:
+        try:
+            uow = unit_of_work.SqlAlchemyUnitOfWork()
+            batchref = await services.deallocate(**line.model_dump(include={"sku", "qty", "orderid"}), uow=uow)
+        except services.InvalidSku as e:
+            raise HTTPException(HTTPStatus.BAD_REQUEST, detail=str(e))
+        except services.NotAllocated as e:
+            raise HTTPException(HTTPStatus.NOT_FOUND, detail=str(e))
+        except unit_of_work.ConcurrencyConflict as e:
+            raise HTTPException(HTTPStatus.CONFLICT, detail=str(e))
+
+        return {"status": "Ok", "batchref": batchref}
+
+    @app.post("/change_batch_quantity", status_code=HTTPStatus.OK)
+    async def change_batch_quantity_endpoint(change: BatchQuantity) -> dict[str, Any]:
+        try:
+            uow = unit_of_work.SqlAlchemyUnitOfWork()
+            results = await services.change_batch_quantity(change.reference, change.qty, uow=uow)
+        except services.UnknownBatch as e:
+            raise HTTPException(HTTPStatus.NOT_FOUND, detail=str(e))
+        except unit_of_work.ConcurrencyConflict as e:
+            raise HTTPException(HTTPStatus.CONFLICT, detail=str(e))
+
+        return {"status": "Ok", "moved": [result.to_dict() for result in results]}
+
+    @app.get("/availability/{sku}", status_code=HTTPStatus.OK)
+    async def availability_endpoint(sku: str) -> dict[str, Any]:
+        batches = await views.availability(sku, unit_of_work.SqlAlchemyUnitOfWork())
+        if batches is None:
+            raise HTTPException(HTTPStatus.NOT_FOUND, detail=f"Unknown sku {sku}")
+
+        return {"sku": sku, "available": sum(b["available"] for b in batches), "batches": batches}
+
+    @app.get("/allocations/{orderid}", status_code=HTTPStatus.OK)
+    async def allocations_view_endpoint(orderid: str) -> list[dict[str, str]]:
+        allocations = await views.allocations(orderid, unit_of_work.SqlAlchemyUnitOfWork())
+        if not allocations:
+            raise HTTPException(HTTPStatus.NOT_FOUND, detail=f"No allocations for order {orderid}")
+
+        return allocations
+
+    @app.get("/export/allocations", status_code=HTTPStatus.OK)
+    async def export_allocations_endpoint(
+        fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+        sku: Optional[str] = None,
+        eta_from: Optional[date] = None,
+        eta_to: Optional[date] = None,
+    ) -> StreamingResponse:
+        chunks = views.export_allocations(
+            unit_of_work.SqlAlchemyUnitOfWork(),
+            **config.get_export_options(),
+            sku=sku,
+            eta_from=eta_from,
+            eta_to=eta_to,
+        )
+        return export_response(chunks, views.ALLOCATION_EXPORT_COLUMNS, fmt, "allocations")
+
+    @app.get("/export/batches", status_code=HTTPStatus.OK)
+    async def export_batches_endpoint(
+        fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+        sku: Optional[str] = None,
+        eta_from: Optional[date] = None,
+        eta_to: Optional[date] = None,
+    ) -> StreamingResponse:
+        chunks = views.export_batches(
+            unit_of_work.SqlAlchemyUnitOfWork(),
+            **config.get_export_options(),
+            sku=sku,
+            eta_from=eta_from,
+            eta_to=eta_to,
+        )
+        return export_response(chunks, views.BATCH_EXPORT_COLUMNS, fmt, "batches")
+
     @app.post("/add_batch", status_code=HTTPStatus.CREATED)
-    async def add_batch(batch: Batch) -> dict[str, str]:
+    async def add_batch(
+        batch: Batch,
+        idempotency_key: Optional[str] = Header(None, max_length=255),
+    ) -> dict[str, str]:
         try:
             uow = unit_of_work.SqlAlchemyUnitOfWork()
             await services.add_batch(
                 **batch.model_dump(include={"reference", "sku", "purchased_quantity", "eta"}),
                 uow=uow,
+                idempotency_key=idempotency_key,
             )
         except services.OutOfStockInBatch as e:
             raise HTTPException(HTTPStatus.BAD_REQUEST, detail=str(e))
+        except exceptions.DuplicateBatch as e:
+            raise HTTPException(HTTPStatus.CONFLICT, detail=str(e))
+        except idempotency.IdempotencyKeyReused as e:
+            raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, detail=str(e))
 
         return {"status": "Ok"}
 
+    @app.post("/add_batches", status_code=HTTPStatus.CREATED)
+    async def add_batches(request: Request) -> dict[str, Any]:
+        batches = await read_batches(request)
+        try:
+            uow = unit_of_work.SqlAlchemyUnitOfWork()
+            added = await services.add_batches(batches, uow=uow)
+        except exceptions.DuplicateBatch as e:
+            raise HTTPException(HTTPStatus.CONFLICT, detail=str(e))
+
+        return {"status": "Ok", "added": added}
+
     return app
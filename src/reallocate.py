@@ -0,0 +1,135 @@
+"""
+Reallocation or deallocation sweep over every product, in parallel.
+
+Products are independent aggregates, so the skus are split into chunks and
+each chunk is swept by one worker process with its own engine and units of
+work. Run from `src`:
+
+    python reallocate.py reallocate --workers 8
+    python reallocate.py deallocate --sku LAMP --sku SOFA
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+
+from dbschema import orm
+from service_layer import services, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _start_worker() -> None:
+    # one loop per worker process for all of its chunks, so the engine and
+    # its pool live as long as the process instead of one chunk
+    global _loop
+
+    orm.start_mappers()
+    _loop = asyncio.new_event_loop()
+
+
+async def _sweep(sweep: str, skus: List[str]) -> Dict[str, Any]:
+    result = {"pid": os.getpid(), "skus": 0, "lines": 0, "unallocated": 0, "conflicts": 0, "failed": []}
+    conflicts = services.allocate_conflicts.value
+
+    for sku in skus:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+        try:
+            if sweep == "reallocate":
+                allocated, unallocated = await services.reallocate(sku, uow)
+                result["lines"] += allocated + unallocated
+                result["unallocated"] += unallocated
+            else:
+                result["lines"] += await services.deallocate_all(sku, uow)
+        except (services.InvalidSku, unit_of_work.ConcurrencyConflict) as e:
+            result["failed"].append(sku)
+            logger.warning("%s of %s failed: %s", sweep, sku, e)
+        except Exception:
+            # anything else only costs this sku, not the rest of the chunk
+            result["failed"].append(sku)
+            logger.exception("%s of %s failed", sweep, sku)
+        result["skus"] += 1
+
+    result["conflicts"] = services.allocate_conflicts.value - conflicts
+    return result
+
+
+def sweep_chunk(sweep: str, skus: List[str]) -> Dict[str, Any]:
+    """Worker entry point: sweep one chunk of skus and report what was done."""
+    start = time.perf_counter()
+    result = _loop.run_until_complete(_sweep(sweep, skus))
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+async def list_skus() -> List[str]:
+    try:
+        async with unit_of_work.get_session_factory()() as session:
+            result = await session.execute(select(orm.products.c.sku).order_by(orm.products.c.sku))
+            return list(result.scalars())
+    finally:
+        # the workers must not inherit the connections of this process
+        await unit_of_work.dispose_engine()
+
+
+def run(sweep: str, skus: List[str], workers: int, chunk_size: int) -> Dict[str, Any]:
+    chunks = [skus[i : i + chunk_size] for i in range(0, len(skus), chunk_size)]
+    per_worker: Dict[int, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    totals = defaultdict(int)
+    failed: List[str] = []
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker) as executor:
+        futures = [executor.submit(sweep_chunk, sweep, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            result = future.result()
+            for key in ("skus", "lines", "unallocated", "conflicts", "seconds"):
+                per_worker[result["pid"]][key] += result[key]
+                totals[key] += result[key]
+            failed.extend(result["failed"])
+            elapsed = time.perf_counter() - start
+            print(
+                f"{totals['skus']}/{len(skus)} skus  {totals['lines']} lines"
+                f"  {totals['lines'] / elapsed:,.0f} lines/s  {totals['conflicts']} conflicts"
+            )
+
+    elapsed = time.perf_counter() - start
+    for pid, stats in sorted(per_worker.items()):
+        print(
+            f"worker {pid}: {stats['skus']:.0f} skus  {stats['lines']:.0f} lines"
+            f"  {stats['lines'] / stats['seconds']:,.0f} lines/s  {stats['conflicts']:.0f} conflicts"
+        )
+    print(
+        f"{sweep} of {len(skus)} skus took {elapsed:.1f} s"
+        f", {totals['lines']:,} lines, {totals['unallocated']} unallocated"
+    )
+    if failed:
+        print(f"failed skus: {' '.join(sorted(failed))}")
+
+    return {**totals, "seconds": elapsed, "failed": failed}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sweep", choices=("reallocate", "deallocate"))
+    parser.add_argument("--sku", dest="skus", action="append", help="only these skus (repeatable), default all")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=50, help="skus handed to a worker at a time")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    skus = args.skus or asyncio.run(list_skus())
+    run(args.sweep, skus, args.workers, args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
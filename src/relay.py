@@ -0,0 +1,25 @@
+import asyncio
+
+import config
+from dbschema import orm
+from service_layer import idempotency, messagebus, outbox, unit_of_work
+
+
+async def run_relay():
+    orm.start_mappers()
+    try:
+        await asyncio.gather(
+            outbox.run_relay(
+                unit_of_work.get_session_factory(),
+                unit_of_work.SqlAlchemyUnitOfWork,
+                **config.get_outbox_options(),
+            ),
+            idempotency.run_purge(unit_of_work.get_session_factory(), **config.get_idempotency_key_options()),
+        )
+    finally:
+        await messagebus.stop()
+        await unit_of_work.dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_relay())
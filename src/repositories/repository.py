@@ -1,13 +1,26 @@
 from abc import ABC, abstractmethod
-from typing import Set
+from collections import Counter
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Set, Tuple
 
-from sqlalchemy import select
+from asyncpg.exceptions import UniqueViolationError
+from sqlalchemy import delete, func, insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
-from domain import model
+from dbschema import orm
+from domain import exceptions, model
 from domain.model import Product
 
+# times the enclosed load under the given name, the unit of work hands in instrumentation.span
+Span = Callable[[str], ContextManager[None]]
+
+BATCH_COLUMNS = ("reference", "sku", "purchased_quantity", "eta")
+# lines per allocated_batchrefs query, 3 bound parameters each
+ALLOCATED_LOOKUP_CHUNK = 1000
+
 
 class AbstractRepository(ABC):
     """Abstract base class for batch repositories.
@@ -21,21 +34,72 @@ class AbstractRepository(ABC):
             Adds a Batch instance to the repository.
         get(reference: str) -> Batch:
             Retrieves a Batch by its unique reference.
+        get_for_allocation(sku: str) -> Product:
+            Retrieves a Product ready to allocate to, without its allocation history.
+        get_by_batchref(batchref: str) -> Product:
+            Retrieves the Product one of whose batches has this reference.
+        add_batch(product: Product, batch: Batch):
+            Adds a new batch to the Product, unless its reference is taken.
+        allocated_batchrefs(lines: List[OrderLine]) -> Dict[OrderLine, str]:
+            Finds the batches of those lines that are already allocated.
+        add_batches(batches: List[Dict[str, Any]]):
+            Stores many new batches at once, creating missing products.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, span: Optional[Span] = None) -> None:
         self.seen: Set[Product] = set()
+        self._span = span or (lambda name: nullcontext())
 
     async def add(self, product: Product) -> None:
         await self._add(product)
         self.seen.add(product)
 
     async def get(self, sku: str) -> Product:
-        product = await self._get(sku)
+        with self._span("repository.get"):
+            product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_for_allocation(self, sku: str) -> Product:
+        with self._span("repository.get_for_allocation"):
+            product = await self._get_for_allocation(sku)
         if product:
             self.seen.add(product)
         return product
 
+    async def get_by_batchref(self, batchref: str) -> Product:
+        with self._span("repository.get_by_batchref"):
+            product = await self._get_by_batchref(batchref)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def add_batch(self, product: Product, batch: model.Batch) -> None:
+        """
+        Raises:
+            DuplicateBatch: If a batch with the same reference exists already.
+        """
+        await self._add_batch(product, batch)
+
+    async def add_batches(self, batches: List[Dict[str, Any]]) -> None:
+        """
+        Raises:
+            DuplicateBatch: If any of the references is taken or repeated, nothing is added then.
+        """
+        await self._add_batches(batches)
+
+    async def allocated_batchrefs(self, lines: List[model.OrderLine]) -> Dict[model.OrderLine, str]:
+        """
+        Reference of the batch each of the lines is already allocated to, for
+        the lines that are. A product from `get_for_allocation` has no
+        allocations loaded, its batches can't tell a retried line apart.
+        """
+        return await self._allocated_batchrefs(lines) if lines else {}
+
+    async def _get_for_allocation(self, sku: str) -> Product:
+        return await self._get(sku)
+
     @abstractmethod
     async def _add(self, product: Product) -> None:
         raise NotImplementedError
@@ -44,10 +108,26 @@ class AbstractRepository(ABC):
     async def _get(self, sku: str) -> Product:
         raise NotImplementedError
 
+    @abstractmethod
+    async def _get_by_batchref(self, batchref: str) -> Product:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _add_batch(self, product: Product, batch: model.Batch) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _add_batches(self, batches: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _allocated_batchrefs(self, lines: List[model.OrderLine]) -> Dict[model.OrderLine, str]:
+        raise NotImplementedError
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session: AsyncSession) -> None:
-        super().__init__()
+    def __init__(self, session: AsyncSession, span: Optional[Span] = None) -> None:
+        super().__init__(span)
         self.session = session
 
     async def _add(self, product: Product) -> None:
@@ -55,17 +135,110 @@ class SqlAlchemyRepository(AbstractRepository):
         await self.session.flush()
 
     async def _get(self, sku: str) -> Product:
+        # populate_existing: batches already in the session from get_for_allocation have no allocations loaded
         result = await self.session.execute(
             select(model.Product)
             .filter_by(sku=sku)
             .options(selectinload(model.Product.batches).selectinload(model.Batch.allocations))
+            .execution_options(populate_existing=True)
         )
         return result.scalar_one_or_none()
 
+    async def _get_for_allocation(self, sku: str) -> Product:
+        # batches come without their allocations, new lines are still written on flush,
+        # the allocated totals are summed up in sql instead of loading every OrderLine
+        result = await self.session.execute(
+            select(model.Product)
+            .filter_by(sku=sku)
+            .options(selectinload(model.Product.batches).noload(model.Batch.allocations))
+        )
+        product = result.scalar_one_or_none()
+        if product is None:
+            return None
+
+        result = await self.session.execute(
+            select(orm.allocations.c.batch_id, func.sum(orm.order_lines.c.qty))
+            .join(orm.order_lines, orm.allocations.c.OrderLine_id == orm.order_lines.c.id)
+            .join(orm.batches, orm.allocations.c.batch_id == orm.batches.c.id)
+            .where(orm.batches.c.sku == sku)
+            .group_by(orm.allocations.c.batch_id)
+        )
+        allocated = dict(result.all())
+        for batch in product.batches:
+            batch._allocated_quantity = allocated.get(batch.id, 0)
+
+        return product
+
+    async def _get_by_batchref(self, batchref: str) -> Product:
+        result = await self.session.execute(
+            select(model.Product)
+            .join(model.Product.batches)
+            .where(orm.batches.c.reference == batchref)
+            .options(selectinload(model.Product.batches).selectinload(model.Batch.allocations))
+            .execution_options(populate_existing=True)
+        )
+        return result.scalar_one_or_none()
+
+    async def _add_batch(self, product: Product, batch: model.Batch) -> None:
+        product.add_batch(batch)
+        # flushed right away, a taken reference fails on ux_batches_reference here instead of on commit
+        try:
+            await self.session.flush()
+        except IntegrityError as e:
+            raise exceptions.DuplicateBatch(f"Batch {batch.reference} already exists") from e
+
+    async def _add_batches(self, batches: List[Dict[str, Any]]) -> None:
+        # set-based inserts, bypassing the orm, the products are not loaded at all
+        connection = await self.session.connection()
+        dialect = connection.dialect.name
+
+        skus = [{"sku": sku} for sku in {b["sku"] for b in batches}]
+        if dialect == "postgresql":
+            upsert = postgresql.insert(orm.products).on_conflict_do_nothing(index_elements=["sku"])
+        else:
+            upsert = sqlite.insert(orm.products).on_conflict_do_nothing(index_elements=["sku"])
+        await connection.execute(upsert, skus)
+
+        if dialect == "postgresql":
+            raw_connection = await connection.get_raw_connection()
+            try:
+                await raw_connection.driver_connection.copy_records_to_table(
+                    orm.batches.name,
+                    records=[tuple(b[column] for column in BATCH_COLUMNS) for b in batches],
+                    columns=BATCH_COLUMNS,
+                )
+            except UniqueViolationError as e:
+                # raised by asyncpg itself, COPY goes around sqlalchemy
+                raise exceptions.DuplicateBatch(f"Batch reference already exists: {e.detail}") from e
+        else:
+            try:
+                await connection.execute(insert(orm.batches), batches)
+            except IntegrityError as e:
+                raise exceptions.DuplicateBatch("Batch reference already exists") from e
+
+    async def _allocated_batchrefs(self, lines: List[model.OrderLine]) -> Dict[model.OrderLine, str]:
+        # only the given lines, found through ix_order_lines_orderid_sku
+        lines_table = orm.order_lines.c
+        allocated = {}
+        for start in range(0, len(lines), ALLOCATED_LOOKUP_CHUNK):
+            chunk = lines[start : start + ALLOCATED_LOOKUP_CHUNK]
+            result = await self.session.execute(
+                select(lines_table.orderid, lines_table.sku, lines_table.qty, orm.batches.c.reference)
+                .join(orm.allocations, orm.allocations.c.OrderLine_id == lines_table.id)
+                .join(orm.batches, orm.allocations.c.batch_id == orm.batches.c.id)
+                .where(
+                    tuple_(lines_table.orderid, lines_table.sku, lines_table.qty).in_(
+                        [(line.orderid, line.sku, line.qty) for line in chunk]
+                    )
+                )
+            )
+            allocated.update({model.OrderLine(orderid, sku, qty): ref for orderid, sku, qty, ref in result})
+        return allocated
+
 
 class FakeRepository(AbstractRepository):
-    def __init__(self, products) -> None:
-        super().__init__()
+    def __init__(self, products, span: Optional[Span] = None) -> None:
+        super().__init__(span)
         self._products = set(products)
 
     async def _add(self, product) -> None:
@@ -73,3 +246,165 @@ class FakeRepository(AbstractRepository):
 
     async def _get(self, sku) -> Product:
         return next((p for p in self._products if p.sku == sku), None)
+
+    async def _get_by_batchref(self, batchref) -> Product:
+        return next((p for p in self._products if any(b.reference == batchref for b in p.batches)), None)
+
+    async def _add_batch(self, product, batch) -> None:
+        if batch.reference in self._references():
+            raise exceptions.DuplicateBatch(f"Batch {batch.reference} already exists")
+        product.add_batch(batch)
+
+    async def _add_batches(self, batches) -> None:
+        counts = Counter(b["reference"] for b in batches)
+        duplicates = self._references().intersection(counts) | {ref for ref, count in counts.items() if count > 1}
+        if duplicates:
+            raise exceptions.DuplicateBatch(f"Batch reference already exists: {', '.join(sorted(duplicates))}")
+        for b in batches:
+            product = await self._get(b["sku"])
+            if product is None:
+                product = Product(b["sku"], batches=[])
+                self._products.add(product)
+            product.add_batch(model.Batch(*(b[column] for column in BATCH_COLUMNS)))
+
+    def _references(self) -> Set[str]:
+        return {batch.reference for product in self._products for batch in product.batches}
+
+    async def _allocated_batchrefs(self, lines) -> Dict[model.OrderLine, str]:
+        wanted = set(lines)
+        return {
+            line: batch.reference
+            for product in self._products
+            for batch in product.batches
+            for line in batch.allocations
+            if line in wanted
+        }
+
+
+class AbstractAllocationsView(ABC):
+    """
+    Flat (orderid, sku, qty, batchref) read model of the current allocations,
+    one row per order line: like OrderLine, the qty is part of its identity.
+    """
+
+    @abstractmethod
+    async def add(self, orderid: str, sku: str, qty: int, batchref: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove(self, orderid: str, sku: str, qty: int, batchref: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def for_order(self, orderid: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+
+class SqlAlchemyAllocationsView(AbstractAllocationsView):
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def add(self, orderid: str, sku: str, qty: int, batchref: str) -> None:
+        # events are delivered at least once, adding the same line twice keeps one row
+        await self.remove(orderid, sku, qty, batchref)
+        await self.session.execute(
+            insert(orm.allocations_view).values(orderid=orderid, sku=sku, qty=qty, batchref=batchref)
+        )
+
+    async def remove(self, orderid: str, sku: str, qty: int, batchref: str) -> None:
+        view = orm.allocations_view.c
+        await self.session.execute(
+            delete(orm.allocations_view).where(
+                view.orderid == orderid, view.sku == sku, view.qty == qty, view.batchref == batchref
+            )
+        )
+
+    async def for_order(self, orderid: str) -> List[Dict[str, str]]:
+        view = orm.allocations_view.c
+        result = await self.session.execute(
+            select(view.sku, view.batchref).where(view.orderid == orderid).order_by(view.id)
+        )
+        return [{"sku": sku, "batchref": batchref} for sku, batchref in result]
+
+
+class FakeAllocationsView(AbstractAllocationsView):
+    def __init__(self) -> None:
+        self._rows: List[tuple] = []
+
+    async def add(self, orderid, sku, qty, batchref) -> None:
+        if (orderid, sku, qty, batchref) not in self._rows:
+            self._rows.append((orderid, sku, qty, batchref))
+
+    async def remove(self, orderid, sku, qty, batchref) -> None:
+        if (orderid, sku, qty, batchref) in self._rows:
+            self._rows.remove((orderid, sku, qty, batchref))
+
+    async def for_order(self, orderid) -> List[Dict[str, str]]:
+        return [{"sku": sku, "batchref": batchref} for o, sku, _, batchref in self._rows if o == orderid]
+
+
+class DuplicateIdempotencyKey(Exception):
+    """Raised when a concurrent request with the same idempotency key recorded its result first"""
+
+    pass
+
+
+class AbstractIdempotencyKeys(ABC):
+    """Results recorded under (scope, idempotency key), see service_layer.idempotency."""
+
+    def __init__(self) -> None:
+        self.added: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    async def get(self, scope: str, key: str) -> Optional[Dict[str, Any]]:
+        return await self._get(scope, key)
+
+    async def add(self, scope: str, key: str, request_hash: str, result: Dict[str, Any]) -> None:
+        await self._add(scope, key, request_hash, result)
+        self.added[(scope, key)] = {"request_hash": request_hash, "result": result}
+
+    @abstractmethod
+    async def _get(self, scope: str, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _add(self, scope: str, key: str, request_hash: str, result: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class SqlAlchemyIdempotencyKeys(AbstractIdempotencyKeys):
+    def __init__(self, session: AsyncSession) -> None:
+        super().__init__()
+        self.session = session
+
+    async def _get(self, scope: str, key: str) -> Optional[Dict[str, Any]]:
+        keys = orm.idempotency_keys.c
+        row = (
+            await self.session.execute(
+                select(keys.request_hash, keys.result).where(keys.scope == scope, keys.key == key)
+            )
+        ).first()
+        return None if row is None else {"request_hash": row.request_hash, "result": row.result}
+
+    async def _add(self, scope: str, key: str, request_hash: str, result: Dict[str, Any]) -> None:
+        # sent right away rather than on commit: a concurrent request with the same key
+        # waits here for the other transaction and fails once that one has committed
+        try:
+            await self.session.execute(
+                insert(orm.idempotency_keys).values(scope=scope, key=key, request_hash=request_hash, result=result)
+            )
+        except IntegrityError as e:
+            raise DuplicateIdempotencyKey(f"Idempotency key {key} was recorded concurrently") from e
+
+
+class FakeIdempotencyKeys(AbstractIdempotencyKeys):
+    def __init__(self) -> None:
+        super().__init__()
+        self._records: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    async def _get(self, scope, key) -> Optional[Dict[str, Any]]:
+        return self._records.get((scope, key))
+
+    async def _add(self, scope, key, request_hash, result) -> None:
+        if (scope, key) in self._records:
+            raise DuplicateIdempotencyKey(f"Idempotency key {key} was recorded concurrently")
+        self._records[(scope, key)] = {"request_hash": request_hash, "result": result}
@@ -1,23 +1,74 @@
+import asyncio
+import copy
+import importlib.util
 import os
 
-from uvicorn.config import Config
+import uvicorn
+from uvicorn.config import LOGGING_CONFIG, Config
 from uvicorn.server import Server
 
-from entrypoints.fastapi_app import make_app
+import config
+from dbschema import migrations
 
-HOST = os.environ.get("API_HOST", "localhost")
-PORT = 10300 if HOST == "localhost" else 10400
-
-app = make_app()
+SERVER = config.get_server_options()
+HOST = SERVER["host"]
+PORT = SERVER["port"]
+# a factory, so the app (fastapi, the routes, the openapi models) is only
+# imported and built by the processes that serve it, not by the supervisor
+APP_FACTORY = "entrypoints.fastapi_app:make_app"
 
 
 async def run_server():
-    config = Config("run:app", host=HOST, port=PORT, log_level="info", access_log=True, use_colors=True)
-    server = Server(config)
+    server_config = Config(
+        APP_FACTORY, factory=True, host=HOST, port=PORT, log_level="info", access_log=True, use_colors=True
+    )
+    server = Server(server_config)
     await server.serve()
 
 
-if __name__ == "__main__":
-    import asyncio
+def production_log_config(sample_rate: float) -> dict:
+    log_config = copy.deepcopy(LOGGING_CONFIG)
+    for formatter in log_config["formatters"].values():
+        formatter["use_colors"] = False
+    log_config["filters"] = {"sampled": {"()": "entrypoints.access_log.SampledAccessLog", "rate": sample_rate}}
+    log_config["handlers"]["access"]["filters"] = ["sampled"]
+    return log_config
+
+
+def run_production_server() -> None:
+    """
+    Supervisor with one uvicorn worker process per core.
+
+    The schema is upgraded once, here, instead of by every worker racing at
+    startup. Every worker builds the app from `APP_FACTORY` on its own and
+    creates its engine in the lifespan, nothing opened here is shared with them.
+    On SIGTERM the workers stop accepting, finish the requests in flight
+    within `graceful_shutdown_timeout`, then drain and close in the lifespan.
+    """
 
-    asyncio.run(run_server())
+    asyncio.run(migrations.main())
+    os.environ["MIGRATE_ON_STARTUP"] = "false"  # inherited by the workers
+
+    sample_rate = SERVER["access_log_sample_rate"]
+    uvicorn.run(
+        APP_FACTORY,
+        factory=True,
+        host=HOST,
+        port=PORT,
+        workers=SERVER["workers"],
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11",
+        access_log=sample_rate > 0,
+        log_config=production_log_config(sample_rate),
+        use_colors=False,
+        server_header=False,
+        proxy_headers=True,
+        timeout_graceful_shutdown=SERVER["graceful_shutdown_timeout"],
+    )
+
+
+if __name__ == "__main__":
+    if SERVER["production"]:
+        run_production_server()
+    else:
+        asyncio.run(run_server())
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import config
+from service_layer import metrics
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire `ttl` seconds after they were stored.
+    Hits, misses and evictions are counted in `service_layer.metrics` under `name`.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = metrics.counter(f"{name}_cache_hits_total", f"Lookups answered by the {name} cache")
+        self.misses = metrics.counter(f"{name}_cache_misses_total", f"Lookups the {name} cache could not answer")
+        self.evictions = metrics.counter(f"{name}_cache_evictions_total", f"Entries evicted from the {name} cache")
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < self.clock():
+            self._entries.pop(key, None)
+            self.misses.inc()
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits.inc()
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions.inc()
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# available quantity per batch of a sku, see views.availability
+availability = TTLCache("availability", **config.get_availability_cache_options())
+
+# results recorded under an idempotency key, see service_layer.idempotency
+idempotency_keys = TTLCache("idempotency_keys", **config.get_idempotency_cache_options())
@@ -0,0 +1,87 @@
+import asyncio
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from domain import exceptions
+from service_layer import services, unit_of_work
+
+PendingLine = Tuple[dict, asyncio.Future]
+
+
+class AllocationCoalescer:
+    """
+    Single-flight allocation per sku.
+
+    The first allocation for a sku opens a group that collects every other
+    allocation for the same sku arriving within `window` seconds, or until
+    `max_group_size` lines are waiting. The whole group is then allocated in
+    arrival order by one `services.allocate_many` call, loading the product
+    and committing once, and every caller gets its own line's result.
+
+    A caller that gives up waiting doesn't take its line out of the group.
+    Allocations with an idempotency key are not grouped, their key is recorded
+    in the transaction of their own `services.allocate`.
+    """
+
+    def __init__(
+        self,
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+        window: float,
+        max_group_size: int,
+    ) -> None:
+        self.uow_factory = uow_factory
+        self.window = window
+        self.max_group_size = max_group_size
+        self._groups: Dict[str, List[PendingLine]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._in_flight: Set[asyncio.Task] = set()
+
+    async def allocate(self, orderid: str, sku: str, qty: int, idempotency_key: Optional[str] = None) -> str:
+        """Same contract as `services.allocate`."""
+        if self.window <= 0 or idempotency_key is not None:
+            return await services.allocate(orderid, sku, qty, uow=self.uow_factory(), idempotency_key=idempotency_key)
+
+        future = asyncio.get_running_loop().create_future()
+        group = self._groups.setdefault(sku, [])
+        group.append(({"orderid": orderid, "sku": sku, "qty": qty}, future))
+
+        if len(group) >= self.max_group_size:
+            self._flush(sku)
+        elif len(group) == 1:
+            self._timers[sku] = asyncio.get_running_loop().call_later(self.window, self._flush, sku)
+
+        return await future
+
+    async def drain(self) -> None:
+        """Allocate every waiting group right away and wait until all of them are done."""
+        for sku in list(self._groups):
+            self._flush(sku)
+        while self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    def _flush(self, sku: str) -> None:
+        timer = self._timers.pop(sku, None)
+        if timer is not None:
+            timer.cancel()
+
+        task = asyncio.ensure_future(self._allocate_group(sku, self._groups.pop(sku)))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _allocate_group(self, sku: str, group: List[PendingLine]) -> None:
+        try:
+            results = await services.allocate_many([line for line, _ in group], uow=self.uow_factory())
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(group, results):
+            if future.done():
+                continue
+            if result.error_type is services.InvalidSku:
+                future.set_exception(services.InvalidSku(result.error))
+            elif result.error_type is exceptions.OutOfStock:
+                future.set_exception(exceptions.OutOfStock(result.error))
+            else:
+                future.set_result(result.batchref)
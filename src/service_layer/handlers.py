@@ -0,0 +1,18 @@
+from adapters import email
+from domain import events
+
+
+async def send_out_of_stock_notification(event: events.OutOfStock, uow) -> None:
+    await email.send_mail("stock@made.com", f"Out of stock for {event.sku}")
+
+
+async def add_allocation_to_read_model(event: events.Allocated, uow) -> None:
+    async with uow:
+        await uow.allocations_view.add(event.orderid, event.sku, event.qty, event.batchref)
+        await uow.commit()
+
+
+async def remove_allocation_from_read_model(event: events.Deallocated, uow) -> None:
+    async with uow:
+        await uow.allocations_view.remove(event.orderid, event.sku, event.qty, event.batchref)
+        await uow.commit()
@@ -0,0 +1,109 @@
+"""
+Idempotency keys: a client that retries a request with the same
+`Idempotency-Key` gets the result of the first one instead of having the
+change made twice.
+
+The result is written by the unit of work that made the change, in the same
+transaction, so it exists exactly when the change does, for every worker.
+After the commit each process keeps it in `cache.idempotency_keys`, a retry
+answered from there sends no SQL at all and neither kind loads the Product.
+Recorded results are deleted once older than the retention window, which is
+never shorter than the cache TTL.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from dbschema import orm
+from service_layer import cache
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyKeyReused(Exception):
+    """Raised when an idempotency key comes back with a different request"""
+
+    pass
+
+
+def request_hash(params: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+async def replay(scope: str, key: str, params: Dict[str, Any], uow) -> Optional[Dict[str, Any]]:
+    """
+    The result recorded for an earlier request with this key, from the
+    cache or else the database. Called inside the unit of work.
+
+    Returns:
+        The recorded result, None when no request used the key yet.
+
+    Raises:
+        IdempotencyKeyReused: If the key was recorded for different `params`.
+    """
+
+    record = cache.idempotency_keys.get((scope, key))
+    if record is None:
+        record = await uow.idempotency_keys.get(scope, key)
+        if record is None:
+            return None
+        cache.idempotency_keys.put((scope, key), record)
+
+    if record["request_hash"] != request_hash(params):
+        raise IdempotencyKeyReused(f"Idempotency key {key} was already used for a different request")
+    return record["result"]
+
+
+async def record(scope: str, key: str, params: Dict[str, Any], result: Dict[str, Any], uow) -> None:
+    """
+    Record the result in the unit of work, to be committed with the change.
+
+    Raises:
+        DuplicateIdempotencyKey: If a concurrent request with the same key got there first.
+    """
+    await uow.idempotency_keys.add(scope, key, request_hash(params), result)
+
+
+async def purge(session_factory: async_sessionmaker, retention: float) -> int:
+    """
+    Delete the results recorded more than `retention` seconds ago, by the
+    database clock that stamped them.
+
+    Returns:
+        int: Number of keys deleted.
+    """
+
+    async with session_factory() as session, session.begin():
+        now = await session.scalar(select(func.now()))
+        result = await session.execute(
+            delete(orm.idempotency_keys).where(orm.idempotency_keys.c.created_at < now - timedelta(seconds=retention))
+        )
+    return result.rowcount
+
+
+async def run_purge(
+    session_factory: async_sessionmaker,
+    retention: float,
+    purge_interval: float,
+    stop: Optional[asyncio.Event] = None,
+) -> None:
+    """Purge expired keys every `purge_interval` seconds until `stop` is set."""
+    stop = stop or asyncio.Event()
+    while not stop.is_set():
+        try:
+            purged = await purge(session_factory, retention)
+            if purged:
+                logger.info("purged %d expired idempotency keys", purged)
+        except Exception:
+            logger.exception("idempotency key purge failed")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=purge_interval)
+        except asyncio.TimeoutError:
+            pass
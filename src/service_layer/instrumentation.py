@@ -0,0 +1,112 @@
+"""
+Timing spans around the stages of a request (repository loads, domain
+calls, commit, event publishing) and the number of SQL statements each
+unit of work sends.
+
+Every finished span goes to the registered sinks, `metrics_sink` turns them
+into the `span_duration_seconds` histogram of `/metrics`. Nothing is
+measured until `configure(True)`, a disabled `span` is a shared no-op.
+"""
+
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Callable, ContextManager, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from service_layer import metrics
+
+Sink = Callable[[str, float], None]
+
+span_duration = metrics.histogram(
+    "span_duration_seconds", "Time spent in each instrumented stage of a request", label="span"
+)
+uow_statements = metrics.histogram(
+    "uow_sql_statements", "SQL statements sent per unit of work", buckets=(1, 2, 5, 10, 20, 50, 100, 500, 1000)
+)
+sql_statements = metrics.counter("sql_statements_total", "SQL statements sent to the database")
+
+SINKS: List[Sink] = []
+
+_NOOP = nullcontext()
+_enabled = False
+
+
+class _UnitOfWorkStats:
+    __slots__ = ("parent", "start", "statements")
+
+    def __init__(self, parent: Optional["_UnitOfWorkStats"]) -> None:
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.statements = 0
+
+
+_current: ContextVar[Optional[_UnitOfWorkStats]] = ContextVar("unit_of_work_stats", default=None)
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args) -> None:
+        _finish(self.name, time.perf_counter() - self.start)
+
+
+def _finish(name: str, seconds: float) -> None:
+    for sink in SINKS:
+        sink(name, seconds)
+
+
+def metrics_sink(name: str, seconds: float) -> None:
+    span_duration.observe(seconds, name)
+
+
+def _count_statement(*args) -> None:
+    sql_statements.inc()
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+
+
+def configure(enabled: bool, sinks: Optional[List[Sink]] = None) -> None:
+    """Turn instrumentation on, with `metrics_sink` unless other sinks are given, or off."""
+    global _enabled
+
+    if _enabled:
+        event.remove(Engine, "before_cursor_execute", _count_statement)
+    SINKS.clear()
+    _enabled = enabled
+    if enabled:
+        SINKS.extend([metrics_sink] if sinks is None else sinks)
+        # every engine, whichever process or test created it
+        event.listen(Engine, "before_cursor_execute", _count_statement)
+
+
+def span(name: str) -> ContextManager[None]:
+    """Time the enclosed block, sync or async, as `name`."""
+    if not _enabled:
+        return _NOOP
+    return _Span(name)
+
+
+def enter_unit_of_work() -> None:
+    if _enabled:
+        _current.set(_UnitOfWorkStats(_current.get()))
+
+
+def exit_unit_of_work() -> None:
+    # units of work nest (handlers run inside the commit of another one),
+    # each one only counts the statements sent while it is the innermost
+    stats = _current.get()
+    if not _enabled or stats is None:
+        return
+    _current.set(stats.parent)
+    uow_statements.observe(stats.statements)
+    _finish("uow", time.perf_counter() - stats.start)
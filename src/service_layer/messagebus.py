@@ -1,15 +1,92 @@
+import asyncio
+import inspect
+import logging
+from typing import Any, Callable, List, Optional
+
+import config
 from domain import events
+from service_layer import handlers
+
+logger = logging.getLogger(__name__)
 
 
-def handle(event: events.Event):
-    for handler in HANDLERS[type(event)]:
-        handler(event)
+HANDLERS = {
+    events.OutOfStock: [handlers.send_out_of_stock_notification],
+    events.Allocated: [handlers.add_allocation_to_read_model],
+    events.Deallocated: [handlers.remove_allocation_from_read_model],
+}
 
 
-def send_out_of_stock_notification(event: events.OutOfStock):
-    email.send_mail("stock@made.com", f"Out of stock for {event.sku}")
+async def dispatch(event: events.Event, uow_factory: Callable[[], Any]) -> None:
+    """Run every handler of the event right away, sync or async, each with a fresh unit of work from `uow_factory`."""
+    for handler in HANDLERS.get(type(event), []):
+        result = handler(event, uow_factory())
+        if inspect.isawaitable(result):
+            await result
 
 
-HANDLERS = {
-    events.OutOfStock: [send_out_of_stock_notification],
-}
+class _Workers:
+    """Bounded event queue of the running loop and the tasks consuming it."""
+
+    def __init__(self, queue_size: int, concurrency: int) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.tasks: List[asyncio.Task] = [asyncio.create_task(self._work()) for _ in range(concurrency)]
+
+    async def _work(self) -> None:
+        while True:
+            event, uow_factory, handled = await self.queue.get()
+            try:
+                await dispatch(event, uow_factory)
+            except Exception:
+                logger.exception("handling %r failed", event)
+                succeeded = False
+            else:
+                succeeded = True
+            finally:
+                self.queue.task_done()
+            if not handled.done():
+                handled.set_result(succeeded)
+
+
+_workers: Optional[_Workers] = None
+
+
+def _get_workers() -> _Workers:
+    global _workers
+
+    if _workers is None or _workers.loop is not asyncio.get_running_loop():
+        _workers = _Workers(**config.get_messagebus_options())
+    return _workers
+
+
+async def handle(event: events.Event, uow_factory: Callable[[], Any]) -> "asyncio.Future[bool]":
+    """
+    Hand the event over to the background workers. Only waits when
+    the queue is full, handlers run after this returns.
+
+    Returns:
+        asyncio.Future[bool]: Resolves once the handlers ran, False when one failed.
+    """
+    workers = _get_workers()
+    handled = workers.loop.create_future()
+    await workers.queue.put((event, uow_factory, handled))
+    return handled
+
+
+async def drain() -> None:
+    """Wait until every queued event has been handled."""
+    if _workers is not None and _workers.loop is asyncio.get_running_loop():
+        await _workers.queue.join()
+
+
+async def stop() -> None:
+    """Drain the queue and stop the workers, used on shutdown."""
+    global _workers
+
+    await drain()
+    if _workers is not None:
+        for task in _workers.tasks:
+            task.cancel()
+        await asyncio.gather(*_workers.tasks, return_exceptions=True)
+    _workers = None
@@ -0,0 +1,82 @@
+"""
+Process-local metrics, rendered in the Prometheus text format by `/metrics`.
+"""
+
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def render(self) -> str:
+        return f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} counter\n{self.name} {self.value}\n"
+
+
+class Histogram:
+    """Prometheus histogram, optionally split by the values of a single label."""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], label: Optional[str] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label = label
+        # per label value: observations per bucket (the last one is +Inf), sum
+        self.series: Dict[Optional[str], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, label_value: Optional[str] = None) -> None:
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def count(self, label_value: Optional[str] = None) -> int:
+        series = self.series.get(label_value)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total) in self.series.items():
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            selector = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{selector} {total[0]}")
+            lines.append(f"{self.name}_count{selector} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+COUNTERS: Dict[str, Counter] = {}
+HISTOGRAMS: Dict[str, Histogram] = {}
+
+
+def counter(name: str, documentation: str) -> Counter:
+    """Get the counter registered under `name`, creating it on first use."""
+    if name not in COUNTERS:
+        COUNTERS[name] = Counter(name, documentation)
+    return COUNTERS[name]
+
+
+def histogram(
+    name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS, label: Optional[str] = None
+) -> Histogram:
+    """Get the histogram registered under `name`, creating it on first use."""
+    if name not in HISTOGRAMS:
+        HISTOGRAMS[name] = Histogram(name, documentation, buckets, label)
+    return HISTOGRAMS[name]
+
+
+def render() -> str:
+    return "".join(m.render() for m in (*COUNTERS.values(), *HISTOGRAMS.values()))
@@ -0,0 +1,166 @@
+"""
+Transactional outbox: `SqlAlchemyUnitOfWork` stores the new domain events
+in the `outbox` table as part of the commit, the relay below reads the
+unsent ones in batches, hands them to the bounded message bus workers and
+marks them sent once handled. Delivery is at-least-once, handlers may see
+an event twice. No transaction stays open while the handlers run.
+
+Only one relay dispatches at a time and it hands over the next event of a
+product only once the previous one was handled, so the events of an
+aggregate reach the handlers in the order they were committed: a `Deallocated` relayed
+ahead of its `Allocated` would leave a stale row in `allocations_view`.
+Every api process may run a relay, the ones that find another relay busy
+simply skip the round.
+
+A failing event only holds back the later events of its own product, those
+of every other product are relayed meanwhile. Its attempts are counted on the
+row, after `max_attempts` failures it is dead-lettered: `dead_lettered_at`
+is set and the relay leaves it alone. Clearing that column requeues it.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from dataclasses import asdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, text, update
+from sqlalchemy.ext.asyncio import AsyncConnection, async_sessionmaker
+
+from dbschema import orm
+from domain import events
+from service_layer import messagebus
+
+logger = logging.getLogger(__name__)
+
+
+EVENT_TYPES = {cls.__name__: cls for cls in events.Event.__subclasses__()}
+
+# key of the Postgres advisory lock held by the relay that is dispatching
+RELAY_LOCK_KEY = 0x6F7574626F78
+_relay_lock = asyncio.Lock()
+
+
+def to_row(event: events.Event) -> Dict[str, Any]:
+    return {"event_type": type(event).__name__, "payload": asdict(event)}
+
+
+def from_row(event_type: str, payload: Dict[str, Any]) -> events.Event:
+    return EVENT_TYPES[event_type](**payload)
+
+
+async def relay_once(
+    session_factory: async_sessionmaker, uow_factory: Callable[[], Any], batch_size: int, max_attempts: int = 5
+) -> int:
+    """
+    Dispatch up to `batch_size` unsent events, oldest first, through the
+    message bus workers, every handler with a fresh unit of work from
+    `uow_factory`.
+
+    Returns right away when another relay, in this process or (on Postgres)
+    any other, is dispatching. A failing event is left unsent together with
+    the later events of the same product, and dead-lettered once it failed
+    `max_attempts` times.
+
+    Returns:
+        int: Number of events dispatched, 0 when another relay is busy.
+    """
+
+    if _relay_lock.locked():
+        return 0
+    async with _relay_lock:
+        return await _relay_batch(session_factory, uow_factory, batch_size, max_attempts)
+
+
+async def _relay_batch(
+    session_factory: async_sessionmaker, uow_factory: Callable[[], Any], batch_size: int, max_attempts: int
+) -> int:
+    async with session_factory.kw["bind"].connect() as connection:
+        postgres = connection.dialect.name == "postgresql"
+        if postgres:
+            # held by the connection rather than a transaction, none stays open while the handlers run
+            locked = await connection.scalar(text("SELECT pg_try_advisory_lock(:key)"), dict(key=RELAY_LOCK_KEY))
+            await connection.commit()
+            if not locked:
+                return 0
+        try:
+            return await _relay_rows(connection, uow_factory, batch_size, max_attempts)
+        finally:
+            if postgres:
+                await connection.rollback()
+                await connection.execute(text("SELECT pg_advisory_unlock(:key)"), dict(key=RELAY_LOCK_KEY))
+                await connection.commit()
+
+
+async def _relay_rows(
+    connection: AsyncConnection, uow_factory: Callable[[], Any], batch_size: int, max_attempts: int
+) -> int:
+    columns = orm.outbox.c
+    result = await connection.execute(
+        select(columns.id, columns.event_type, columns.payload, columns.attempts)
+        .where(columns.sent_at.is_(None), columns.dead_lettered_at.is_(None))
+        .order_by(columns.id)
+        .limit(batch_size)
+    )
+    by_product: Dict[str, List[Tuple[int, events.Event, int]]] = defaultdict(list)
+    for row_id, event_type, payload, attempts in result.all():
+        event = from_row(event_type, payload)
+        by_product[event.sku].append((row_id, event, attempts))
+    await connection.commit()
+
+    # products go through the workers side by side, the events of one product one after the other
+    relayed = await asyncio.gather(*(_relay_product(rows, uow_factory) for rows in by_product.values()))
+
+    sent = [row_id for product_sent, _ in relayed for row_id in product_sent]
+    if sent:
+        await connection.execute(update(orm.outbox).where(columns.id.in_(sent)).values(sent_at=func.now()))
+    for _, failed in relayed:
+        if failed is not None:
+            await _record_failure(connection, *failed, max_attempts)
+    await connection.commit()
+
+    return len(sent)
+
+
+async def _relay_product(
+    rows: List[Tuple[int, events.Event, int]], uow_factory: Callable[[], Any]
+) -> Tuple[List[int], Optional[Tuple[int, int]]]:
+    # stops at the first failure, the later events of the product would overtake it
+    sent = []
+    for row_id, event, attempts in rows:
+        handled = await messagebus.handle(event, uow_factory)
+        if not await handled:
+            return sent, (row_id, attempts + 1)
+        sent.append(row_id)
+    return sent, None
+
+
+async def _record_failure(connection: AsyncConnection, row_id: int, attempts: int, max_attempts: int) -> None:
+    values = {"attempts": attempts}
+    if attempts >= max_attempts:
+        logger.error("outbox event %s failed %d times, dead-lettered", row_id, attempts)
+        values["dead_lettered_at"] = func.now()
+    await connection.execute(update(orm.outbox).where(orm.outbox.c.id == row_id).values(**values))
+
+
+async def run_relay(
+    session_factory: async_sessionmaker,
+    uow_factory: Callable[[], Any],
+    batch_size: int,
+    poll_interval: float,
+    max_attempts: int,
+    stop: Optional[asyncio.Event] = None,
+) -> None:
+    """Relay events until `stop` is set, only sleeping when the outbox is empty."""
+    stop = stop or asyncio.Event()
+    while not stop.is_set():
+        try:
+            relayed = await relay_once(session_factory, uow_factory, batch_size, max_attempts)
+        except Exception:
+            logger.exception("outbox relay failed")
+            relayed = 0
+        if relayed < batch_size:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,122 @@
+"""
+Opt-in SQL profiler (`SQL_PROFILER_ENABLED`): every statement an engine
+sends while a `profile` is open is recorded with its duration and row count.
+
+A finished profile flags slow statements and statements repeated within it
+(the shape of an N+1: the same select once per parent row), and is kept in
+a ring buffer of the latest profiles, read by `/debug/sql-profiles`.
+"""
+
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MAX_STATEMENTS_PER_PROFILE = 1000
+
+
+class Profile:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started_at = time.time()
+        self.statements: List[Dict[str, Any]] = []
+        self.statement_count = 0
+        self.seconds = 0.0
+        self.flags: List[Dict[str, Any]] = []
+        self.finished = False
+
+    def record(self, statement: str, seconds: float, rows: Optional[int]) -> None:
+        self.statement_count += 1
+        if len(self.statements) < MAX_STATEMENTS_PER_PROFILE:
+            self.statements.append({"statement": statement, "ms": seconds * 1000, "rows": rows})
+
+    def analyze(self, slow_query_ms: float, repeat_threshold: int) -> None:
+        for recorded in self.statements:
+            if recorded["ms"] >= slow_query_ms:
+                self.flags.append({"kind": "slow", **recorded})
+
+        selects = Counter(
+            s["statement"] for s in self.statements if s["statement"].lstrip().upper().startswith("SELECT")
+        )
+        for statement, count in selects.items():
+            if count >= repeat_threshold:
+                self.flags.append({"kind": "repeated", "statement": statement, "count": count})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "ms": self.seconds * 1000,
+            "statement_count": self.statement_count,
+            "flags": self.flags,
+            "statements": self.statements,
+        }
+
+
+class SqlProfiler:
+    def __init__(self, buffer_size: int, slow_query_ms: float, repeat_threshold: int) -> None:
+        self.slow_query_ms = slow_query_ms
+        self.repeat_threshold = repeat_threshold
+        self.profiles: Deque[Profile] = deque(maxlen=buffer_size)
+        self._current: ContextVar[Optional[Profile]] = ContextVar("sql_profile", default=None)
+
+    def attach(self, engine: Engine) -> None:
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[Profile]:
+        profile = Profile(name)
+        token = self._current.set(profile)
+        start = time.perf_counter()
+        try:
+            yield profile
+        finally:
+            profile.seconds = time.perf_counter() - start
+            # tasks started during the profile (e.g. event handlers) still see it, it no longer records
+            profile.finished = True
+            self._current.reset(token)
+            profile.analyze(self.slow_query_ms, self.repeat_threshold)
+            self.profiles.append(profile)
+
+    def recent(self, flagged_only: bool = False) -> List[Dict[str, Any]]:
+        """Latest profiles first."""
+        return [p.to_dict() for p in reversed(self.profiles) if p.flags or not flagged_only]
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        if self._current.get() is not None:
+            context._sql_profiler_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        profile = self._current.get()
+        start = getattr(context, "_sql_profiler_start", None)
+        if profile is None or start is None or profile.finished:
+            return
+        profile.record(statement, time.perf_counter() - start, _row_count(cursor))
+
+
+def _row_count(cursor) -> Optional[int]:
+    # drivers report -1 for selects, the async adapters have already buffered the rows by now
+    if cursor.rowcount is not None and cursor.rowcount >= 0:
+        return cursor.rowcount
+    rows = getattr(cursor, "_rows", None)
+    return len(rows) if rows is not None else None
+
+
+_profiler: Optional[SqlProfiler] = None
+
+
+def configure(options: Dict[str, Any]) -> Optional[SqlProfiler]:
+    """Create the process' profiler from `config.get_sql_profiler_options()`, None when it is disabled."""
+    global _profiler
+
+    _profiler = SqlProfiler(**{k: v for k, v in options.items() if k != "enabled"}) if options["enabled"] else None
+    return _profiler
+
+
+def get_profiler() -> Optional[SqlProfiler]:
+    return _profiler
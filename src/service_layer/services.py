@@ -1,10 +1,22 @@
 from __future__ import annotations
 
+import asyncio
+import random
+from dataclasses import dataclass, field
 from datetime import date
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type, TypeVar
 
-from domain import events, model
-from service_layer import messagebus, unit_of_work
+import config
+from domain import events, exceptions, model
+from repositories import repository
+from service_layer import cache, idempotency, instrumentation, messagebus, metrics, unit_of_work
+
+T = TypeVar("T")
+
+allocate_conflicts = metrics.counter(
+    "allocate_conflicts_total", "Allocations that lost an optimistic concurrency race on commit"
+)
+allocate_retries = metrics.counter("allocate_retries_total", "Allocations retried after a concurrency conflict")
 
 
 class InvalidSku(Exception):
@@ -13,54 +25,321 @@ class InvalidSku(Exception):
     pass
 
 
+class UnknownBatch(Exception):
+    """Raised when no batch has the given reference"""
+
+    pass
+
+
+class NotAllocated(Exception):
+    """Raised when deallocating an order line that is not allocated"""
+
+    pass
+
+
 class OutOfStockInBatch(Exception):
     """Raised when encountered error in /add_batch route"""
 
     pass
 
 
+@dataclass
+class AllocationResult:
+    """Outcome of allocating a single order line in allocate_many"""
+
+    orderid: str
+    sku: str
+    qty: int
+    batchref: Optional[str] = None
+    error: Optional[str] = None
+    # exception class behind `error`, for callers that raise it again, left out of to_dict
+    error_type: Optional[Type[Exception]] = field(default=None, repr=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "orderid": self.orderid,
+            "sku": self.sku,
+            "qty": self.qty,
+            "batchref": self.batchref,
+            "error": self.error,
+        }
+
+
 def is_valid_sku(sku: str, batches: List[model.Batch]) -> bool:
     """Check whether a sku is valid"""
     return sku in {b.sku for b in batches}
 
 
-async def allocate(orderid: str, sku: str, qty: int, uow: unit_of_work.AbstractUnitOfWork) -> str:
+async def retry_on_conflict(attempt: Callable[[], Awaitable[T]]) -> T:
     """
-    Create from primitives order line and allocate it to a batch.
+    Run `attempt` again when its commit hits a concurrency conflict,
+    sleeping a random (full jitter) exponential backoff in between.
+
+    Raises:
+        ConcurrencyConflict: If the last allowed attempt conflicts as well.
+    """
+
+    options = config.get_allocate_retry_options()
+    for attempt_number in range(1, options["max_attempts"] + 1):
+        try:
+            return await attempt()
+        except unit_of_work.ConcurrencyConflict:
+            allocate_conflicts.inc()
+            if attempt_number == options["max_attempts"]:
+                raise
+            allocate_retries.inc()
+            await asyncio.sleep(random.uniform(0, min(options["max_delay"], options["base_delay"] * 2**attempt_number)))
+
+
+async def allocate(
+    orderid: str,
+    sku: str,
+    qty: int,
+    uow: unit_of_work.AbstractUnitOfWork,
+    idempotency_key: Optional[str] = None,
+) -> str:
+    """
+    Create from primitives order line and allocate it to a batch. A line
+    that is already allocated stays on its batch.
 
     Args:
         orderid: Unique order id
         sku: Stock-keeping-unit
         qty: Quantity
-        repo: The repository to fetch available batches.
-        session: The database session for committing changes.
+        uow: Unit of work for handling database operations.
+        idempotency_key: When given, a repeated call with the same key returns
+            the first call's batch reference without allocating again.
 
     Raises:
         InvalidSku: If the sku in the order line is not valid.
+        OutOfStock: If no batch can fulfill the order line.
+        ConcurrencyConflict: If the product kept changing under every retry.
+        IdempotencyKeyReused: If the key was used for a different order line.
 
     Returns:
         str: The reference id of the batch to which the order line was allocated.
     """
 
-    line = model.OrderLine(orderid, sku, qty)
+    params = {"orderid": orderid, "sku": sku, "qty": qty}
 
-    async with uow:
-        product = await uow.products.get(sku=line.sku)
-        if product is None:
-            raise InvalidSku(f"Invalid sku {line.sku}")
+    async def attempt() -> str:
+        line = model.OrderLine(orderid, sku, qty)
 
-        batchref = product.allocate(line)
-        await uow.commit()
+        async with uow:
+            if idempotency_key is not None:
+                replayed = await idempotency.replay("allocate", idempotency_key, params, uow)
+                if replayed is not None:
+                    return replayed["batchref"]
+
+            product = await uow.products.get_for_allocation(sku=line.sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {line.sku}")
+
+            # a retried line stays where it is, the product loaded for allocation doesn't know its allocations
+            allocated = await uow.products.allocated_batchrefs([line])
+            if line in allocated:
+                batchref = allocated[line]
+            else:
+                with instrumentation.span("product.allocate"):
+                    batchref = product.allocate(line)
+            if idempotency_key is not None:
+                await idempotency.record("allocate", idempotency_key, params, {"batchref": batchref}, uow)
+            await uow.commit()
+
+        return batchref
 
+    try:
+        batchref = await retry_on_conflict(attempt)
+    except repository.DuplicateIdempotencyKey:
+        # rolled back, the concurrent request with the same key committed first: replay its result
+        batchref = await attempt()
+
+    # raised after the commit, the OutOfStock event is still published
+    if batchref is None:
+        raise exceptions.OutOfStock(f"Out of stock for sku {sku}")
     return batchref
 
 
+async def allocate_many(lines: List[Dict[str, Any]], uow: unit_of_work.AbstractUnitOfWork) -> List[AllocationResult]:
+    """
+    Allocate many order lines in a single unit of work.
+
+    Every product is loaded once, lines are allocated in the given order
+    and all changes are committed together.
+
+    Args:
+        lines: Order lines as dicts with orderid, sku and qty.
+        uow: Unit of work for handling database operations.
+
+    Returns:
+        List[AllocationResult]: One result per line, in the same order,
+        with either the allocated batch reference or an error message.
+
+    Raises:
+        ConcurrencyConflict: If any of the products kept changing under every retry.
+    """
+
+    async def attempt() -> List[AllocationResult]:
+        results = []
+
+        async with uow:
+            products = {}
+            for sku in {line["sku"] for line in lines}:
+                products[sku] = await uow.products.get_for_allocation(sku=sku)
+            allocated = await uow.products.allocated_batchrefs(
+                [model.OrderLine(line["orderid"], line["sku"], line["qty"]) for line in lines if products[line["sku"]]]
+            )
+
+            with instrumentation.span("product.allocate"):
+                for line in lines:
+                    result = AllocationResult(line["orderid"], line["sku"], line["qty"])
+                    order_line = model.OrderLine(result.orderid, result.sku, result.qty)
+                    product = products[result.sku]
+                    if product is None:
+                        result.error, result.error_type = f"Invalid sku {result.sku}", InvalidSku
+                    elif order_line in allocated:
+                        result.batchref = allocated[order_line]
+                    else:
+                        result.batchref = product.allocate(order_line)
+                        if result.batchref is None:
+                            result.error = f"Out of stock for sku {result.sku}"
+                            result.error_type = exceptions.OutOfStock
+                    results.append(result)
+
+            await uow.commit()
+
+        return results
+
+    return await retry_on_conflict(attempt)
+
+
+async def deallocate(orderid: str, sku: str, qty: int, uow: unit_of_work.AbstractUnitOfWork) -> str:
+    """
+    Take an order line off the batch it was allocated to.
+
+    Raises:
+        InvalidSku: If there is no product with this sku.
+        NotAllocated: If the line is not allocated to any batch.
+        ConcurrencyConflict: If the product kept changing under every retry.
+
+    Returns:
+        str: The reference of the batch the line was allocated to.
+    """
+
+    async def attempt() -> str:
+        line = model.OrderLine(orderid, sku, qty)
+
+        async with uow:
+            product = await uow.products.get(sku=sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+
+            batchref = product.deallocate(line)
+            if batchref is None:
+                raise NotAllocated(f"Order line {orderid} of sku {sku} is not allocated")
+            await uow.commit()
+
+        return batchref
+
+    return await retry_on_conflict(attempt)
+
+
+async def change_batch_quantity(
+    reference: str, qty: int, uow: unit_of_work.AbstractUnitOfWork
+) -> List[AllocationResult]:
+    """
+    Change the purchased quantity of a batch, moving the lines it no longer
+    has room for to the product's other batches in the same unit of work.
+
+    Raises:
+        UnknownBatch: If no batch has this reference.
+        ConcurrencyConflict: If the product kept changing under every retry.
+
+    Returns:
+        List[AllocationResult]: The lines that were moved, with their new
+        batch reference or an error when no other batch had room for them.
+    """
+
+    async def attempt() -> List[AllocationResult]:
+        async with uow:
+            product = await uow.products.get_by_batchref(reference)
+            if product is None:
+                raise UnknownBatch(f"Unknown batch {reference}")
+
+            results = []
+            for line, batchref in product.change_batch_quantity(reference, qty):
+                result = AllocationResult(line.orderid, line.sku, line.qty, batchref)
+                if batchref is None:
+                    result.error, result.error_type = f"Out of stock for sku {line.sku}", exceptions.OutOfStock
+                results.append(result)
+            await uow.commit()
+
+        return results
+
+    return await retry_on_conflict(attempt)
+
+
+async def deallocate_all(sku: str, uow: unit_of_work.AbstractUnitOfWork) -> int:
+    """
+    Deallocate every order line of a product.
+
+    Raises:
+        InvalidSku: If there is no product with this sku.
+        ConcurrencyConflict: If the product kept changing under every retry.
+
+    Returns:
+        int: Number of lines deallocated.
+    """
+
+    async def attempt() -> int:
+        async with uow:
+            product = await uow.products.get(sku=sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+
+            lines = product.deallocate_all()
+            await uow.commit()
+
+        return len(lines)
+
+    return await retry_on_conflict(attempt)
+
+
+async def reallocate(sku: str, uow: unit_of_work.AbstractUnitOfWork) -> Tuple[int, int]:
+    """
+    Deallocate every order line of a product and allocate them again,
+    by order id, against its current batches, all in one commit.
+
+    Raises:
+        InvalidSku: If there is no product with this sku.
+        ConcurrencyConflict: If the product kept changing under every retry.
+
+    Returns:
+        Tuple[int, int]: Lines allocated again and lines left without a batch.
+    """
+
+    async def attempt() -> Tuple[int, int]:
+        async with uow:
+            product = await uow.products.get(sku=sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+
+            lines = sorted(product.deallocate_all(), key=lambda line: (line.orderid, line.qty))
+            unallocated = sum(product.allocate(line) is None for line in lines)
+            await uow.commit()
+
+        return len(lines) - unallocated, unallocated
+
+    return await retry_on_conflict(attempt)
+
+
 async def add_batch(
     reference: str,
     sku: str,
     purchased_quantity: int,
     eta: Optional[date],
     uow: unit_of_work.AbstractUnitOfWork,
+    idempotency_key: Optional[str] = None,
 ) -> None:
     """
     Creates a new `Batch` instance from primitive values,
@@ -72,18 +351,68 @@ async def add_batch(
         purchased_quantity: Total quantity purchased in this batch.
         eta: Estimated time of arrival for the batch. Can be `None`.
         uow: Unit of work for handling database operations.
+        idempotency_key: When given, a repeated call with the same key does nothing.
 
     Returns:
         None
 
     Raises:
         InvalidSku: If the batch data is invalid.
+        DuplicateBatch: If another batch has this reference already.
+        IdempotencyKeyReused: If the key was used for a different batch.
     """
 
+    params = {"reference": reference, "sku": sku, "purchased_quantity": purchased_quantity, "eta": eta}
+
+    async def attempt() -> None:
+        async with uow:
+            if idempotency_key is not None:
+                if await idempotency.replay("add_batch", idempotency_key, params, uow) is not None:
+                    return
+
+            # a new batch needs the stock of the others, not their order lines
+            product = await uow.products.get_for_allocation(sku=sku)
+            if product is None:
+                product = model.Product(sku, batches=[])
+                await uow.products.add(product)
+            await uow.products.add_batch(product, model.Batch(reference, sku, purchased_quantity, eta))
+            if idempotency_key is not None:
+                await idempotency.record("add_batch", idempotency_key, params, {}, uow)
+            await uow.commit()
+
+    try:
+        await attempt()
+    except repository.DuplicateIdempotencyKey:
+        await attempt()
+
+
+async def add_batches(batches: List[Dict[str, Any]], uow: unit_of_work.AbstractUnitOfWork) -> int:
+    """
+    Bulk version of `add_batch` for large receiving files.
+
+    Missing products are created and all batches are inserted with
+    set-based statements in a single commit, without loading any product.
+
+    Args:
+        batches: Batches as dicts with reference, sku, purchased_quantity and eta.
+        uow: Unit of work for handling database operations.
+
+    Returns:
+        int: Number of batches added.
+
+    Raises:
+        DuplicateBatch: If a reference is taken or repeated, no batch is added then.
+    """
+
+    if not batches:
+        return 0
+
     async with uow:
-        product = await uow.products.get(sku=sku)
-        if product is None:
-            product = model.Product(sku, batches=[])
-            await uow.products.add(product)
-        product.batches.append(model.Batch(reference, sku, purchased_quantity, eta))
+        await uow.products.add_batches(batches)
         await uow.commit()
+
+    # bulk inserts never load the products, so they are not in products.seen
+    for sku in {b["sku"] for b in batches}:
+        cache.availability.invalidate(sku)
+
+    return len(batches)
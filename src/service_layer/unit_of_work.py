@@ -1,39 +1,104 @@
 import abc
+import os
+from typing import Optional
 
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.orm.exc import StaleDataError
 
 import config
+from dbschema import orm
 from repositories import repository
-from service_layer import messagebus
+from service_layer import cache, instrumentation, messagebus, outbox
 
-DEFAULT_ENGINE = create_async_engine(
-    config.get_postgres_uri(),
-)
 
-DEFAULT_SESSION_FACTORY = async_sessionmaker(
-    bind=DEFAULT_ENGINE,
-)
+class ConcurrencyConflict(Exception):
+    """Raised on commit when a product was changed by another transaction since it was loaded"""
+
+    pass
+
+
+_engine: Optional[AsyncEngine] = None
+_engine_pid: Optional[int] = None
+_session_factory: Optional[async_sessionmaker] = None
+
+
+def get_engine() -> AsyncEngine:
+    """
+    Engine of the current process, created on first use.
+
+    A process forked after the engine was created (e.g. uvicorn workers)
+    gets its own engine and pool instead of sharing the parent's connections.
+    """
+    global _engine, _engine_pid, _session_factory
+
+    if _engine is None or _engine_pid != os.getpid():
+        uri, options = config.get_database_uri(), config.get_engine_options()
+        if not uri.startswith("postgresql"):
+            # the statement cache sizes are asyncpg connect arguments
+            del options["connect_args"]
+        _engine = create_async_engine(uri, **options)
+        _engine_pid = os.getpid()
+        _session_factory = async_sessionmaker(bind=_engine)
+    return _engine
+
+
+def get_session_factory() -> async_sessionmaker:
+    get_engine()
+    return _session_factory
+
+
+async def dispose_engine() -> None:
+    global _engine, _engine_pid, _session_factory
+
+    if _engine is not None and _engine_pid == os.getpid():
+        await _engine.dispose()
+    _engine = _engine_pid = _session_factory = None
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    allocations_view: repository.AbstractAllocationsView
+    idempotency_keys: repository.AbstractIdempotencyKeys
 
     async def __aenter__(self):
+        instrumentation.enter_unit_of_work()
         return self
 
     async def __aexit__(self, *args):
-        await self.rollback()
+        try:
+            await self.rollback()
+        finally:
+            instrumentation.exit_unit_of_work()
 
     async def commit(self):
-        await self._commit()
-        self.publish_events()
-
-    def publish_events(self):
+        # read before the commit, which expires every loaded attribute
+        skus = [product.sku for product in self.products.seen]
+        with instrumentation.span("uow.commit"):
+            await self._commit()
+        for sku in skus:
+            cache.availability.invalidate(sku)
+        # only committed results are cached, a retry after a failed commit must not replay them
+        for key, record in self.idempotency_keys.added.items():
+            cache.idempotency_keys.put(key, record)
+        self.idempotency_keys.added.clear()
+        with instrumentation.span("uow.publish_events"):
+            await self.publish_events()
+
+    async def publish_events(self):
+        # handlers run later and commit on their own, never in this unit of work
+        for event in self.collect_new_events():
+            await messagebus.handle(event, uow_factory=self.fresh)
+
+    def collect_new_events(self):
         for product in self.products.seen:
-            print(vars(product))
             while product.events:
-                event = product.events.pop(0)
-                messagebus.handle(event)
+                yield product.events.pop(0)
+
+    @abc.abstractmethod
+    def fresh(self) -> "AbstractUnitOfWork":
+        """A new unit of work on the same storage, for the handlers of the events this one publishes."""
+        raise NotImplementedError
 
     @abc.abstractmethod
     async def _commit(self):
@@ -45,12 +110,14 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(self, session_factory=None):
         self.session_factory = session_factory
 
     async def __aenter__(self):
-        self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
+        self.session = (self.session_factory or get_session_factory())()
+        self.products = repository.SqlAlchemyRepository(self.session, span=instrumentation.span)
+        self.allocations_view = repository.SqlAlchemyAllocationsView(self.session)
+        self.idempotency_keys = repository.SqlAlchemyIdempotencyKeys(self.session)
         await self.session.begin()
         return await super().__aenter__()
 
@@ -58,8 +125,18 @@ class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
         await super().__aexit__(*args)
         await self.session.close()
 
+    def fresh(self) -> "SqlAlchemyUnitOfWork":
+        return SqlAlchemyUnitOfWork(self.session_factory)
+
     async def _commit(self):
-        await self.session.commit()
+        # events go to the outbox in the same transaction, leaving nothing to publish after the commit
+        rows = [outbox.to_row(event) for event in self.collect_new_events()]
+        if rows:
+            await self.session.execute(insert(orm.outbox), rows)
+        try:
+            await self.session.commit()
+        except StaleDataError as e:
+            raise ConcurrencyConflict(str(e)) from e
 
     async def rollback(self):
         await self.session.rollback()
@@ -67,9 +144,19 @@ class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
 
 class FakeUnitOfWork(AbstractUnitOfWork):
     def __init__(self):
-        self.products = repository.FakeRepository([])
+        self.products = repository.FakeRepository([], span=instrumentation.span)
+        self.allocations_view = repository.FakeAllocationsView()
+        self.idempotency_keys = repository.FakeIdempotencyKeys()
         self.committed = False
 
+    def fresh(self) -> "FakeUnitOfWork":
+        uow = FakeUnitOfWork()
+        # same products, read model and keys, its own seen products and commit flag
+        uow.products._products = self.products._products
+        uow.allocations_view = self.allocations_view
+        uow.idempotency_keys._records = self.idempotency_keys._records
+        return uow
+
     async def _commit(self):
         self.committed = True
 
@@ -0,0 +1,130 @@
+from datetime import date
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+from sqlalchemy import Select, func, select
+
+from dbschema import orm
+from service_layer import cache, unit_of_work
+
+
+async def availability(sku: str, uow: unit_of_work.SqlAlchemyUnitOfWork) -> Optional[List[Dict[str, Any]]]:
+    """
+    Quantity still available in every batch of a sku, served from
+    `cache.availability` when possible and never loading a Product.
+
+    Returns:
+        Optional[List[Dict[str, Any]]]: reference, eta and available per batch,
+        None for an unknown sku.
+    """
+
+    batches = cache.availability.get(sku)
+    if batches is not None:
+        return batches
+
+    allocated = func.coalesce(func.sum(orm.order_lines.c.qty), 0)
+    async with uow:
+        result = await uow.session.execute(
+            select(orm.batches.c.reference, orm.batches.c.eta, orm.batches.c.purchased_quantity - allocated)
+            .select_from(orm.batches)
+            .outerjoin(orm.allocations, orm.allocations.c.batch_id == orm.batches.c.id)
+            .outerjoin(orm.order_lines, orm.order_lines.c.id == orm.allocations.c.OrderLine_id)
+            .where(orm.batches.c.sku == sku)
+            .group_by(orm.batches.c.id, orm.batches.c.reference, orm.batches.c.eta, orm.batches.c.purchased_quantity)
+            .order_by(orm.batches.c.id)
+        )
+        batches = [{"reference": ref, "eta": eta, "available": available} for ref, eta, available in result]
+
+    if not batches:
+        return None
+
+    cache.availability.put(sku, batches)
+    return batches
+
+
+async def allocations(orderid: str, uow: unit_of_work.AbstractUnitOfWork) -> List[Dict[str, str]]:
+    """Where the lines of an order were allocated, read from the allocations_view read model only."""
+    async with uow:
+        return await uow.allocations_view.for_order(orderid)
+
+
+ALLOCATION_EXPORT_COLUMNS = ("orderid", "sku", "qty", "batchref", "eta")
+BATCH_EXPORT_COLUMNS = ("reference", "sku", "eta", "purchased_quantity", "allocated")
+
+
+def _filter_batches(query: Select, sku: Optional[str], eta_from: Optional[date], eta_to: Optional[date]) -> Select:
+    if sku is not None:
+        query = query.where(orm.batches.c.sku == sku)
+    if eta_from is not None:
+        query = query.where(orm.batches.c.eta >= eta_from)
+    if eta_to is not None:
+        query = query.where(orm.batches.c.eta <= eta_to)
+    return query
+
+
+async def _stream(query: Select, uow: unit_of_work.SqlAlchemyUnitOfWork, chunk_size: int) -> AsyncIterator[Sequence]:
+    # server-side cursor, only one chunk of rows is held at a time however large the result
+    async with uow:
+        result = await uow.session.stream(query.execution_options(yield_per=chunk_size))
+        async for rows in result.partitions():
+            yield rows
+
+
+def export_allocations(
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    chunk_size: int,
+    sku: Optional[str] = None,
+    eta_from: Optional[date] = None,
+    eta_to: Optional[date] = None,
+) -> AsyncIterator[Sequence]:
+    """
+    Every allocated order line, in chunks of rows with `ALLOCATION_EXPORT_COLUMNS`,
+    optionally only for one sku and for batches with an eta in the given range.
+    """
+
+    query = (
+        select(
+            orm.order_lines.c.orderid,
+            orm.order_lines.c.sku,
+            orm.order_lines.c.qty,
+            orm.batches.c.reference,
+            orm.batches.c.eta,
+        )
+        .select_from(orm.allocations)
+        .join(orm.order_lines, orm.order_lines.c.id == orm.allocations.c.OrderLine_id)
+        .join(orm.batches, orm.batches.c.id == orm.allocations.c.batch_id)
+        .order_by(orm.allocations.c.id)
+    )
+    return _stream(_filter_batches(query, sku, eta_from, eta_to), uow, chunk_size)
+
+
+def export_batches(
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    chunk_size: int,
+    sku: Optional[str] = None,
+    eta_from: Optional[date] = None,
+    eta_to: Optional[date] = None,
+) -> AsyncIterator[Sequence]:
+    """Every batch with its allocated quantity, in chunks of rows with `BATCH_EXPORT_COLUMNS`."""
+
+    allocated = func.coalesce(func.sum(orm.order_lines.c.qty), 0)
+    query = (
+        select(
+            orm.batches.c.reference,
+            orm.batches.c.sku,
+            orm.batches.c.eta,
+            orm.batches.c.purchased_quantity,
+            allocated,
+        )
+        .select_from(orm.batches)
+        .outerjoin(orm.allocations, orm.allocations.c.batch_id == orm.batches.c.id)
+        .outerjoin(orm.order_lines, orm.order_lines.c.id == orm.allocations.c.OrderLine_id)
+        .group_by(
+            orm.batches.c.id,
+            orm.batches.c.reference,
+            orm.batches.c.sku,
+            orm.batches.c.eta,
+            orm.batches.c.purchased_quantity,
+        )
+        .order_by(orm.batches.c.id)
+    )
+    return _stream(_filter_batches(query, sku, eta_from, eta_to), uow, chunk_size)
@@ -1,5 +1,6 @@
-from typing import AsyncGenerator, Callable, Final
+from typing import AsyncGenerator, Callable, Final, Generator
 
+import pytest
 import pytest_asyncio
 from fastapi import FastAPI
 from httpx import ASGITransport, AsyncClient
@@ -7,14 +8,28 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from config import get_postgres_uri
-from dbschema.orm import metadata
+from dbschema.orm import metadata, start_mappers
 from domain.model import Batch
 from entrypoints.fastapi_app import make_app
+from service_layer import cache
 
 TEST_BASE_URL: Final[str] = "http://test"
 IN_MEMORY_DB_URI: Final[str] = "sqlite+aiosqlite:///:memory:"
 
 
+@pytest.fixture(scope="session", autouse=True)
+def mappers() -> None:
+    start_mappers()
+
+
+@pytest.fixture(autouse=True)
+def clear_idempotency_cache() -> Generator[None, None, None]:
+    # results cached by one test must not be replayed in another
+    cache.idempotency_keys.clear()
+    yield
+    cache.idempotency_keys.clear()
+
+
 @pytest_asyncio.fixture(scope="session")
 async def test_app() -> FastAPI:
     app = make_app()
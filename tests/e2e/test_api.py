@@ -1,3 +1,4 @@
+import json
 import uuid
 from http import HTTPStatus
 
@@ -5,6 +6,7 @@ import pytest
 from httpx import AsyncClient
 
 import config
+from service_layer import instrumentation
 
 
 def random_suffix() -> str:
@@ -67,6 +69,21 @@ async def test_api_returns_allocation(async_test_client: AsyncClient) -> None:
     assert response.json() == {"status": "Ok", "batchref": earlybatch}
 
 
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("postgres_db")
+async def test_409_for_a_taken_batch_reference(async_test_client: AsyncClient) -> None:
+    sku, batch = random_sku(), random_batchref()
+    await post_to_add_batch(async_test_client, batch, sku, 10, None)
+
+    url = config.get_api_url()
+    batch_data = {"reference": batch, "sku": sku, "purchased_quantity": 5, "eta": None}
+    response = await async_test_client.post(f"{url}/add_batch", json=batch_data)
+    assert response.status_code == HTTPStatus.CONFLICT
+
+    response = await async_test_client.post(f"{url}/add_batches", json=[batch_data])
+    assert response.status_code == HTTPStatus.CONFLICT
+
+
 @pytest.mark.asyncio
 @pytest.mark.usefixtures("postgres_db")
 async def test_allocations_are_persisted(async_test_client: AsyncClient) -> None:
@@ -114,3 +131,112 @@ async def test_400_message_for_invalid_sku(async_test_client: AsyncClient) -> No
     r = await async_test_client.post(f"{url}/allocate", json=data)
     assert r.status_code == HTTPStatus.BAD_REQUEST
     assert r.json()["detail"] == f"Invalid sku {unknown_sku}"
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("postgres_db")
+async def test_api_allocates_many_lines(async_test_client: AsyncClient) -> None:
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    batch = random_batchref()
+    order1, order2 = random_orderid(1), random_orderid(2)
+
+    await post_to_add_batch(async_test_client, batch, sku, 10, None)
+
+    data = [
+        {"orderid": order1, "sku": sku, "qty": 10},
+        {"orderid": order2, "sku": unknown_sku, "qty": 1},
+    ]
+    url = config.get_api_url()
+    r = await async_test_client.post(f"{url}/allocate/batch", json=data)
+    assert r.status_code == HTTPStatus.ACCEPTED
+    assert [(line["batchref"], line["error"]) for line in r.json()["results"]] == [
+        (batch, None),
+        (None, f"Invalid sku {unknown_sku}"),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("postgres_db")
+async def test_404_for_order_without_allocations(async_test_client: AsyncClient) -> None:
+    orderid = random_orderid()
+    url = config.get_api_url()
+    r = await async_test_client.get(f"{url}/allocations/{orderid}")
+    assert r.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("postgres_db")
+async def test_change_batch_quantity_moves_lines_and_deallocate_frees_them(async_test_client: AsyncClient) -> None:
+    sku = random_sku()
+    batch, shipment = random_batchref(1), random_batchref(2)
+    orderid = random_orderid()
+    url = config.get_api_url()
+
+    await post_to_add_batch(async_test_client, batch, sku, 10, None)
+    await post_to_add_batch(async_test_client, shipment, sku, 10, "2030-01-01")
+    line = {"orderid": orderid, "sku": sku, "qty": 6}
+    r = await async_test_client.post(f"{url}/allocate", json=line)
+    assert r.json()["batchref"] == batch
+
+    r = await async_test_client.post(f"{url}/change_batch_quantity", json={"reference": batch, "qty": 5})
+    assert r.status_code == HTTPStatus.OK
+    assert [(m["orderid"], m["batchref"]) for m in r.json()["moved"]] == [(orderid, shipment)]
+
+    r = await async_test_client.post(f"{url}/deallocate", json=line)
+    assert r.status_code == HTTPStatus.OK
+    assert r.json()["batchref"] == shipment
+
+    r = await async_test_client.post(f"{url}/deallocate", json=line)
+    assert r.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("postgres_db")
+async def test_exports_allocations_as_ndjson(async_test_client: AsyncClient) -> None:
+    sku, batch, orderid = random_sku(), random_batchref(), random_orderid()
+    url = config.get_api_url()
+
+    await post_to_add_batch(async_test_client, batch, sku, 10, None)
+    await async_test_client.post(f"{url}/allocate", json={"orderid": orderid, "sku": sku, "qty": 3})
+
+    r = await async_test_client.get(f"{url}/export/allocations", params={"sku": sku})
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line) for line in r.text.splitlines()] == [
+        {"orderid": orderid, "sku": sku, "qty": 3, "batchref": batch, "eta": None}
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("postgres_db")
+async def test_metrics_expose_span_durations(async_test_client: AsyncClient) -> None:
+    instrumentation.configure(True)
+    await post_to_add_batch(async_test_client, random_batchref(), random_sku(), 10, None)
+
+    response = await async_test_client.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    samples = dict(line.rsplit(" ", 1) for line in response.text.splitlines() if not line.startswith("#"))
+    assert float(samples['span_duration_seconds_count{span="repository.get_for_allocation"}']) > 0
+    assert float(samples['span_duration_seconds_count{span="uow.commit"}']) > 0
+    assert float(samples["uow_sql_statements_count"]) > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("postgres_db")
+async def test_retried_allocate_with_idempotency_key_allocates_once(async_test_client: AsyncClient) -> None:
+    sku, batch = random_sku(), random_batchref()
+    await post_to_add_batch(async_test_client, batch, sku, 10, None)
+
+    url = config.get_api_url()
+    line = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+    for _ in range(2):
+        r = await async_test_client.post(f"{url}/allocate", json=line, headers=headers)
+        assert r.status_code == HTTPStatus.ACCEPTED
+        assert r.json() == {"status": "Ok", "batchref": batch}
+
+    r = await async_test_client.get(f"{url}/availability/{sku}")
+    assert r.json()["available"] == 0
+
+    r = await async_test_client.post(f"{url}/allocate", json={**line, "qty": 1}, headers=headers)
+    assert r.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
@@ -0,0 +1,101 @@
+import pytest
+from sqlalchemy import inspect, text
+
+from dbschema import migrations, orm
+
+
+def index_names(connection) -> set:
+    inspector = inspect(connection)
+    return {index["name"] for table in inspector.get_table_names() for index in inspector.get_indexes(table)}
+
+
+@pytest.mark.asyncio
+async def test_upgrade_adds_indexes_to_an_existing_database(in_memory_db) -> None:
+    async with in_memory_db.begin() as conn:
+        for table in (orm.order_lines, orm.batches, orm.allocations):
+            for index in table.indexes:
+                await conn.run_sync(index.drop)
+        await conn.execute(text("DROP TABLE schema_version"))
+
+    async with in_memory_db.begin() as conn:
+        version = await conn.run_sync(migrations.upgrade)
+        names = await conn.run_sync(index_names)
+
+    assert version == migrations.SCHEMA_VERSION
+    assert {"ix_batches_sku", "ux_batches_reference", "ix_allocations_batch_id"} <= names
+
+
+@pytest.mark.asyncio
+async def test_upgrade_is_idempotent(in_memory_db) -> None:
+    async with in_memory_db.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        await conn.run_sync(migrations.upgrade)
+        result = await conn.execute(text("SELECT count(*), max(version) FROM schema_version"))
+
+    assert list(result) == [(len(migrations.REVISIONS), migrations.SCHEMA_VERSION)]
+
+
+@pytest.mark.asyncio
+async def test_upgrade_leaves_a_current_database_alone(in_memory_db) -> None:
+    async with in_memory_db.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        await conn.run_sync(orm.allocations_view.drop)
+
+    async with in_memory_db.begin() as conn:
+        version = await conn.run_sync(migrations.upgrade)
+        tables = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names())
+
+    assert version == migrations.SCHEMA_VERSION
+    assert orm.allocations_view.name not in tables
+
+
+@pytest.mark.asyncio
+async def test_upgrade_rebuilds_the_allocations_view_with_quantities(in_memory_db) -> None:
+    async with in_memory_db.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        await conn.run_sync(orm.allocations_view.drop)
+        await conn.execute(
+            text(
+                "CREATE TABLE allocations_view (id INTEGER PRIMARY KEY, orderid VARCHAR(255) NOT NULL,"
+                " sku VARCHAR(255) NOT NULL, batchref VARCHAR(255) NOT NULL)"
+            )
+        )
+        await conn.execute(text("INSERT INTO allocations_view (orderid, sku, batchref) VALUES ('o1', 'JUG', 'b1')"))
+        await conn.execute(text("DELETE FROM schema_version WHERE version >= 6"))
+        await conn.execute(text("INSERT INTO products (sku, version_number) VALUES ('JUG', 1)"))
+        await conn.execute(
+            text("INSERT INTO batches (id, reference, sku, purchased_quantity) VALUES (1, 'b1', 'JUG', 10)")
+        )
+        await conn.execute(
+            text("INSERT INTO order_lines (id, orderid, sku, qty) VALUES (1, 'o1', 'JUG', 1), (2, 'o1', 'JUG', 2)")
+        )
+        await conn.execute(text('INSERT INTO allocations ("OrderLine_id", batch_id) VALUES (1, 1), (2, 1)'))
+
+    async with in_memory_db.begin() as conn:
+        version = await conn.run_sync(migrations.upgrade)
+        result = await conn.execute(text("SELECT orderid, sku, qty, batchref FROM allocations_view ORDER BY qty"))
+
+    assert version == migrations.SCHEMA_VERSION
+    assert list(result) == [("o1", "JUG", 1, "b1"), ("o1", "JUG", 2, "b1")]
+
+
+@pytest.mark.asyncio
+async def test_upgrade_adds_attempts_to_the_outbox(in_memory_db) -> None:
+    async with in_memory_db.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+        await conn.run_sync(orm.outbox.drop)
+        await conn.execute(
+            text(
+                "CREATE TABLE outbox (id INTEGER PRIMARY KEY, event_type VARCHAR(255) NOT NULL,"
+                " payload JSON NOT NULL, sent_at DATETIME)"
+            )
+        )
+        await conn.execute(text("""INSERT INTO outbox (event_type, payload) VALUES ('OutOfStock', '{"sku": "JUG"}')"""))
+        await conn.execute(text("DELETE FROM schema_version WHERE version = 7"))
+
+    async with in_memory_db.begin() as conn:
+        version = await conn.run_sync(migrations.upgrade)
+        result = await conn.execute(text("SELECT event_type, attempts, dead_lettered_at FROM outbox"))
+
+    assert version == migrations.SCHEMA_VERSION
+    assert list(result) == [("OutOfStock", 0, None)]
@@ -133,5 +133,24 @@ async def test_retrieving_allocations(session) -> None:
     result = await session.execute(select(Batch).options(selectinload(model.Batch.allocations)))
     batch = result.scalar_one()
     assert batch.allocations == {OrderLine("order1", "sku1", 12)}
+    assert batch.allocated_quantity == 12
+    assert batch.available_quantity == 88
+
+    await session.rollback()
+
+
+@pytest.mark.asyncio
+async def test_loaded_lines_share_their_sku_string(session) -> None:
+    await session.execute(
+        text(
+            "INSERT INTO order_lines (orderid, sku, qty) VALUES "
+            '("order1", "RETRO-CLOCK", 1),'
+            '("order2", "RETRO-CLOCK", 2)'
+        )
+    )
+
+    result = await session.execute(select(OrderLine).order_by(OrderLine.orderid))
+    first, second = result.scalars().all()
+    assert first.sku is second.sku
 
     await session.rollback()
@@ -0,0 +1,216 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select, text
+
+from dbschema import orm
+from domain import events, model
+from service_layer import messagebus, outbox, services, unit_of_work, views
+
+
+async def allocate_out_of_stock(session_factory, sku: str) -> None:
+    session = session_factory()
+    await session.execute(text("INSERT INTO products (sku, version_number) VALUES (:sku, 1)"), dict(sku=sku))
+    await session.commit()
+    await session.close()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    async with uow:
+        product = await uow.products.get(sku=sku)
+        product.allocate(model.OrderLine("o1", sku, 10))
+        await uow.commit()
+
+
+@pytest.mark.asyncio
+async def test_events_are_stored_in_the_outbox_on_commit(session_factory, monkeypatch) -> None:
+    published = []
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [lambda event, uow: published.append(event)])
+
+    await allocate_out_of_stock(session_factory, "CUSHION")
+    await messagebus.drain()
+
+    session = session_factory()
+    result = await session.execute(
+        select(orm.outbox.c.event_type, orm.outbox.c.payload, orm.outbox.c.sent_at).where(
+            orm.outbox.c.event_type == "OutOfStock"
+        )
+    )
+    [(event_type, payload, sent_at)] = result
+    assert event_type == "OutOfStock"
+    assert outbox.from_row(event_type, payload) == events.OutOfStock(sku="CUSHION")
+    assert sent_at is None
+    assert published == []
+
+
+@pytest.mark.asyncio
+async def test_relay_dispatches_and_marks_events_sent(session_factory, monkeypatch) -> None:
+    relayed = []
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [lambda event, uow: relayed.append(event)])
+
+    await allocate_out_of_stock(session_factory, "CANDLE")
+
+    def uow_factory():
+        return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    assert await outbox.relay_once(session_factory, uow_factory, batch_size=10) == 1
+    assert relayed == [events.OutOfStock(sku="CANDLE")]
+    assert await outbox.relay_once(session_factory, uow_factory, batch_size=10) == 0
+
+
+@pytest.mark.asyncio
+async def test_relayed_allocations_are_readable_by_order(session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "VASE", 10, None, uow)
+    await services.allocate("order1", "VASE", 2, uow)
+
+    assert await views.allocations("order1", uow) == []
+    await outbox.relay_once(session_factory, lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory), 10)
+    assert await views.allocations("order1", uow) == [{"sku": "VASE", "batchref": "batch1"}]
+
+
+@pytest.mark.asyncio
+async def test_relayed_deallocation_leaves_the_other_line_of_the_order(session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "JUG", 10, None, uow)
+    await services.allocate("order1", "JUG", 1, uow)
+    await services.allocate("order1", "JUG", 2, uow)
+    await services.deallocate("order1", "JUG", 1, uow)
+
+    await outbox.relay_once(session_factory, lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory), 10)
+    assert await views.allocations("order1", uow) == [{"sku": "JUG", "batchref": "batch1"}]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_relays_keep_the_order_of_the_events(session_factory, monkeypatch) -> None:
+    session = session_factory()
+    await session.execute(
+        orm.outbox.insert(),
+        [
+            outbox.to_row(events.Allocated("order1", "LAMP", 1, "batch1")),
+            outbox.to_row(events.Deallocated("order1", "LAMP", 1, "batch1")),
+        ],
+    )
+    await session.commit()
+    await session.close()
+
+    [add_to_read_model] = messagebus.HANDLERS[events.Allocated]
+    deliveries = []
+
+    async def slow_add_to_read_model(event, uow):
+        # the first delivery stalls, anything relayed meanwhile overtakes it
+        deliveries.append(event)
+        if len(deliveries) == 1:
+            await asyncio.sleep(0.05)
+        await add_to_read_model(event, uow)
+
+    monkeypatch.setitem(messagebus.HANDLERS, events.Allocated, [slow_add_to_read_model])
+
+    def uow_factory():
+        return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    async def relay():
+        for _ in range(3):
+            await outbox.relay_once(session_factory, uow_factory, batch_size=1)
+            await asyncio.sleep(0)
+
+    await asyncio.gather(relay(), relay())
+    await asyncio.gather(relay(), relay())
+
+    assert await views.allocations("order1", uow_factory()) == []
+    session = session_factory()
+    unsent = await session.scalar(select(func.count()).select_from(orm.outbox).where(orm.outbox.c.sent_at.is_(None)))
+    await session.close()
+    assert unsent == 0
+
+
+async def add_to_outbox(session_factory, *events_) -> None:
+    session = session_factory()
+    await session.execute(orm.outbox.insert(), [outbox.to_row(event) for event in events_])
+    await session.commit()
+    await session.close()
+
+
+@pytest.mark.asyncio
+async def test_a_failing_event_does_not_hold_back_other_products(session_factory, monkeypatch) -> None:
+    await add_to_outbox(
+        session_factory,
+        events.OutOfStock("LAMP"),
+        events.Allocated("order1", "LAMP", 1, "batch1"),
+        events.Allocated("order2", "SOFA", 1, "batch2"),
+    )
+
+    def send_out_of_stock_notification(event, uow):
+        raise ConnectionRefusedError("smtp is down")
+
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [send_out_of_stock_notification])
+
+    def uow_factory():
+        return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    assert await outbox.relay_once(session_factory, uow_factory, batch_size=10) == 1
+    assert await views.allocations("order1", uow_factory()) == []
+    assert await views.allocations("order2", uow_factory()) == [{"sku": "SOFA", "batchref": "batch2"}]
+
+
+@pytest.mark.asyncio
+async def test_an_event_failing_max_attempts_times_is_dead_lettered(session_factory, monkeypatch) -> None:
+    await add_to_outbox(session_factory, events.OutOfStock("LAMP"), events.Allocated("order1", "LAMP", 1, "batch1"))
+    attempts = []
+
+    def send_out_of_stock_notification(event, uow):
+        attempts.append(event)
+        raise ConnectionRefusedError("smtp is down")
+
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [send_out_of_stock_notification])
+
+    def uow_factory():
+        return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    for _ in range(2):
+        assert await outbox.relay_once(session_factory, uow_factory, batch_size=10, max_attempts=3) == 0
+    # the third failure gives up on the notification and lets the allocation through
+    assert await outbox.relay_once(session_factory, uow_factory, batch_size=10, max_attempts=3) == 0
+    assert await outbox.relay_once(session_factory, uow_factory, batch_size=10, max_attempts=3) == 1
+    assert await outbox.relay_once(session_factory, uow_factory, batch_size=10, max_attempts=3) == 0
+
+    assert len(attempts) == 3
+    assert await views.allocations("order1", uow_factory()) == [{"sku": "LAMP", "batchref": "batch1"}]
+    session = session_factory()
+    result = await session.execute(
+        select(orm.outbox.c.attempts, orm.outbox.c.sent_at, orm.outbox.c.dead_lettered_at).where(
+            orm.outbox.c.event_type == "OutOfStock"
+        )
+    )
+    [(attempts_recorded, sent_at, dead_lettered_at)] = result
+    await session.close()
+    assert attempts_recorded == 3
+    assert sent_at is None
+    assert dead_lettered_at is not None
+
+
+@pytest.mark.asyncio
+async def test_relay_hands_products_to_the_workers_side_by_side(session_factory, monkeypatch) -> None:
+    await add_to_outbox(session_factory, events.OutOfStock("LAMP"), events.OutOfStock("SOFA"))
+    sofa_handled = asyncio.Event()
+
+    async def send_out_of_stock_notification(event, uow):
+        # the lamp notification only gets through while the sofa one is handled alongside
+        if event.sku == "LAMP":
+            await asyncio.wait_for(sofa_handled.wait(), timeout=1)
+        sofa_handled.set()
+
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [send_out_of_stock_notification])
+
+    def uow_factory():
+        return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    assert await outbox.relay_once(session_factory, uow_factory, batch_size=10) == 2
+
+
+def test_batch_quantity_changed_is_stored_by_batchref() -> None:
+    event = events.BatchQuantityChanged("batch1", "LAMP", 5)
+
+    row = outbox.to_row(event)
+
+    assert row == {"event_type": "BatchQuantityChanged", "payload": {"batchref": "batch1", "sku": "LAMP", "qty": 5}}
+    assert outbox.from_row(row["event_type"], row["payload"]) == event
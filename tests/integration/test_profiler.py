@@ -0,0 +1,61 @@
+import pytest
+
+from service_layer import profiler, services, unit_of_work
+
+
+@pytest.fixture
+def sql_profiler(in_memory_db):
+    sql_profiler = profiler.SqlProfiler(buffer_size=2, slow_query_ms=60_000, repeat_threshold=3)
+    sql_profiler.attach(in_memory_db.sync_engine)
+    return sql_profiler
+
+
+@pytest.mark.asyncio
+async def test_statements_are_recorded_per_profile(sql_profiler, session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "KETTLE", 10, None, uow)
+
+    with sql_profiler.profile("allocate") as profile:
+        await services.allocate("o1", "KETTLE", 1, uow)
+
+    [recorded] = sql_profiler.recent()
+    assert recorded["name"] == "allocate"
+    assert recorded["statement_count"] == len(profile.statements) > 0
+    assert recorded["statements"][0]["statement"].lstrip().startswith("SELECT")
+    assert recorded["statements"][0]["rows"] == 1
+    assert recorded["flags"] == []
+
+
+@pytest.mark.asyncio
+async def test_repeated_selects_are_flagged(sql_profiler, session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "KETTLE", 10, None, uow)
+
+    # one load per line, the shape of an N+1
+    with sql_profiler.profile("loop"):
+        for orderid in ("o1", "o2", "o3"):
+            await services.allocate(orderid, "KETTLE", 1, uow)
+
+    [recorded] = sql_profiler.recent(flagged_only=True)
+    assert {flag["kind"] for flag in recorded["flags"]} == {"repeated"}
+    assert all(flag["count"] == 3 for flag in recorded["flags"])
+
+
+@pytest.mark.asyncio
+async def test_slow_statements_are_flagged_and_buffer_is_bounded(in_memory_db, session_factory) -> None:
+    sql_profiler = profiler.SqlProfiler(buffer_size=2, slow_query_ms=0, repeat_threshold=100)
+    sql_profiler.attach(in_memory_db.sync_engine)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    for n in range(3):
+        with sql_profiler.profile(f"add-{n}"):
+            await services.add_batch(f"batch{n}", "KETTLE", 10, None, uow)
+
+    assert [p["name"] for p in sql_profiler.recent()] == ["add-2", "add-1"]
+    assert all(flag["kind"] == "slow" for flag in sql_profiler.recent()[0]["flags"])
+    assert sql_profiler.recent()[0]["flags"]
+
+
+def test_no_profiler_when_disabled() -> None:
+    assert profiler.configure({"enabled": False, "buffer_size": 1, "slow_query_ms": 1, "repeat_threshold": 1}) is None
+    assert profiler.get_profiler() is None
@@ -1,11 +1,11 @@
 from datetime import date
 
 import pytest
-from sqlalchemy import text
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from domain import model
-from service_layer import unit_of_work
+from domain import exceptions, model
+from service_layer import cache, idempotency, instrumentation, services, unit_of_work
 
 
 # Helper functions
@@ -84,3 +84,246 @@ async def test_rolls_back_on_error(session_factory) -> None:
     result = await new_session.execute(text("SELECT * FROM batches"))
     rows = list(result)
     assert rows == []
+
+
+@pytest.mark.asyncio
+async def test_bulk_added_batches_are_persisted(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "SHELF", 10, None)
+    await session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    async with uow:
+        await uow.products.add_batches(
+            [
+                {"reference": "batch2", "sku": "SHELF", "purchased_quantity": 20, "eta": None},
+                {"reference": "batch3", "sku": "CABINET", "purchased_quantity": 30, "eta": date(2025, 6, 1)},
+            ]
+        )
+        await uow.commit()
+
+    result = await session.execute(text("SELECT sku FROM products ORDER BY sku"))
+    assert list(result) == [("CABINET",), ("SHELF",)]
+
+    async with uow:
+        product = await uow.products.get(sku="SHELF")
+        assert {b.reference for b in product.batches} == {"batch1", "batch2"}
+
+
+@pytest.mark.asyncio
+async def test_allocation_load_skips_history_but_keeps_totals(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "WARDROBE", 100, None)
+    await session.commit()
+
+    for orderid in ("o1", "o2"):
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        async with uow:
+            product = await uow.products.get_for_allocation(sku="WARDROBE")
+            [batch] = product.batches
+            assert batch.allocations == set()
+            product.allocate(model.OrderLine(orderid=orderid, sku="WARDROBE", qty=10))
+            await uow.commit()
+
+    async with uow:
+        product = await uow.products.get_for_allocation(sku="WARDROBE")
+        assert product.batches[0].available_quantity == 80
+
+    assert await get_allocated_batch_ref(session, "o1", "WARDROBE") == "batch1"
+    assert await get_allocated_batch_ref(session, "o2", "WARDROBE") == "batch1"
+
+
+@pytest.mark.asyncio
+async def test_retried_line_is_not_allocated_twice(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "NIGHTSTAND", 100, None)
+    await session.commit()
+
+    for _ in range(2):
+        batchref = await services.allocate(
+            "o1", "NIGHTSTAND", 10, uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        )
+        assert batchref == "batch1"
+
+    result = await session.execute(text("SELECT count(*) FROM order_lines WHERE orderid = 'o1'"))
+    assert list(result) == [(1,)]
+
+
+@pytest.mark.asyncio
+async def test_full_load_after_allocation_load_sees_the_allocations(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "CABINET", 100, None)
+    await session.commit()
+    await services.allocate("o1", "CABINET", 10, uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    async with uow:
+        await uow.products.get_for_allocation(sku="CABINET")
+        product = await uow.products.get(sku="CABINET")
+        assert product.batches[0].allocations == {model.OrderLine("o1", "CABINET", 10)}
+
+
+@pytest.mark.asyncio
+async def test_batch_added_to_an_allocated_product_keeps_its_allocations(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "SHELF", 10, None)
+    await session.commit()
+    await services.allocate("o1", "SHELF", 10, uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+    await services.add_batch("batch2", "SHELF", 5, None, unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    async with uow:
+        product = await uow.products.get(sku="SHELF")
+        batches = {batch.reference: batch for batch in product.batches}
+        assert batches["batch1"].allocations == {model.OrderLine("o1", "SHELF", 10)}
+        assert batches["batch2"].available_quantity == 5
+    assert await services.allocate("o2", "SHELF", 5, uow=uow) == "batch2"
+
+
+@pytest.mark.asyncio
+async def test_taken_batch_reference_is_a_duplicate_batch(session_factory) -> None:
+    await services.add_batch("batch1", "SHELF", 10, None, unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+    with pytest.raises(exceptions.DuplicateBatch):
+        await services.add_batch("batch1", "CRATE", 5, None, unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+    with pytest.raises(exceptions.DuplicateBatch):
+        await services.add_batches(
+            [
+                {"reference": "batch2", "sku": "CRATE", "purchased_quantity": 5, "eta": None},
+                {"reference": "batch1", "sku": "CRATE", "purchased_quantity": 5, "eta": None},
+            ],
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        )
+
+    session = session_factory()
+    result = await session.execute(text("SELECT reference, sku FROM batches"))
+    assert list(result) == [("batch1", "SHELF")]
+    await session.close()
+
+
+@pytest.mark.asyncio
+async def test_engine_is_created_once_per_process(monkeypatch) -> None:
+    engine = unit_of_work.get_engine()
+    assert unit_of_work.get_engine() is engine
+
+    monkeypatch.setattr(unit_of_work.os, "getpid", lambda: -1)
+    assert unit_of_work.get_engine() is not engine
+
+    await unit_of_work.dispose_engine()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_change_to_a_product_is_a_conflict(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "STOOL", 100, None)
+    await session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with pytest.raises(unit_of_work.ConcurrencyConflict):
+        async with uow:
+            product = await uow.products.get_for_allocation(sku="STOOL")
+            await session.execute(text("UPDATE products SET version_number = version_number + 1 WHERE sku = 'STOOL'"))
+            await session.commit()
+
+            product.allocate(model.OrderLine(orderid="o1", sku="STOOL", qty=10))
+            await uow.commit()
+
+    result = await session.execute(text("SELECT count(*) FROM allocations"))
+    assert list(result) == [(0,)]
+
+
+@pytest.mark.asyncio
+async def test_changed_batch_quantity_moves_lines_in_one_commit(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "TABLE-LAMP", 10, None)
+    await session.execute(
+        text("INSERT INTO batches (reference, sku, purchased_quantity, eta) VALUES ('batch2', 'TABLE-LAMP', 10, :eta)"),
+        dict(eta=date(2030, 1, 1)),
+    )
+    await session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    async with uow:
+        product = await uow.products.get(sku="TABLE-LAMP")
+        product.allocate(model.OrderLine(orderid="o1", sku="TABLE-LAMP", qty=7))
+        product.allocate(model.OrderLine(orderid="o2", sku="TABLE-LAMP", qty=3))
+        await uow.commit()
+
+    async with uow:
+        product = await uow.products.get_by_batchref("batch1")
+        assert product.sku == "TABLE-LAMP"
+        product.change_batch_quantity("batch1", 4)
+        await uow.commit()
+
+    assert await get_allocated_batch_ref(session, "o1", "TABLE-LAMP") == "batch2"
+    assert await get_allocated_batch_ref(session, "o2", "TABLE-LAMP") == "batch1"
+
+
+@pytest.mark.asyncio
+async def test_statements_are_counted_per_unit_of_work(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "DRESSER", 100, None)
+    await session.commit()
+
+    sent = []
+    engine = session_factory.kw["bind"].sync_engine
+    event.listen(engine, "before_cursor_execute", lambda *args: sent.append(args[2]))
+    instrumentation.configure(True, sinks=[])
+    counted = instrumentation.uow_statements.count()
+    _, [total] = instrumentation.uow_statements.series.get(None, (None, [0.0]))
+
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        async with uow:
+            product = await uow.products.get_for_allocation(sku="DRESSER")
+            product.allocate(model.OrderLine(orderid="o1", sku="DRESSER", qty=10))
+            await uow.commit()
+    finally:
+        instrumentation.configure(False)
+
+    assert sent
+    assert instrumentation.uow_statements.count() == counted + 1
+    assert instrumentation.uow_statements.series[None][1][0] - total == len(sent)
+
+
+@pytest.mark.asyncio
+async def test_idempotent_allocate_is_replayed_from_the_database(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "LAMPSHADE", 100, None)
+    await session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    await services.allocate("o1", "LAMPSHADE", 10, uow=uow, idempotency_key="retried-allocate")
+    cache.idempotency_keys.clear()  # as seen from another worker
+
+    sent = []
+    engine = session_factory.kw["bind"].sync_engine
+    event.listen(engine, "before_cursor_execute", lambda *args: sent.append(args[2]))
+    batchref = await services.allocate("o1", "LAMPSHADE", 10, uow=uow, idempotency_key="retried-allocate")
+
+    assert batchref == "batch1"
+    assert not any("batches" in statement for statement in sent)
+    result = await session.execute(text("SELECT count(*) FROM order_lines WHERE orderid = 'o1'"))
+    assert list(result) == [(1,)]
+
+
+@pytest.mark.asyncio
+async def test_idempotency_keys_past_the_retention_are_purged(session_factory) -> None:
+    session = session_factory()
+    await insert_batch(session, "batch1", "FOOTSTOOL", 100, None)
+    await session.execute(
+        text(
+            "INSERT INTO idempotency_keys (scope, key, request_hash, result, created_at)"
+            "VALUES ('allocate', 'stale', 'hash', '{}', '2000-01-01 00:00:00')"
+        )
+    )
+    await session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.allocate("o1", "FOOTSTOOL", 10, uow=uow, idempotency_key="recent")
+
+    assert await idempotency.purge(session_factory, retention=3600) == 1
+
+    result = await session.execute(text("SELECT key FROM idempotency_keys"))
+    assert list(result) == [("recent",)]
+    await session.close()
@@ -0,0 +1,87 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import text
+
+from domain import model
+from entrypoints.fastapi_app import encode_rows
+from service_layer import cache, services, unit_of_work, views
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    cache.availability.clear()
+    yield
+    cache.availability.clear()
+
+
+@pytest.mark.asyncio
+async def test_availability_per_batch(session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "DESK", 10, None, uow)
+    await services.add_batch("batch2", "DESK", 20, None, uow)
+    await services.allocate("o1", "DESK", 4, uow)
+
+    batches = await views.availability("DESK", uow)
+
+    assert [(b["reference"], b["available"]) for b in batches] == [("batch1", 6), ("batch2", 20)]
+    assert await views.availability("NOPE", uow) is None
+
+
+@pytest.mark.asyncio
+async def test_availability_is_cached_until_the_product_changes(session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "LAMP", 10, None, uow)
+    await views.availability("LAMP", uow)
+
+    session = session_factory()
+    await session.execute(text("UPDATE batches SET purchased_quantity = 50"))
+    await session.commit()
+    assert (await views.availability("LAMP", uow))[0]["available"] == 10
+
+    async with uow:
+        product = await uow.products.get_for_allocation("LAMP")
+        product.allocate(model.OrderLine("o1", "LAMP", 5))
+        await uow.commit()
+
+    assert (await views.availability("LAMP", uow))[0]["available"] == 45
+
+
+async def collect(chunks) -> list:
+    return [tuple(row) async for rows in chunks for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_export_allocations_filters_by_sku_and_eta(session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "CHAIR", 10, None, uow)
+    await services.add_batch("batch2", "TABLE", 10, date(2030, 1, 1), uow)
+    for orderid in ("o1", "o2", "o3"):
+        await services.allocate(orderid, "CHAIR", 1, uow)
+    await services.allocate("o4", "TABLE", 2, uow)
+
+    everything = await collect(views.export_allocations(uow, chunk_size=2))
+    assert [row[0] for row in everything] == ["o1", "o2", "o3", "o4"]
+
+    chairs = await collect(views.export_allocations(uow, chunk_size=2, sku="CHAIR"))
+    assert chairs == [(orderid, "CHAIR", 1, "batch1", None) for orderid in ("o1", "o2", "o3")]
+
+    shipped = await collect(views.export_allocations(uow, chunk_size=2, eta_from=date(2029, 12, 1)))
+    assert shipped == [("o4", "TABLE", 2, "batch2", date(2030, 1, 1))]
+
+
+@pytest.mark.asyncio
+async def test_export_batches_as_csv(session_factory) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    await services.add_batch("batch1", "SHELF", 10, None, uow)
+    await services.add_batch("batch2", "SHELF", 5, date(2030, 1, 1), uow)
+    await services.allocate("o1", "SHELF", 4, uow)
+
+    chunks = views.export_batches(uow, chunk_size=1, sku="SHELF")
+    body = b"".join([chunk async for chunk in encode_rows(chunks, views.BATCH_EXPORT_COLUMNS, "csv")])
+
+    assert body.decode().splitlines() == [
+        "reference,sku,eta,purchased_quantity,allocated",
+        "batch1,SHELF,,10,4",
+        "batch2,SHELF,2030-01-01,5,0",
+    ]
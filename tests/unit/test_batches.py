@@ -61,3 +61,34 @@ def test_can_only_deallocate_allocated_lines():
     batch, unallocated_line = make_batch_and_line("SOMETHING", 20, 2)
     batch.deallocate(unallocated_line)
     assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_tracks_allocations() -> None:
+    batch = Batch("batch-001", "DESK-LAMP", qty=100, eta=None)
+    lines = [OrderLine(f"order-{i}", "DESK-LAMP", i) for i in range(1, 8)]
+
+    for line in lines:
+        batch.allocate(line)
+        assert batch.allocated_quantity == sum(line.qty for line in batch.allocations)
+
+    for line in lines[::2]:
+        batch.deallocate(line)
+        assert batch.allocated_quantity == sum(line.qty for line in batch.allocations)
+
+    assert batch.available_quantity == batch.purchased_quantity - sum(line.qty for line in batch.allocations)
+
+
+def test_rejected_allocation_does_not_change_allocated_quantity() -> None:
+    batch, line = make_batch_and_line("MONITOR", 5, 10)
+    batch.allocate(line)
+    assert batch.allocated_quantity == 0
+    assert batch.allocations == set()
+
+
+def test_allocated_quantity_is_recomputed_when_marked_stale() -> None:
+    batch, line = make_batch_and_line("SPEAKER", 20, 3)
+    batch.allocations.add(line)
+    batch._allocated_quantity = None
+
+    assert batch.allocated_quantity == 3
+    assert batch.available_quantity == 17
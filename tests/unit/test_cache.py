@@ -0,0 +1,44 @@
+from service_layer.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted() -> None:
+    cache = TTLCache("test-lru", maxsize=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_ttl() -> None:
+    clock = FakeClock()
+    cache = TTLCache("test-ttl", maxsize=10, ttl=5, clock=clock)
+    cache.put("a", 1)
+
+    clock.now = 4
+    assert cache.get("a") == 1
+    clock.now = 6
+    assert cache.get("a") is None
+
+
+def test_hits_and_misses_are_counted() -> None:
+    cache = TTLCache("test-counters", maxsize=10, ttl=60)
+    hits, misses = cache.hits.value, cache.misses.value
+
+    cache.get("a")
+    cache.put("a", 1)
+    cache.get("a")
+
+    assert (cache.hits.value - hits, cache.misses.value - misses) == (1, 1)
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from domain import exceptions
+from service_layer import services
+from service_layer.coalescing import AllocationCoalescer
+from service_layer.unit_of_work import FakeUnitOfWork
+
+
+class CountingUnitOfWork(FakeUnitOfWork):
+    def __init__(self):
+        super().__init__()
+        self.commits = 0
+
+    async def _commit(self):
+        self.commits += 1
+        await super()._commit()
+
+
+async def make_uow(sku: str, qty: int) -> CountingUnitOfWork:
+    uow = CountingUnitOfWork()
+    await services.add_batch(reference="b1", sku=sku, purchased_quantity=qty, eta=None, uow=uow)
+    uow.commits = 0
+    return uow
+
+
+@pytest.mark.asyncio
+async def test_concurrent_allocations_for_a_sku_share_one_unit_of_work() -> None:
+    uow = await make_uow("HOT-SNEAKERS", 10)
+    coalescer = AllocationCoalescer(lambda: uow, window=0.01, max_group_size=100)
+
+    results = await asyncio.gather(*(coalescer.allocate(f"o{i}", "HOT-SNEAKERS", 2) for i in range(4)))
+
+    assert results == ["b1", "b1", "b1", "b1"]
+    assert uow.commits == 1
+
+
+@pytest.mark.asyncio
+async def test_lines_of_a_group_past_the_stock_are_out_of_stock() -> None:
+    uow = await make_uow("HOT-BOOTS", 10)
+    coalescer = AllocationCoalescer(lambda: uow, window=0.01, max_group_size=100)
+
+    results = await asyncio.gather(
+        *(coalescer.allocate(f"o{i}", "HOT-BOOTS", 3) for i in range(4)), return_exceptions=True
+    )
+
+    assert results[:3] == ["b1", "b1", "b1"]
+    assert isinstance(results[3], exceptions.OutOfStock)
+    assert str(results[3]) == "Out of stock for sku HOT-BOOTS"
+    assert uow.commits == 1
+
+
+@pytest.mark.asyncio
+async def test_full_group_is_allocated_without_waiting_for_the_window() -> None:
+    uow = await make_uow("HOT-JACKET", 10)
+    coalescer = AllocationCoalescer(lambda: uow, window=60, max_group_size=2)
+
+    results = await asyncio.wait_for(
+        asyncio.gather(coalescer.allocate("o1", "HOT-JACKET", 1), coalescer.allocate("o2", "HOT-JACKET", 1)),
+        timeout=1,
+    )
+
+    assert results == ["b1", "b1"]
+
+
+@pytest.mark.asyncio
+async def test_invalid_sku_is_raised_to_every_caller() -> None:
+    uow = await make_uow("REAL-SKU", 10)
+    coalescer = AllocationCoalescer(lambda: uow, window=0.01, max_group_size=100)
+
+    results = await asyncio.gather(
+        coalescer.allocate("o1", "FAKE-SKU", 1), coalescer.allocate("o2", "FAKE-SKU", 1), return_exceptions=True
+    )
+
+    assert all(isinstance(r, services.InvalidSku) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_invalid_sku_is_recognised_by_its_type_not_its_message(monkeypatch) -> None:
+    uow = await make_uow("REAL-SKU", 10)
+    coalescer = AllocationCoalescer(lambda: uow, window=0.01, max_group_size=100)
+
+    async def allocate_many(lines, uow):
+        return [
+            services.AllocationResult(**line, error="No such product", error_type=services.InvalidSku) for line in lines
+        ]
+
+    monkeypatch.setattr(services, "allocate_many", allocate_many)
+
+    with pytest.raises(services.InvalidSku, match="No such product"):
+        await coalescer.allocate("o1", "GONE-SKU", 1)
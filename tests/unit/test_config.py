@@ -0,0 +1,46 @@
+import config
+
+
+def test_engine_options_are_read_from_env(monkeypatch) -> None:
+    monkeypatch.setenv("DB_POOL_SIZE", "20")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "false")
+    monkeypatch.setenv("DB_STATEMENT_CACHE_SIZE", "0")
+
+    options = config.get_engine_options()
+
+    assert options["pool_size"] == 20
+    assert options["pool_pre_ping"] is False
+    assert options["connect_args"]["statement_cache_size"] == 0
+
+
+def test_database_uri_defaults_to_postgres(monkeypatch) -> None:
+    monkeypatch.delenv("DB_URI", raising=False)
+    assert config.get_database_uri() == config.get_postgres_uri()
+
+    monkeypatch.setenv("DB_URI", "sqlite+aiosqlite:///bench.db")
+    assert config.get_database_uri() == "sqlite+aiosqlite:///bench.db"
+
+
+def test_server_options_default_to_a_single_development_server(monkeypatch) -> None:
+    for name in ("API_HOST", "API_PORT", "SERVER_MODE", "ACCESS_LOG_SAMPLE_RATE"):
+        monkeypatch.delenv(name, raising=False)
+
+    options = config.get_server_options()
+
+    assert options["port"] == 10300
+    assert options["production"] is False
+    assert options["access_log_sample_rate"] == 0
+    assert config.get_api_url() == "http://localhost:10300"
+
+
+def test_server_options_for_production(monkeypatch) -> None:
+    monkeypatch.setenv("API_HOST", "0.0.0.0")
+    monkeypatch.setenv("API_PORT", "8000")
+    monkeypatch.setenv("SERVER_MODE", "production")
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+
+    options = config.get_server_options()
+
+    assert options["port"] == 8000
+    assert options["production"] is True
+    assert options["workers"] == 4
@@ -0,0 +1,41 @@
+import pytest
+
+from adapters import email
+
+
+class RecordingSMTP:
+    sent = []
+
+    def __init__(self, host, port, timeout):
+        self.address = (host, port)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send_message(self, message):
+        self.sent.append((self.address, message["To"], message.get_content().strip()))
+
+
+@pytest.mark.asyncio
+async def test_mail_goes_to_the_configured_smtp_server(monkeypatch) -> None:
+    monkeypatch.setenv("SMTP_HOST", "mail.example.com")
+    monkeypatch.setenv("SMTP_PORT", "2525")
+    monkeypatch.setattr(email.smtplib, "SMTP", RecordingSMTP)
+
+    await email.send_mail("stock@made.com", "Out of stock for LAMP")
+
+    assert RecordingSMTP.sent == [(("mail.example.com", 2525), "stock@made.com", "Out of stock for LAMP")]
+
+
+@pytest.mark.asyncio
+async def test_mail_is_only_logged_without_smtp_server(monkeypatch, caplog) -> None:
+    monkeypatch.delenv("SMTP_HOST", raising=False)
+    monkeypatch.setattr(email.smtplib, "SMTP", None)
+
+    with caplog.at_level("INFO"):
+        await email.send_mail("stock@made.com", "Out of stock for LAMP")
+
+    assert "Out of stock for LAMP" in caplog.text
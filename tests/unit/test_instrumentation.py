@@ -0,0 +1,52 @@
+import pytest
+
+from service_layer import instrumentation, services
+from service_layer.metrics import Histogram
+from service_layer.unit_of_work import FakeUnitOfWork
+
+
+@pytest.fixture
+def spans():
+    recorded = []
+    instrumentation.configure(True, sinks=[lambda name, seconds: recorded.append(name)])
+    yield recorded
+    instrumentation.configure(False)
+
+
+@pytest.mark.asyncio
+async def test_allocation_stages_are_timed(spans) -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="RADIO", purchased_quantity=10, eta=None, uow=uow)
+    spans.clear()
+
+    await services.allocate(orderid="o1", sku="RADIO", qty=1, uow=uow)
+
+    assert spans[:4] == ["repository.get_for_allocation", "product.allocate", "uow.commit", "uow.publish_events"]
+    assert spans[-1] == "uow"
+
+
+@pytest.mark.asyncio
+async def test_nothing_is_recorded_when_disabled(spans) -> None:
+    instrumentation.configure(False)
+    uow = FakeUnitOfWork()
+
+    await services.add_batch(reference="b1", sku="RADIO", purchased_quantity=10, eta=None, uow=uow)
+
+    assert spans == []
+    assert instrumentation.span("anything") is instrumentation.span("other")
+
+
+def test_histogram_renders_cumulative_buckets() -> None:
+    histogram = Histogram("test_seconds", "Test", buckets=(0.1, 1.0), label="span")
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, "commit")
+
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{span="commit",le="0.1"} 1',
+        'test_seconds_bucket{span="commit",le="1.0"} 3',
+        'test_seconds_bucket{span="commit",le="+Inf"} 4',
+        'test_seconds_sum{span="commit"} 4.25',
+        'test_seconds_count{span="commit"} 4',
+    ]
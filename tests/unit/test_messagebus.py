@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from domain import events
+from service_layer import messagebus, views
+from service_layer.unit_of_work import FakeUnitOfWork
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    handled = []
+    release = asyncio.Event()
+
+    async def slow_handler(event, uow):
+        await release.wait()
+        handled.append(event)
+
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [slow_handler])
+    yield handled, release
+    release.set()
+
+
+@pytest.mark.asyncio
+async def test_handle_does_not_wait_for_handlers(handled) -> None:
+    handled, release = handled
+
+    await messagebus.handle(events.OutOfStock(sku="LAMP"), uow_factory=FakeUnitOfWork)
+    assert handled == []
+
+    release.set()
+    await messagebus.drain()
+    assert handled == [events.OutOfStock(sku="LAMP")]
+
+
+@pytest.mark.asyncio
+async def test_failing_handler_does_not_stop_the_workers(monkeypatch) -> None:
+    handled = []
+
+    def flaky_handler(event, uow):
+        if event.sku == "BROKEN":
+            raise ValueError(event.sku)
+        handled.append(event)
+
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [flaky_handler])
+
+    broken = await messagebus.handle(events.OutOfStock(sku="BROKEN"), uow_factory=FakeUnitOfWork)
+    chair = await messagebus.handle(events.OutOfStock(sku="CHAIR"), uow_factory=FakeUnitOfWork)
+    await messagebus.drain()
+
+    assert handled == [events.OutOfStock(sku="CHAIR")]
+    assert await broken is False
+    assert await chair is True
+
+
+@pytest.mark.asyncio
+async def test_allocations_read_model_follows_allocated_and_deallocated() -> None:
+    uow = FakeUnitOfWork()
+
+    await messagebus.dispatch(events.Allocated("o1", "SOFA", 1, "b1"), uow.fresh)
+    await messagebus.dispatch(events.Allocated("o1", "RUG", 2, "b2"), uow.fresh)
+    await messagebus.dispatch(events.Allocated("o1", "RUG", 2, "b2"), uow.fresh)
+    assert await views.allocations("o1", uow) == [
+        {"sku": "SOFA", "batchref": "b1"},
+        {"sku": "RUG", "batchref": "b2"},
+    ]
+
+    await messagebus.dispatch(events.Deallocated("o1", "SOFA", 1, "b1"), uow.fresh)
+    assert await views.allocations("o1", uow) == [{"sku": "RUG", "batchref": "b2"}]
+
+
+@pytest.mark.asyncio
+async def test_read_model_keeps_apart_lines_of_an_order_on_the_same_batch() -> None:
+    uow = FakeUnitOfWork()
+
+    await messagebus.dispatch(events.Allocated("o1", "SOFA", 1, "b1"), uow.fresh)
+    await messagebus.dispatch(events.Allocated("o1", "SOFA", 2, "b1"), uow.fresh)
+    assert await views.allocations("o1", uow) == [
+        {"sku": "SOFA", "batchref": "b1"},
+        {"sku": "SOFA", "batchref": "b1"},
+    ]
+
+    await messagebus.dispatch(events.Deallocated("o1", "SOFA", 1, "b1"), uow.fresh)
+    assert await views.allocations("o1", uow) == [{"sku": "SOFA", "batchref": "b1"}]
@@ -0,0 +1,75 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from domain.model import Batch, OrderLine, Product
+from domain.planning import allocate_columns
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+later = tomorrow + timedelta(days=10)
+
+
+def allocate_through_products(lines, batches):
+    """Reference result: every line allocated one by one through its Product."""
+    products = {}
+    for ref, sku, qty, eta in batches:
+        products.setdefault(sku, Product(sku, [])).batches.append(Batch(ref, sku, qty, eta))
+
+    refs = []
+    for orderid, sku, qty in lines:
+        product = products.get(sku)
+        refs.append(product.allocate(OrderLine(orderid, sku, qty)) if product else None)
+
+    available = {b.reference: b.available_quantity for p in products.values() for b in p.batches}
+    return refs, [available[ref] for ref, *_ in batches]
+
+
+def allocate_as_columns(lines, batches):
+    orderids, line_skus, line_qtys = zip(*lines) if lines else ((), (), ())
+    refs, batch_skus, batch_qtys, etas = zip(*batches) if batches else ((), (), (), ())
+    result = allocate_columns(line_skus, line_qtys, orderids, refs, batch_skus, batch_qtys, etas)
+    return result.batchref, result.available
+
+
+def test_prefers_in_stock_then_earliest_batches() -> None:
+    batches = [
+        ("slow-batch", "CLOCK", 10, later),
+        ("speedy-batch", "CLOCK", 10, tomorrow),
+        ("in-stock-batch", "CLOCK", 10, None),
+    ]
+    lines = [("o1", "CLOCK", 8), ("o2", "CLOCK", 5), ("o3", "CLOCK", 2)]
+
+    refs, available = allocate_as_columns(lines, batches)
+
+    assert refs == ["in-stock-batch", "speedy-batch", "in-stock-batch"]
+    assert available == [10, 5, 0]
+
+
+def test_out_of_stock_and_unknown_skus_get_no_batch() -> None:
+    batches = [("batch1", "LAMP", 5, None)]
+    lines = [("o1", "LAMP", 6), ("o2", "SOFA", 1), ("o3", "LAMP", 5)]
+
+    refs, available = allocate_as_columns(lines, batches)
+
+    assert refs == [None, None, "batch1"]
+    assert available == [0]
+
+
+def test_rejects_columns_of_different_length() -> None:
+    with pytest.raises(ValueError):
+        allocate_columns(["LAMP"], [1, 2], ["o1"], [], [], [], [])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_allocating_line_by_line(seed) -> None:
+    rng = random.Random(seed)
+    skus = [f"sku-{n}" for n in range(5)]
+    etas = [None, today, tomorrow, later]
+    batches = [
+        (f"batch-{n}", rng.choice(skus), rng.randint(0, 50), rng.choice(etas)) for n in range(rng.randint(0, 15))
+    ]
+    lines = [(f"order-{n}", rng.choice(skus), rng.randint(1, 20)) for n in range(rng.randint(0, 200))]
+
+    assert allocate_as_columns(lines, batches) == allocate_through_products(lines, batches)
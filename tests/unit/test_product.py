@@ -66,3 +66,92 @@ def test_increments_version_number() -> None:
     product.allocate(line)
 
     assert product.version_number == 8
+
+
+def test_skips_exhausted_batches() -> None:
+    exhausted = Batch("exhausted-batch", "TURNTABLE", 5, eta=None)
+    shipment = Batch("shipment-batch", "TURNTABLE", 100, eta=tomorrow)
+    product = Product(sku="TURNTABLE", batches=[exhausted, shipment])
+
+    assert product.allocate(OrderLine("order1", "TURNTABLE", 5)) == "exhausted-batch"
+    assert product.allocate(OrderLine("order2", "TURNTABLE", 1)) == "shipment-batch"
+    assert exhausted not in product._in_stock()
+
+
+def test_added_batches_take_their_place_in_allocation_order() -> None:
+    product = Product(sku="SUBWOOFER", batches=[Batch("late-batch", "SUBWOOFER", 100, eta=later)])
+    product.allocate(OrderLine("order1", "SUBWOOFER", 1))
+
+    product.add_batch(Batch("early-batch", "SUBWOOFER", 100, eta=tomorrow))
+    product.add_batch(Batch("in-stock-batch", "SUBWOOFER", 100, eta=None))
+
+    assert [b.reference for b in product._in_stock()] == ["in-stock-batch", "early-batch", "late-batch"]
+    assert product.allocate(OrderLine("order2", "SUBWOOFER", 1)) == "in-stock-batch"
+
+
+def test_restocked_batch_is_used_again() -> None:
+    batch = Batch("batch1", "EQUALIZER", 10, eta=today)
+    product = Product(sku="EQUALIZER", batches=[batch])
+    line = OrderLine("order1", "EQUALIZER", 10)
+    product.allocate(line)
+
+    batch.deallocate(line)
+    product.refresh_batch(batch)
+
+    assert product.allocate(OrderLine("order2", "EQUALIZER", 4)) == "batch1"
+
+
+def test_records_allocated_and_deallocated_events() -> None:
+    batch = Batch("batch1", "HAMMOCK", 10, eta=None)
+    product = Product(sku="HAMMOCK", batches=[batch])
+    line = OrderLine("order1", "HAMMOCK", 4)
+
+    product.allocate(line)
+    assert product.deallocate(line) == "batch1"
+
+    assert product.events == [
+        events.Allocated("order1", "HAMMOCK", 4, "batch1"),
+        events.Deallocated("order1", "HAMMOCK", 4, "batch1"),
+    ]
+    assert batch.available_quantity == 10
+
+
+def test_deallocate_all_frees_every_batch() -> None:
+    in_stock = Batch("in-stock-batch", "TORCH", 10, eta=None)
+    shipment = Batch("shipment-batch", "TORCH", 10, eta=tomorrow)
+    product = Product(sku="TORCH", batches=[in_stock, shipment])
+    product.allocate(OrderLine("order1", "TORCH", 10))
+    product.allocate(OrderLine("order2", "TORCH", 3))
+    version = product.version_number
+
+    lines = product.deallocate_all()
+
+    assert sorted(line.orderid for line in lines) == ["order1", "order2"]
+    assert in_stock.available_quantity == 10 and shipment.available_quantity == 10
+    assert product.version_number == version + 1
+    assert product.allocate(OrderLine("order3", "TORCH", 5)) == "in-stock-batch"
+
+
+def test_reducing_batch_quantity_moves_the_fewest_lines() -> None:
+    in_stock = Batch("in-stock-batch", "LANTERN", 20, eta=None)
+    shipment = Batch("shipment-batch", "LANTERN", 20, eta=tomorrow)
+    product = Product(sku="LANTERN", batches=[in_stock, shipment])
+    for orderid, qty in (("o1", 2), ("o2", 8), ("o3", 3), ("o4", 5)):
+        product.allocate(OrderLine(orderid, "LANTERN", qty))
+
+    moved = product.change_batch_quantity("in-stock-batch", 10)
+
+    assert moved == [(OrderLine("o2", "LANTERN", 8), "shipment-batch")]
+    assert in_stock.available_quantity == 0
+    assert shipment.available_quantity == 12
+    assert events.BatchQuantityChanged("in-stock-batch", "LANTERN", 10) in product.events
+
+
+def test_lines_without_room_elsewhere_end_up_unallocated() -> None:
+    batch = Batch("batch1", "CANOE", 10, eta=None)
+    product = Product(sku="CANOE", batches=[batch])
+    product.allocate(OrderLine("o1", "CANOE", 6))
+
+    assert product.change_batch_quantity("batch1", 5) == [(OrderLine("o1", "CANOE", 6), None)]
+    assert batch.available_quantity == 5
+    assert product.events[-1] == events.OutOfStock("CANOE")
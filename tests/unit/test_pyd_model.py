@@ -0,0 +1,31 @@
+from adapters.pyd_model import OrderLine
+
+
+def make_line(**fields) -> OrderLine:
+    return OrderLine(**{"orderid": "order-1", "sku": "LAMP", "qty": 1, **fields})
+
+
+def test_equal_lines_hash_the_same() -> None:
+    line, same = make_line(), make_line()
+
+    assert line == same
+    assert hash(line) == hash(same)
+    assert len({line, same}) == 1
+
+
+def test_lines_differing_in_any_field_are_not_equal() -> None:
+    line = make_line()
+
+    assert line != make_line(orderid="order-2")
+    assert line != make_line(sku="DESK")
+    assert line != make_line(qty=2)
+
+
+def test_copy_with_changed_fields_is_rehashed() -> None:
+    line = make_line()
+    hash(line)
+
+    changed = line.model_copy(update={"qty": 5})
+
+    assert hash(changed) == hash(make_line(qty=5))
+    assert changed == make_line(qty=5)
@@ -0,0 +1,21 @@
+import pytest
+
+import reallocate
+from service_layer import services
+
+
+@pytest.mark.asyncio
+async def test_a_failing_sku_does_not_stop_the_sweep(monkeypatch) -> None:
+    async def fake_reallocate(sku, uow):
+        if sku == "BROKEN":
+            raise RuntimeError("connection reset")
+        return 2, 1
+
+    monkeypatch.setattr(services, "reallocate", fake_reallocate)
+
+    result = await reallocate._sweep("reallocate", ["LAMP", "BROKEN", "SOFA"])
+
+    assert result["skus"] == 3
+    assert result["lines"] == 6
+    assert result["unallocated"] == 2
+    assert result["failed"] == ["BROKEN"]
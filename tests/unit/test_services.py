@@ -1,7 +1,11 @@
+from datetime import date
+
 import pytest
 
-from service_layer import services
-from service_layer.unit_of_work import FakeUnitOfWork
+from domain import exceptions
+from repositories.repository import FakeRepository
+from service_layer import idempotency, services
+from service_layer.unit_of_work import ConcurrencyConflict, FakeUnitOfWork
 
 # class FakeSession:
 #     committed = False
@@ -10,6 +14,18 @@ from service_layer.unit_of_work import FakeUnitOfWork
 #         self.committed = True
 
 
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    def __init__(self, conflicts: int):
+        super().__init__()
+        self.conflicts = conflicts
+
+    async def _commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ConcurrencyConflict("product changed")
+        await super()._commit()
+
+
 @pytest.mark.asyncio
 async def test_commits() -> None:
     uow = FakeUnitOfWork()
@@ -38,6 +54,18 @@ async def test_allocate_error_for_invalid_sku() -> None:
         await services.allocate(orderid="o1", sku="NONEXISTENTSKU", qty=10, uow=uow)
 
 
+@pytest.mark.asyncio
+async def test_allocate_error_for_out_of_stock() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="SMALL-TABLE", purchased_quantity=10, eta=None, uow=uow)
+    uow.committed = False
+
+    with pytest.raises(exceptions.OutOfStock, match="Out of stock for sku SMALL-TABLE"):
+        await services.allocate(orderid="o1", sku="SMALL-TABLE", qty=20, uow=uow)
+
+    assert uow.committed
+
+
 @pytest.mark.asyncio
 async def test_add_batch_for_new_product() -> None:
     uow = FakeUnitOfWork()
@@ -64,3 +92,213 @@ async def test_add_batch_for_existing_product() -> None:
     await services.add_batch(reference="b2", sku="TABLE", purchased_quantity=99, eta=None, uow=uow)
 
     assert "b2" in [b.reference for b in (await uow.products.get("TABLE")).batches]
+
+
+@pytest.mark.asyncio
+async def test_allocate_many_reports_each_line() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="LAMP", purchased_quantity=10, eta=None, uow=uow)
+    await services.add_batch(reference="b2", sku="CHAIR", purchased_quantity=5, eta=None, uow=uow)
+    uow.committed = False
+
+    results = await services.allocate_many(
+        [
+            {"orderid": "o1", "sku": "LAMP", "qty": 4},
+            {"orderid": "o2", "sku": "CHAIR", "qty": 5},
+            {"orderid": "o3", "sku": "LAMP", "qty": 6},
+            {"orderid": "o4", "sku": "UNKNOWN", "qty": 1},
+        ],
+        uow=uow,
+    )
+
+    assert [(r.orderid, r.batchref, r.error) for r in results] == [
+        ("o1", "b1", None),
+        ("o2", "b2", None),
+        ("o3", "b1", None),
+        ("o4", None, "Invalid sku UNKNOWN"),
+    ]
+    assert uow.committed is True
+
+
+@pytest.mark.asyncio
+async def test_allocate_many_reports_lines_out_of_stock() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="DESK", purchased_quantity=10, eta=None, uow=uow)
+
+    results = await services.allocate_many(
+        [{"orderid": "o1", "sku": "DESK", "qty": 4}, {"orderid": "o2", "sku": "DESK", "qty": 7}],
+        uow=uow,
+    )
+
+    assert [(r.orderid, r.batchref, r.error) for r in results] == [
+        ("o1", "b1", None),
+        ("o2", None, "Out of stock for sku DESK"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_add_batch_rejects_a_taken_reference() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="LAMP", purchased_quantity=10, eta=None, uow=uow)
+
+    with pytest.raises(exceptions.DuplicateBatch, match="b1"):
+        await services.add_batch(reference="b1", sku="CHAIR", purchased_quantity=5, eta=None, uow=uow)
+
+    assert [b.reference for b in (await uow.products.get("LAMP")).batches] == ["b1"]
+
+
+@pytest.mark.asyncio
+async def test_add_batches_rejects_taken_or_repeated_references() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="SOFA", purchased_quantity=10, eta=None, uow=uow)
+
+    for batches in (
+        [{"reference": "b1", "sku": "RUG", "purchased_quantity": 20, "eta": None}],
+        [
+            {"reference": "b2", "sku": "RUG", "purchased_quantity": 20, "eta": None},
+            {"reference": "b2", "sku": "RUG", "purchased_quantity": 30, "eta": None},
+        ],
+    ):
+        with pytest.raises(exceptions.DuplicateBatch):
+            await services.add_batches(batches, uow=uow)
+
+    assert await uow.products.get("RUG") is None
+
+
+@pytest.mark.asyncio
+async def test_add_batches_creates_missing_products() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="SOFA", purchased_quantity=10, eta=None, uow=uow)
+
+    added = await services.add_batches(
+        [
+            {"reference": "b2", "sku": "SOFA", "purchased_quantity": 20, "eta": None},
+            {"reference": "b3", "sku": "RUG", "purchased_quantity": 30, "eta": None},
+        ],
+        uow=uow,
+    )
+
+    assert added == 2
+    assert [b.reference for b in (await uow.products.get("SOFA")).batches] == ["b1", "b2"]
+    assert [b.reference for b in (await uow.products.get("RUG")).batches] == ["b3"]
+    assert uow.committed
+
+
+@pytest.mark.asyncio
+async def test_allocate_retries_on_conflict(monkeypatch) -> None:
+    monkeypatch.setenv("ALLOCATE_RETRY_BASE_DELAY", "0")
+    uow = ConflictingUnitOfWork(conflicts=0)
+    await services.add_batch(reference="b1", sku="BENCH", purchased_quantity=100, eta=None, uow=uow)
+    uow.conflicts = 2
+    retries = services.allocate_retries.value
+
+    result = await services.allocate(orderid="o1", sku="BENCH", qty=10, uow=uow)
+
+    assert result == "b1"
+    assert uow.committed
+    assert services.allocate_retries.value == retries + 2
+
+
+@pytest.mark.asyncio
+async def test_allocate_gives_up_after_max_attempts(monkeypatch) -> None:
+    monkeypatch.setenv("ALLOCATE_MAX_ATTEMPTS", "3")
+    monkeypatch.setenv("ALLOCATE_RETRY_BASE_DELAY", "0")
+    uow = ConflictingUnitOfWork(conflicts=0)
+    await services.add_batch(reference="b1", sku="BEANBAG", purchased_quantity=100, eta=None, uow=uow)
+    uow.conflicts = 3
+
+    with pytest.raises(ConcurrencyConflict):
+        await services.allocate(orderid="o1", sku="BEANBAG", qty=10, uow=uow)
+
+
+@pytest.mark.asyncio
+async def test_reallocate_moves_lines_to_earlier_batches() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="shipment", sku="KETTLE", purchased_quantity=10, eta=date.today(), uow=uow)
+    await services.allocate(orderid="o1", sku="KETTLE", qty=4, uow=uow)
+    await services.allocate(orderid="o2", sku="KETTLE", qty=4, uow=uow)
+    await services.add_batch(reference="in-stock", sku="KETTLE", purchased_quantity=5, eta=None, uow=uow)
+
+    assert await services.reallocate("KETTLE", uow) == (2, 0)
+
+    product = await uow.products.get("KETTLE")
+    assert [(b.reference, b.available_quantity) for b in product.batches] == [("shipment", 6), ("in-stock", 1)]
+
+
+@pytest.mark.asyncio
+async def test_deallocate_all_counts_lines() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="TOASTER", purchased_quantity=10, eta=None, uow=uow)
+    await services.allocate(orderid="o1", sku="TOASTER", qty=4, uow=uow)
+
+    assert await services.deallocate_all("TOASTER", uow) == 1
+    assert (await uow.products.get("TOASTER")).batches[0].available_quantity == 10
+
+    with pytest.raises(services.InvalidSku):
+        await services.deallocate_all("UNKNOWN", uow)
+
+
+@pytest.mark.asyncio
+async def test_deallocate_returns_the_batch_of_the_line() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="BLENDER", purchased_quantity=10, eta=None, uow=uow)
+    await services.allocate(orderid="o1", sku="BLENDER", qty=4, uow=uow)
+
+    assert await services.deallocate(orderid="o1", sku="BLENDER", qty=4, uow=uow) == "b1"
+    assert (await uow.products.get("BLENDER")).batches[0].available_quantity == 10
+
+    with pytest.raises(services.NotAllocated):
+        await services.deallocate(orderid="o1", sku="BLENDER", qty=4, uow=uow)
+
+
+@pytest.mark.asyncio
+async def test_change_batch_quantity_reports_moved_lines() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="GRILL", purchased_quantity=10, eta=None, uow=uow)
+    await services.add_batch(reference="b2", sku="GRILL", purchased_quantity=10, eta=date.today(), uow=uow)
+    await services.allocate(orderid="o1", sku="GRILL", qty=6, uow=uow)
+    await services.allocate(orderid="o2", sku="GRILL", qty=4, uow=uow)
+
+    results = await services.change_batch_quantity("b1", 5, uow=uow)
+
+    assert [(r.orderid, r.batchref, r.error) for r in results] == [("o1", "b2", None)]
+
+    with pytest.raises(services.UnknownBatch):
+        await services.change_batch_quantity("missing", 5, uow=uow)
+
+
+@pytest.mark.asyncio
+async def test_allocate_with_a_used_idempotency_key_replays_without_loading_the_product() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="TEAPOT", purchased_quantity=100, eta=None, uow=uow)
+    first = await services.allocate(orderid="o1", sku="TEAPOT", qty=10, uow=uow, idempotency_key="teapot-o1")
+
+    products = uow.products
+    uow.products = FakeRepository([])
+    retried = await services.allocate(orderid="o1", sku="TEAPOT", qty=10, uow=uow, idempotency_key="teapot-o1")
+
+    assert first == retried == "b1"
+    [product] = products._products
+    assert product.batches[0].available_quantity == 90
+
+
+@pytest.mark.asyncio
+async def test_idempotency_key_reused_for_another_request() -> None:
+    uow = FakeUnitOfWork()
+    await services.add_batch(reference="b1", sku="SAUCER", purchased_quantity=100, eta=None, uow=uow)
+    await services.allocate(orderid="o1", sku="SAUCER", qty=10, uow=uow, idempotency_key="saucer-o1")
+
+    with pytest.raises(idempotency.IdempotencyKeyReused):
+        await services.allocate(orderid="o2", sku="SAUCER", qty=10, uow=uow, idempotency_key="saucer-o1")
+
+
+@pytest.mark.asyncio
+async def test_add_batch_with_a_used_idempotency_key_adds_it_once() -> None:
+    uow = FakeUnitOfWork()
+    for _ in range(2):
+        await services.add_batch(
+            reference="b1", sku="MUG", purchased_quantity=100, eta=None, uow=uow, idempotency_key="mug-b1"
+        )
+
+    product = await uow.products.get(sku="MUG")
+    assert [b.reference for b in product.batches] == ["b1"]